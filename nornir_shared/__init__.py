@@ -22,14 +22,22 @@ emaillib
 '''
 
 
-__all__ = ['argparse_helpers', 'checksum', 'files', 'histogram', 'images', 'mathhelper', 'misc', 'parallel', 'plot',
-           'processoutputinterceptor', 'reflection', 'prettyoutput', 'tasktimer']
+__all__ = ['argparse_helpers', 'checksum', 'chunkedimage', 'files', 'histogram', 'histogramcache', 'imageconvert', 'imageinfo', 'imageinfocache', 'imagepipeline', 'imagereader', 'images', 'imagevalidation', 'mathhelper', 'misc', 'parallel', 'plot',
+           'processoutputinterceptor', 'reflection', 'prettyoutput', 'tasktimer', 'tilepyramid']
 
 #
 #
 # .. automodule:: nornir_shared.checksum
+# .. automodule:: nornir_shared.chunkedimage
 # .. automodule:: nornir_shared.files
 # .. automodule:: nornir_shared.histogram
+# .. automodule:: nornir_shared.histogramcache
+# .. automodule:: nornir_shared.imageconvert
+# .. automodule:: nornir_shared.imageinfo
+# .. automodule:: nornir_shared.imageinfocache
+# .. automodule:: nornir_shared.imagepipeline
+# .. automodule:: nornir_shared.imagereader
+# .. automodule:: nornir_shared.imagevalidation
 # .. automodule:: nornir_shared.images
 # .. automodule:: nornir_shared.mathhelper
 # .. automodule:: nornir_shared.misc
@@ -39,6 +47,7 @@ __all__ = ['argparse_helpers', 'checksum', 'files', 'histogram', 'images', 'math
 # .. automodule:: nornir_shared.processoutputinterceptor
 # .. automodule:: nornir_shared.reflection
 # .. automodule:: nornir_shared.tasktimer
+# .. automodule:: nornir_shared.tilepyramid
 # .. automodule:: nornir_shared.argparse_helpers
 
 
@@ -73,5 +73,22 @@ def FileChecksum(filename: str) -> str | None:
     return None
 
 
+def BinaryFileChecksum(filename: str, algorithm: str = 'md5', chunk_size: int = 1 << 20) -> str:
+    '''
+    Return the hash of a file's bytes, read in chunks so large images are not loaded at once
+
+    :param str filename: path to file
+    :param str algorithm: Name of a hashlib algorithm
+    :return: hex digest
+    :rtype str:
+    '''
+    m = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            m.update(chunk)
+
+    return m.hexdigest()
+
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,232 @@
+'''
+Store large intermediate images as a directory of fixed size .npy chunks.
+
+A chunked image is a directory, by convention with the .npyc extension, containing a JSON
+header and one .npy file for each chunk that has been written::
+
+    section.npyc/
+        header.json     {"format": "nornir-chunked-image", "version": 1, "shape": [40000, 30000],
+                         "dtype": "|u1", "chunk_shape": [1024, 1024], "fill_value": 0}
+        0_0.npy         Rows 0-1023, columns 0-1023
+        0_1.npy         Rows 0-1023, columns 1024-2047
+        ...
+
+Chunks at the right and bottom edges are only as large as the part of the image they cover.
+Chunks that have not been written read as the fill value.  Chunks are memory mapped when read,
+so a region can be read from an image of any size without decoding, and only the chunks the
+region overlaps are touched.  Writing a region replaces each chunk it covers entirely with a
+temporary file renamed over the chunk, and updates partly covered chunks in place.
+'''
+from __future__ import annotations
+
+import json
+import math
+import os
+
+import numpy
+from numpy.typing import NDArray, DTypeLike
+
+from nornir_shared import files
+from nornir_shared import imageinfo
+from nornir_shared import imagereader
+
+ChunkedImageExtension = '.npyc'
+HeaderFilename = 'header.json'
+DefaultChunkShape = (1024, 1024)
+
+_FormatName = 'nornir-chunked-image'
+_FormatVersion = 1
+
+
+def IsChunkedImage(path: str) -> bool:
+    ''':return: True if the path is a chunked image directory'''
+    return os.path.isfile(os.path.join(path, HeaderFilename))
+
+
+class ChunkedImage(object):
+    '''An image stored as a directory of .npy chunks, see the module documentation for the layout'''
+
+    def __init__(self, path: str):
+        '''
+        Open an existing chunked image
+        :raises FileNotFoundError: The directory or its header does not exist
+        :raises ValueError: The header is not a chunked image header this version can read
+        '''
+        self.Path = path
+        with open(os.path.join(path, HeaderFilename), 'r') as f:
+            header = json.load(f)
+
+        if header.get('format') != _FormatName or header.get('version', 0) > _FormatVersion:
+            raise ValueError(f"{path} is not a chunked image of version {_FormatVersion} or earlier")
+
+        self.Shape = tuple(header['shape'])
+        self.Dtype = numpy.dtype(header['dtype'])
+        self.ChunkShape = tuple(header['chunk_shape'])
+        self.FillValue = header['fill_value']
+
+    @classmethod
+    def Create(cls, path: str, shape: tuple[int, ...], dtype: DTypeLike, chunk_shape: tuple[int, int] | None = None,
+               fill_value: int | float = 0, overwrite: bool = False) -> ChunkedImage:
+        '''
+        Create an empty chunked image, every value reads as fill_value until it is written
+        :param shape: (Height, Width) or (Height, Width, Channels)
+        :param overwrite: Replace an existing chunked image at the path, otherwise FileExistsError is raised
+        '''
+        if chunk_shape is None:
+            chunk_shape = DefaultChunkShape
+
+        if len(shape) < 2 or any(dim < 0 for dim in shape):
+            raise ValueError(f"Invalid chunked image shape {shape}")
+
+        if len(chunk_shape) != 2 or any(dim < 1 for dim in chunk_shape):
+            raise ValueError(f"Invalid chunk shape {chunk_shape}")
+
+        if IsChunkedImage(path):
+            if not overwrite:
+                raise FileExistsError(f"Chunked image {path} already exists")
+
+            for name in os.listdir(path):
+                if name.endswith('.npy'):
+                    os.remove(os.path.join(path, name))
+
+        os.makedirs(path, exist_ok=True)
+
+        dtype = numpy.dtype(dtype)
+        header = {'format': _FormatName,
+                  'version': _FormatVersion,
+                  'shape': [int(dim) for dim in shape],
+                  'dtype': dtype.str,
+                  'chunk_shape': [int(dim) for dim in chunk_shape],
+                  'fill_value': numpy.array(fill_value, dtype=dtype).item()}
+
+        with files.AtomicWrite(os.path.join(path, HeaderFilename)) as tempPath:
+            with open(tempPath, 'w') as f:
+                json.dump(header, f)
+
+        return cls(path)
+
+    @property
+    def GridShape(self) -> tuple[int, int]:
+        ''':return: Number of chunks in (Y, X)'''
+        return (int(math.ceil(self.Shape[0] / self.ChunkShape[0])),
+                int(math.ceil(self.Shape[1] / self.ChunkShape[1])))
+
+    def ChunkPath(self, iY: int, iX: int) -> str:
+        return os.path.join(self.Path, f'{iY}_{iX}.npy')
+
+    def ChunkBounds(self, iY: int, iX: int) -> tuple[int, int, int, int]:
+        ''':return: (y0, x0, y1, x1) of the image covered by a chunk'''
+        y0 = iY * self.ChunkShape[0]
+        x0 = iX * self.ChunkShape[1]
+        return y0, x0, min(y0 + self.ChunkShape[0], self.Shape[0]), min(x0 + self.ChunkShape[1], self.Shape[1])
+
+    def ReadChunk(self, iY: int, iX: int) -> NDArray:
+        ''':return: A read-only memory map of the chunk, or an array of the fill value if it has not been written'''
+        path = self.ChunkPath(iY, iX)
+        if os.path.exists(path):
+            return numpy.load(path, mmap_mode='r')
+
+        (y0, x0, y1, x1) = self.ChunkBounds(iY, iX)
+        chunk = numpy.full((y1 - y0, x1 - x0) + self.Shape[2:], self.FillValue, dtype=self.Dtype)
+        chunk.flags.writeable = False
+        return chunk
+
+    def _Clip(self, y: int, x: int, height: int, width: int) -> tuple[int, int, int, int]:
+        if y < 0 or x < 0 or height < 0 or width < 0:
+            raise ValueError(f"Invalid region y={y} x={x} height={height} width={width}")
+
+        y1 = min(y + height, self.Shape[0])
+        x1 = min(x + width, self.Shape[1])
+        return min(y, y1), min(x, x1), y1, x1
+
+    def _Chunks(self, y0: int, x0: int, y1: int, x1: int):
+        '''Yield (iY, iX, cy0, cx0, cy1, cx1) for each chunk overlapping the region, with the overlap in image coordinates'''
+        if y0 >= y1 or x0 >= x1:
+            return
+
+        for iY in range(y0 // self.ChunkShape[0], (y1 - 1) // self.ChunkShape[0] + 1):
+            for iX in range(x0 // self.ChunkShape[1], (x1 - 1) // self.ChunkShape[1] + 1):
+                (by0, bx0, by1, bx1) = self.ChunkBounds(iY, iX)
+                yield iY, iX, max(by0, y0), max(bx0, x0), min(by1, y1), min(bx1, x1)
+
+    def ReadRegion(self, y: int, x: int, height: int, width: int) -> NDArray:
+        ''':return: A copy of the region, clipped to the image bounds'''
+        (y0, x0, y1, x1) = self._Clip(y, x, height, width)
+        region = numpy.empty((y1 - y0, x1 - x0) + self.Shape[2:], dtype=self.Dtype)
+        for (iY, iX, cy0, cx0, cy1, cx1) in self._Chunks(y0, x0, y1, x1):
+            (by0, bx0) = self.ChunkBounds(iY, iX)[:2]
+            chunk = self.ReadChunk(iY, iX)
+            region[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = chunk[cy0 - by0:cy1 - by0, cx0 - bx0:cx1 - bx0]
+
+        return region
+
+    def WriteRegion(self, y: int, x: int, values: NDArray):
+        '''
+        Write values into the image with their top left corner at (y, x).  Chunks written by different
+        threads or processes at the same time must not overlap.
+        :raises ValueError: The values extend past the image bounds
+        '''
+        values = numpy.asarray(values)
+        (height, width) = values.shape[:2]
+        if y < 0 or x < 0 or y + height > self.Shape[0] or x + width > self.Shape[1] or values.shape[2:] != self.Shape[2:]:
+            raise ValueError(f"Region of shape {values.shape} at ({y}, {x}) does not fit an image of shape {self.Shape}")
+
+        for (iY, iX, cy0, cx0, cy1, cx1) in self._Chunks(y, x, y + height, x + width):
+            (by0, bx0, by1, bx1) = self.ChunkBounds(iY, iX)
+            source = values[cy0 - y:cy1 - y, cx0 - x:cx1 - x]
+            path = self.ChunkPath(iY, iX)
+
+            if (cy0, cx0, cy1, cx1) == (by0, bx0, by1, bx1):
+                with files.AtomicWrite(path) as tempPath:
+                    numpy.save(tempPath, source.astype(self.Dtype, copy=False))
+            elif os.path.exists(path):
+                chunk = numpy.lib.format.open_memmap(path, mode='r+')
+                chunk[cy0 - by0:cy1 - by0, cx0 - bx0:cx1 - bx0] = source
+                chunk.flush()
+                del chunk
+            else:
+                chunk = numpy.array(self.ReadChunk(iY, iX))
+                chunk[cy0 - by0:cy1 - by0, cx0 - bx0:cx1 - bx0] = source
+                with files.AtomicWrite(path) as tempPath:
+                    numpy.save(tempPath, chunk)
+
+    def Read(self) -> NDArray:
+        ''':return: The entire image'''
+        return self.ReadRegion(0, 0, self.Shape[0], self.Shape[1])
+
+    def Write(self, values: NDArray):
+        '''Replace the entire image'''
+        if numpy.shape(values)[:2] != self.Shape[:2]:
+            raise ValueError(f"Cannot write an image of shape {numpy.shape(values)} to a chunked image of shape {self.Shape}")
+
+        for y0 in range(0, self.Shape[0], self.ChunkShape[0]):
+            self.WriteRegion(y0, 0, values[y0:y0 + self.ChunkShape[0]])
+
+
+def FromImage(image_path: str, path: str, chunk_shape: tuple[int, int] | None = None,
+              overwrite: bool = False) -> ChunkedImage:
+    '''
+    Convert an image, such as a PNG, to a chunked image.  The image is read with
+    imagereader.IterDecodedStrips one row of chunks at a time and each row is written before the
+    next is read.  .npy files are memory mapped and non-interlaced PNGs are decoded a row of chunks
+    at a time, so neither is held in memory.  Other formats are decoded entirely first.
+    '''
+    if chunk_shape is None:
+        chunk_shape = DefaultChunkShape
+
+    height = imageinfo.ReadImageInfo(image_path).Height
+
+    store = None
+    y = 0
+    for strip in imagereader.IterDecodedStrips(image_path, rows_per_strip=chunk_shape[0], expand_palette=True):
+        if store is None:
+            store = ChunkedImage.Create(path, (height,) + strip.shape[1:], strip.dtype, chunk_shape=chunk_shape,
+                                        overwrite=overwrite)
+
+        store.WriteRegion(y, 0, strip)
+        y += strip.shape[0]
+
+    if store is None:
+        raise ValueError(f"{image_path} has no rows to convert")
+
+    return store
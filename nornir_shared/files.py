@@ -4,9 +4,11 @@ Created on Jul 11, 2012
 @author: Jamesan
 '''
 import typing
+import contextlib
 import glob
 import os
 import re
+import tempfile
 import time
 import collections.abc
 
@@ -171,6 +173,30 @@ def RemoveOutdatedFile(ReferenceFilename: str, remove_if_outdated: str | datetim
     return needsRemoving
 
 
+@contextlib.contextmanager
+def AtomicWrite(path: str, suffix: str | None = None) -> typing.Iterator[str]:
+    '''
+    Yields a temporary path in the target's directory to write, which is renamed over the target
+    when the block completes.  Readers never see a partially written file, and the temporary file
+    is removed if the block raises.
+    :param suffix: Extension of the temporary file, the target's extension by default so writers
+                   that choose a format by extension, such as PIL and numpy.save, behave the same
+    '''
+    if suffix is None:
+        suffix = os.path.splitext(path)[1]
+
+    (handle, tempPath) = tempfile.mkstemp(suffix=suffix, prefix='.tmp_', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(handle)
+
+    try:
+        yield tempPath
+        os.replace(tempPath, path)
+    except BaseException:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+
+
 def RemoveInvalidImageFile(TestFilename: str):
     '''Takes a ReferenceFilename and TestFilename.  Removes TestFilename if it is newer than the reference'''
     if not nornir_shared.images.IsValidImage(TestFilename):
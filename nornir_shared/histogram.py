@@ -1,32 +1,120 @@
 from __future__ import annotations
 import typing
-import copy
-from decimal import *
+import collections.abc
+import concurrent.futures
 import math
+import multiprocessing
 import os
-import xml.dom.minidom
+import platform
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import quoteattr
+
+import numpy
+from numpy.typing import NDArray
 
 from nornir_shared import prettyoutput
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python 3.7, SharedHistogram is unavailable and BuildParallel returns bins from each task instead
+    shared_memory = None
+
+# Integer arrays spanning fewer distinct values than this are counted by value first, then the value counts are mapped to bins
+_DirectBincountRange = 1 << 20
+
+# Number of values converted to bin indicies at a time when adding floating point arrays, bounds temporary memory use
+_AddArrayChunkSize = 1 << 20
+
+# Histograms saved with this extension use the binary numpy .npz format, all others are saved as XML
+BinaryExtension = '.npz'
+
+# Each QuantileSketch level may hold this fraction of the values of the level above it
+_SketchCapacityDecay = 2.0 / 3.0
+
+
+def IsBinaryHistogramFile(filename: str) -> bool:
+    (root, ext) = os.path.splitext(filename)
+    return ext.lower() == BinaryExtension
+
+
+def _NumberString(value) -> str:
+    '''Integral values are written without a decimal point, others as floats that read back exactly'''
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+def _AsBinArray(values) -> NDArray:
+    '''Convert a sequence of bin counts to the array type used for histogram storage.
+       Integer counts are stored as int64, fractional counts as float64.  Writeable
+       arrays of the correct type are used without copying, read-only arrays such as
+       another histogram's BinArray are copied.'''
+    if isinstance(values, BinList):
+        values = values.ToArray()
+
+    arr = numpy.asarray(values)
+    arr = arr.astype(numpy.float64 if arr.dtype.kind == 'f' else numpy.int64, copy=False)
+    if not arr.flags.writeable:
+        arr = arr.copy()
 
-def _FindValueAtPercentile(Bins, Percentile, BinWidth, BinMinValue):
-    Count = 0
-    iCutoffBin = 0
+    return arr
 
-    NumValues = sum(Bins)
+
+def _ScalarSum(bins: NDArray) -> int | float:
+    '''Sum of the bins as a python scalar'''
+    return bins.sum().item()
+
+
+def _IndexWeightedSum(counts: NDArray, iMin: int, power: int = 1) -> int | float:
+    ''':return: sum(counts[i] * (iMin + i) ** power) as a python scalar, exact for integer counts'''
+    indicies = numpy.arange(iMin, iMin + len(counts), dtype=numpy.int64)
+    if power != 1:
+        indicies = indicies ** power
+
+    if counts.dtype.kind == 'f':
+        return numpy.dot(counts, indicies).item()
+
+    # Fall back to python integers if the sum could overflow int64
+    largest_index = max(abs(iMin), abs(iMin + len(counts))) ** power
+    if _ScalarSum(counts) * largest_index < (1 << 62):
+        return numpy.dot(counts, indicies).item()
+
+    return numpy.dot(counts.astype(object), indicies.astype(object))
+
+
+def _FindValueAtPercentile(Bins, Percentile, BinWidth, BinMinValue, Cumulative=None, CumulativeOffset=0):
+    '''
+    :param Cumulative: Optional cumulative sum of the bins, which makes the search O(log n).
+                       Cumulative[i] - CumulativeOffset must equal sum(Bins[0:i+1]), which allows
+                       a slice of a histogram's cumulative array to be passed without copying.
+    '''
+    Bins = _AsBinArray(Bins)
+
+    if Cumulative is None:
+        Cumulative = numpy.cumsum(Bins)
+        CumulativeOffset = 0
+
+    NumValues = Cumulative[-1].item() - CumulativeOffset
     CutoffCount = float(NumValues) * Percentile
 
-    # OK, find the index where the cutoff occurs
-    for i in range(0, len(Bins)):
-        Count += Bins[i]
-        iCutoffBin = i
-        if Count > CutoffCount:
-            break
+    # OK, find the index where the cutoff occurs, the last bin if the cutoff is never exceeded
+    if Cumulative.dtype.kind == 'f':
+        iCutoffBin = int(numpy.searchsorted(Cumulative, CutoffCount + CumulativeOffset, side='right'))
+    else:
+        # Integer counts exceed the cutoff when they reach the next whole number, which avoids rounding CutoffCount + CumulativeOffset
+        iCutoffBin = int(numpy.searchsorted(Cumulative, CumulativeOffset + math.floor(CutoffCount) + 1, side='left'))
+
+    if iCutoffBin >= len(Bins):
+        iCutoffBin = len(Bins) - 1
+
+    Count = Cumulative[iCutoffBin].item() - CumulativeOffset
 
     # OK, find where inside the bin the cutoff occurs
-    StartingCount = Count - Bins[iCutoffBin]
+    StartingCount = Count - Bins[iCutoffBin].item()
 
-    IntrabinPercentile = float(CutoffCount - StartingCount) / float(Bins[iCutoffBin])
+    IntrabinPercentile = float(CutoffCount - StartingCount) / float(Bins[iCutoffBin].item())
 
     # Calculate the value
     BaseValue = iCutoffBin * BinWidth
@@ -36,17 +124,190 @@ def _FindValueAtPercentile(Bins, Percentile, BinWidth, BinMinValue):
     return ActualValue
 
 
+def _FindValuesAtPercentile(Bins: NDArray, Percentile: float, BinWidth: float, BinMinValue: float,
+                            Cumulative: NDArray, CumulativeOffset: NDArray | int = 0) -> NDArray[float]:
+    '''
+    _FindValueAtPercentile for each row of a 2-D array of bins
+    :param Cumulative: Cumulative sum of each row, Cumulative[r, i] - CumulativeOffset[r] must equal sum(Bins[r, 0:i+1])
+    '''
+    CumulativeOffset = numpy.broadcast_to(numpy.asarray(CumulativeOffset), (Bins.shape[0],))
+
+    NumValues = Cumulative[:, -1] - CumulativeOffset
+    CutoffCount = NumValues.astype(numpy.float64) * Percentile
+
+    # Count the bins that do not exceed the cutoff, the same comparisons as the searchsorted calls in _FindValueAtPercentile
+    if Cumulative.dtype.kind == 'f':
+        iCutoffBin = (Cumulative <= (CutoffCount + CumulativeOffset)[:, numpy.newaxis]).sum(axis=1)
+    else:
+        Target = CumulativeOffset + numpy.floor(CutoffCount).astype(numpy.int64) + 1
+        iCutoffBin = (Cumulative < Target[:, numpy.newaxis]).sum(axis=1)
+
+    numpy.minimum(iCutoffBin, Bins.shape[1] - 1, out=iCutoffBin)
+
+    rows = numpy.arange(Bins.shape[0])
+    BinCount = Bins[rows, iCutoffBin]
+    StartingCount = (Cumulative[rows, iCutoffBin] - CumulativeOffset) - BinCount
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        IntrabinPercentile = (CutoffCount - StartingCount) / BinCount.astype(numpy.float64)
+
+    return (iCutoffBin * BinWidth) + (BinWidth * IntrabinPercentile) + BinMinValue
+
+
+class BinList(collections.abc.Sequence):
+    '''
+    List compatible view of the bin counts stored in a Histogram.  Reads and
+    writes go directly to the histogram's numpy array.  Slices are returned as
+    list copies, as they were when the bins were stored in a list.
+    '''
+
+    def __init__(self, hist: Histogram):
+        self._hist = hist
+
+    def __len__(self):
+        return len(self._hist._bins)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._hist._bins[index].tolist()
+
+        return self._hist._bins[index].item()
+
+    def __setitem__(self, index, value):
+        self._hist._bins[index] = value
+        self._hist._InvalidateCache()
+
+    def __iter__(self):
+        return iter(self._hist._bins.tolist())
+
+    def __reversed__(self):
+        return iter(self._hist._bins[::-1].tolist())
+
+    def __eq__(self, other):
+        if isinstance(other, (BinList, numpy.ndarray)):
+            return numpy.array_equal(self._hist._bins, numpy.asarray(other))
+
+        if not isinstance(other, collections.abc.Sequence) or isinstance(other, str):
+            return NotImplemented
+
+        return len(other) == len(self) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __array__(self, dtype=None, copy=None):
+        '''A copy of the bins, or a read-only view if copy is False, so arrays made from the bins cannot bypass the cached statistics'''
+        if copy is False:
+            if dtype is not None and numpy.dtype(dtype) != self._hist._bins.dtype:
+                raise ValueError(f"Cannot convert {self._hist._bins.dtype} bins to {dtype} without copying")
+
+            return self._hist.BinArray
+
+        return self._hist._bins.astype(self._hist._bins.dtype if dtype is None else dtype, copy=True)
+
+    def __repr__(self):
+        return repr(self._hist._bins.tolist())
+
+    def ToArray(self) -> NDArray:
+        ''':return: A read-only view of the bin array, see Histogram.BinArray'''
+        return self._hist.BinArray
+
+    def copy(self) -> list:
+        return self._hist._bins.tolist()
+
+
 class Histogram(object):
 
     def __init__(self):
+        self._bins = numpy.zeros(0, dtype=numpy.int64)
+        self._InvalidateCache()
+
         self.MinValue = float('NaN')
         self.MaxValue = 0
         self.NumBins = 0
         self.NumSamples = 0
-
-        self.Bins = list()
         pass
 
+    def _InvalidateCache(self):
+        '''Discard values derived from the bins.  Must be called whenever the bins change.'''
+        self._cumulative = None
+        self._reverse_cumulative = None
+        self._stats = {}
+
+    def _InvalidateGeometry(self):
+        '''Discard values derived from the bin geometry.  Must be called whenever MinValue, MaxValue or NumBins change.'''
+        self._binwidth = None
+        self._InvalidateCache()
+
+    def _CachedStat(self, key, calculate: typing.Callable[[], typing.Any]):
+        ''':return: The cached value for key, calling calculate to create it if it is not cached'''
+        try:
+            return self._stats[key]
+        except KeyError:
+            value = calculate()
+            self._stats[key] = value
+            return value
+
+    @property
+    def MinValue(self) -> float:
+        return self._MinValue
+
+    @MinValue.setter
+    def MinValue(self, value: float):
+        self._MinValue = value
+        self._InvalidateGeometry()
+
+    @property
+    def MaxValue(self) -> float:
+        return self._MaxValue
+
+    @MaxValue.setter
+    def MaxValue(self, value: float):
+        self._MaxValue = value
+        self._InvalidateGeometry()
+
+    @property
+    def NumBins(self) -> int:
+        return self._NumBins
+
+    @NumBins.setter
+    def NumBins(self, value: int):
+        self._NumBins = value
+        self._InvalidateGeometry()
+
+    @property
+    def Bins(self) -> BinList:
+        '''The bin counts.  Behaves as a list but is backed by :attr:`BinArray`'''
+        return BinList(self)
+
+    @Bins.setter
+    def Bins(self, value):
+        self._bins = _AsBinArray(value)
+        self._InvalidateCache()
+
+    @property
+    def BinArray(self) -> NDArray:
+        '''The bin counts as an int64 numpy array, float64 if fractional counts were added.  A read-only
+           view, not a copy.  Change bins through Bins or the Add methods so cached statistics are updated.'''
+        view = self._bins.view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def CumulativeBins(self) -> NDArray:
+        '''Cumulative count of all bins up to and including each bin.  Built on first use and cached until the bins change.'''
+        if self._cumulative is None:
+            self._cumulative = numpy.cumsum(self._bins)
+
+        return self._cumulative
+
+    @property
+    def _ReverseCumulativeBins(self) -> NDArray:
+        '''Cumulative count of bins from the last bin down to each bin, in reverse bin order'''
+        if self._reverse_cumulative is None:
+            self._reverse_cumulative = numpy.cumsum(self._bins[::-1])
+
+        return self._reverse_cumulative
+
     def __str__(self):
         s = 'Histogram\n'
         s += 'NumBins: ' + str(self.NumBins) + '\n'
@@ -57,12 +318,25 @@ class Histogram(object):
         return s
 
     def __getstate__(self):
+        # The bins are pickled as an array, which pickle protocol 5 can transfer as an out-of-band buffer
         save = {'MinValue': self.MinValue, 'MaxValue': self.MaxValue, 'NumBins': self.NumBins,
-                'NumSamples': self.NumSamples, 'Bins': self.Bins}
+                'NumSamples': self.NumSamples, 'Bins': self._bins}
         return save
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        state = dict(state)
+        bins = state.pop('Bins', [])
+        self._bins = numpy.zeros(0, dtype=numpy.int64)
+        self._InvalidateGeometry()
+        for (name, value) in state.items():
+            setattr(self, name, value)
+
+        # Older pickles store the bins as a list.  Out-of-band buffers may be read-only.
+        bins = _AsBinArray(bins)
+        if not bins.flags.writeable:
+            bins = bins.copy()
+
+        self.Bins = bins
 
     @classmethod
     def Init(cls, minVal, maxVal, numBins=None, binVals=None):
@@ -83,36 +357,78 @@ class Histogram(object):
         obj.MaxValue = maxVal
 
         if binVals is None:
-            obj.Bins = [0] * obj.NumBins
+            obj._bins = numpy.zeros(obj.NumBins, dtype=numpy.int64)
             obj.NumSamples = 0
         else:
             obj.Bins = binVals
-            obj.NumSamples = sum(binVals)
-            obj.NumBins = len(binVals)
+            obj.NumSamples = _ScalarSum(obj._bins)
+            obj.NumBins = len(obj._bins)
 
         return obj
 
+    @classmethod
+    def FromImageArray(cls, image: NDArray, minVal: float | None = None, maxVal: float | None = None,
+                       numBins: int | None = None) -> Histogram:
+        '''
+        Create a histogram of every pixel in an image array.
+        :param image: Image pixels, any shape
+        :param minVal: Minimum histogram value, defaults to the minimum of an integer dtype or the image minimum for floating point images
+        :param maxVal: Maximum histogram value, defaults to the maximum of an integer dtype or the image maximum for floating point images
+        :param numBins: Number of bins, defaults to one bin per value.  Required for floating point images.
+        '''
+        image = numpy.asarray(image)
+
+        if image.dtype.kind in 'iu':
+            dtypeInfo = numpy.iinfo(image.dtype)
+            if minVal is None:
+                minVal = dtypeInfo.min
+            if maxVal is None:
+                maxVal = dtypeInfo.max
+        else:
+            if numBins is None:
+                raise ValueError(f"numBins must be specified for a histogram of a {image.dtype} image")
+            if minVal is None:
+                minVal = image.min().item()
+            if maxVal is None:
+                maxVal = image.max().item()
+
+        obj = cls.Init(minVal, maxVal, numBins)
+        obj.AddArray(image)
+        return obj
+
     @staticmethod
     def FromArray(hist_array: typing.Sequence[float], minValue: float, binSize: float) -> Histogram:
         obj = Histogram()
 
         obj.NumBins = len(hist_array)
-        obj.Bins = list(hist_array)
+        obj._bins = numpy.array(_AsBinArray(hist_array))
         obj.MinValue = minValue
         obj.MaxValue = (minValue + (binSize * obj.NumBins)) - 1
-        obj.NumSamples = sum(hist_array)
+        obj.NumSamples = _ScalarSum(obj._bins)
         return obj
 
     @staticmethod
     def FromXML(xml: str) -> Histogram | None:
-        obj = Histogram()
-
+        '''
+        :param xml: Histogram XML string, or a parsed xml.dom.minidom document
+        '''
         if isinstance(xml, str):
-            xmlDoc = xml.dom.minidom.parseString(xml)
-        else:
-            xmlDoc = xml
-        # else:
-        # raise InvalidOperation("xml parameter was not a string or XML minidom object")
+            HistogramElem = ElementTree.fromstring(xml)
+            if HistogramElem.tag != 'Histogram':
+                HistogramElem = HistogramElem.find('.//Histogram')
+
+            if HistogramElem is None:
+                prettyoutput.Log("Histogram tag not found in histogram XML")
+                return
+
+            ChannelElem = HistogramElem.find('.//Channel')
+            if ChannelElem is None:
+                prettyoutput.Log("No channel element found in histogram")
+                return
+
+            return Histogram._FromXMLParts(HistogramElem.attrib, ChannelElem.text)
+
+        xmlDoc = xml
 
         Elems = xmlDoc.getElementsByTagName('Histogram')
         if len(Elems) != 1:
@@ -121,37 +437,44 @@ class Histogram(object):
 
         HistogramElem = Elems[0]
 
-        if HistogramElem.hasAttribute('NumBins'):
-            obj.NumBins = int(HistogramElem.getAttribute('NumBins'))
-
-        if HistogramElem.hasAttribute('NumSamples'):
-            obj.NumSamples = int(HistogramElem.getAttribute('NumSamples'))
-
-        if HistogramElem.hasAttribute('MinValue'):
-            obj.MinValue = float(HistogramElem.getAttribute('MinValue'))
-
-        if HistogramElem.hasAttribute('MaxValue'):
-            obj.MaxValue = float(HistogramElem.getAttribute('MaxValue'))
-
         ChannelElems = HistogramElem.getElementsByTagName('Channel')
 
         if len(ChannelElems) == 0:
             prettyoutput.Log("No channel element found in histogram")
             return
 
-        ChannelElem = ChannelElems[0]
+        BinNode = ChannelElems[0].firstChild
+        attrib = {name: value for (name, value) in HistogramElem.attributes.items()}
+        return Histogram._FromXMLParts(attrib, BinNode.data if BinNode is not None else None)
+
+    @staticmethod
+    def _FromXMLParts(attrib: dict[str, str], BinString: str | None) -> Histogram | None:
+        '''Create a histogram from the attributes of the Histogram element and the text of its Channel element'''
+        obj = Histogram()
+
+        if 'NumBins' in attrib:
+            obj.NumBins = int(attrib['NumBins'])
+
+        if 'NumSamples' in attrib:
+            try:
+                obj.NumSamples = int(attrib['NumSamples'])
+            except ValueError:
+                obj.NumSamples = float(attrib['NumSamples'])
 
-        BinNode = ChannelElem.firstChild
-        BinString = BinNode.data
+        if 'MinValue' in attrib:
+            obj.MinValue = float(attrib['MinValue'])
 
-        BinStrings = BinString.split()
+        if 'MaxValue' in attrib:
+            obj.MaxValue = float(attrib['MaxValue'])
 
-        obj.Bins = list()
+        if BinString is None:
+            BinString = ''
 
-        for i in range(0, len(BinStrings)):
-            obj.Bins.append(int(BinStrings[i]))
+        # Fractional bins, from weighted histograms, are written with a decimal point or exponent
+        isFloat = any(c in BinString for c in '.eEn')
+        obj.Bins = numpy.fromstring(BinString, dtype=numpy.float64 if isFloat else numpy.int64, sep=' ')
 
-        if len(obj.Bins) != obj.NumBins:
+        if len(obj._bins) != obj.NumBins:
             prettyoutput.Log("ERROR: obj.Bins != obj.NumBins")
             prettyoutput.Log(str(obj))
             return
@@ -159,19 +482,70 @@ class Histogram(object):
         return obj
 
     @staticmethod
-    def Load(filename: str) -> Histogram | None: 
+    def _LoadXML(filename: str) -> Histogram | None:
+        '''Stream the histogram XML file, stopping once the first Channel element has been read'''
+        attrib = None
+        for (event, elem) in ElementTree.iterparse(filename, events=('start', 'end')):
+            if event == 'start' and elem.tag == 'Histogram':
+                attrib = dict(elem.attrib)
+            elif event == 'end' and elem.tag == 'Channel' and attrib is not None:
+                return Histogram._FromXMLParts(attrib, elem.text)
+
+        if attrib is None:
+            prettyoutput.Log("Histogram tag not found in histogram XML")
+        else:
+            prettyoutput.Log("No channel element found in histogram")
+
+        return None
+
+    @staticmethod
+    def Load(filename: str) -> Histogram | None:
+        '''Load a histogram written by Save.  Files with the BinaryExtension are read as .npz, all others as XML.
+           Returns None if the file does not exist or does not describe a valid histogram.'''
         try:
-            xml_str = xml.dom.minidom.parse(filename)
-            return Histogram.FromXML(xml_str)
+            if IsBinaryHistogramFile(filename):
+                return Histogram.LoadBinary(filename)
+
+            return Histogram._LoadXML(filename)
         except FileNotFoundError:
-            prettyoutput.Log(f"Mosaic file not found: {filename}")
+            prettyoutput.Log(f"Histogram file not found: {filename}")
             return None
-        
+
+    @staticmethod
+    def LoadBinary(filename: str) -> Histogram | None:
+        '''Load a histogram written by SaveBinary.  As for XML files, returns None if the file does not describe a valid histogram.'''
+        with numpy.load(filename, allow_pickle=False) as data:
+            missing = [name for name in ('MinValue', 'MaxValue', 'NumBins', 'NumSamples', 'Bins') if name not in data]
+            if len(missing) > 0:
+                prettyoutput.Log(f"Histogram {filename} is missing {', '.join(missing)}")
+                return None
+
+            obj = Histogram()
+            obj.MinValue = data['MinValue'].item()
+            obj.MaxValue = data['MaxValue'].item()
+            obj.NumBins = data['NumBins'].item()
+            obj.NumSamples = data['NumSamples'].item()
+            obj.Bins = data['Bins']
+
+        if len(obj._bins) != obj.NumBins:
+            prettyoutput.Log("ERROR: obj.Bins != obj.NumBins")
+            prettyoutput.Log(str(obj))
+            return None
+
+        return obj
 
     @property
     def BinWidth(self) -> float:
-        # Add one to MaxValue because 0 is a valid value
-        return float((self.MaxValue + 1) - self.MinValue) / float(self.NumBins)
+        if self._binwidth is None:
+            # Add one to MaxValue because 0 is a valid value
+            self._binwidth = float((self.MaxValue + 1) - self.MinValue) / float(self.NumBins)
+
+        return self._binwidth
+
+    @property
+    def TotalCount(self) -> int | float:
+        '''The sum of all bins.  Unlike NumSamples this is always calculated from the bins.'''
+        return self._CachedStat('TotalCount', lambda: _ScalarSum(self._bins))
 
     def _MinMaxBinIndicies(self, minVal: float | None = None, maxVal: float | None = None) -> tuple[int, int, float]:
         '''Returns (iMin, iMax, MinBinValue) for a pair of minVal, maxVals'''
@@ -193,7 +567,11 @@ class Histogram(object):
 
         (iMin, iMax, AdjustedMin) = self._MinMaxBinIndicies(minVal, maxVal)
 
-        MedianValue = _FindValueAtPercentile(self.Bins[iMin:iMax], 0.5, self.BinWidth, AdjustedMin)
+        Cumulative = self.CumulativeBins
+        Offset = Cumulative[iMin - 1].item() if iMin > 0 else 0
+
+        MedianValue = _FindValueAtPercentile(self._bins[iMin:iMax], 0.5, self.BinWidth, AdjustedMin,
+                                             Cumulative=Cumulative[iMin:iMax], CumulativeOffset=Offset)
         return MedianValue
 
     def BinValue(self, iBin: int, fraction: float = 0.0) -> float:
@@ -210,58 +588,89 @@ class Histogram(object):
         '''
         :returns: The index of the lowest valued bin that contains a non-zero value, or None if all bins are empty
         '''
-        # Remove empty buckets from the high-end of the histogram
-        for i, count in enumerate(self.Bins):
-            if count > 0:
-                return i
+        return self._CachedStat('MinNonEmptyBin', self._CalculateMinNonEmptyBin)
 
-        return None
+    def _CalculateMinNonEmptyBin(self) -> int | None:
+        nonzero = numpy.flatnonzero(self._bins)
+        if len(nonzero) == 0:
+            return None
+
+        return int(nonzero[0])
 
     def MaxNonEmptyBin(self) -> int | None:
         '''
         :returns: The index of the highest valued bin that contains a non-zero value, or None if all bins are empty
         '''
-        # Remove empty buckets from the high-end of the histogram
-        for i in range(len(self.Bins) - 2, -1, -1):
-            if self.Bins[i] > 0:
-                return i
+        return self._CachedStat('MaxNonEmptyBin', self._CalculateMaxNonEmptyBin)
 
-        return None
+    def _CalculateMaxNonEmptyBin(self) -> int | None:
+        # The search begins at the second to last bin
+        nonzero = numpy.flatnonzero(self._bins[:-1])
+        if len(nonzero) == 0:
+            return None
+
+        return int(nonzero[-1])
+
+    def BinCenters(self, iMin: int = 0, iMax: int | None = None) -> NDArray[float]:
+        ''':return: The center value of bins in the range [iMin, iMax)'''
+        if iMax is None:
+            iMax = self.NumBins
+
+        BinWidth = self.BinWidth
+        return (numpy.arange(iMin, iMax) * BinWidth) + (0.5 * BinWidth) + self.MinValue
 
     def Mean(self, minVal=None, maxVal=None) -> float:
+        return self._CachedStat(('Mean', minVal, maxVal), lambda: self._CalculateMean(minVal, maxVal))
 
-        iBin = 0
-        maxBin = 0
-        _sum = Decimal()
-        totalcount = Decimal()
+    def _CalculateMean(self, minVal=None, maxVal=None) -> float:
 
         (iMin, iMax, AdjustedMin) = self._MinMaxBinIndicies(minVal, maxVal)
 
-        for ibin in range(iMin, iMax):
-            bincount = self.Bins[ibin]
-            _sum += Decimal(bincount * self.BinValue(ibin, fraction=0.5))
-            totalcount += bincount
+        counts = self._bins[iMin:iMax]
+        totalcount = _ScalarSum(counts)
 
-        return float(_sum) / float(totalcount)
+        # Each bin center is MinValue + (iBin + 0.5) * BinWidth, so the weighted sum of centers
+        # reduces to the sum of count * iBin, which is exact for integer counts
+        indexsum = _IndexWeightedSum(counts, iMin)
+        return self.MinValue + (self.BinWidth * ((indexsum / totalcount) + 0.5))
 
-    def PeakValue(self, minVal: float | None = None, maxVal: float | None = None) -> float | None:
+    def Variance(self, minVal=None, maxVal=None) -> float:
+        '''The variance of the bin centers weighted by the bin counts'''
+        return self._CachedStat(('Variance', minVal, maxVal), lambda: self._CalculateVariance(minVal, maxVal))
+
+    def _CalculateVariance(self, minVal=None, maxVal=None) -> float:
 
-        maxBin = 0
         (iMin, iMax, AdjustedMin) = self._MinMaxBinIndicies(minVal, maxVal)
 
-        PeakList = []
+        counts = self._bins[iMin:iMax]
+        totalcount = _ScalarSum(counts)
+
+        # Variance of the bin index, scaled by the bin width
+        indexsum = _IndexWeightedSum(counts, iMin)
+        if counts.dtype.kind == 'f':
+            deviations = numpy.arange(iMin, iMax) - (indexsum / totalcount)
+            indexvariance = numpy.dot(counts, deviations * deviations).item() / totalcount
+        else:
+            # Integer sums are exact, so N * sum(c*i^2) - sum(c*i)^2 does not suffer from cancellation
+            indexsquaredsum = _IndexWeightedSum(counts, iMin, power=2)
+            indexvariance = ((totalcount * indexsquaredsum) - (indexsum * indexsum)) / (totalcount * totalcount)
+
+        return indexvariance * self.BinWidth * self.BinWidth
 
-        for ibin in range(iMin, iMax):
-            bincount = self.Bins[ibin]
-            if maxBin < bincount:
-                maxBin = bincount
-                PeakList = [self.BinValue(ibin, fraction=0.5)]
-            elif maxBin == bincount:
-                PeakList.append(self.BinValue(ibin, fraction=0.5))
+    def PeakValue(self, minVal: float | None = None, maxVal: float | None = None) -> float | None:
+        return self._CachedStat(('PeakValue', minVal, maxVal), lambda: self._CalculatePeakValue(minVal, maxVal))
 
-        if len(PeakList) == 0:
+    def _CalculatePeakValue(self, minVal: float | None = None, maxVal: float | None = None) -> float | None:
+
+        (iMin, iMax, AdjustedMin) = self._MinMaxBinIndicies(minVal, maxVal)
+
+        counts = self._bins[iMin:iMax]
+        if len(counts) == 0:
             return None
 
+        iPeaks = numpy.flatnonzero(counts == counts.max())
+        PeakList = self.BinCenters(iMin, iMax)[iPeaks]
+
         return math.fsum(PeakList) / float(len(PeakList))
 
     def GammaAtValue(self, val, minVal=None, maxVal=None) -> float:
@@ -294,16 +703,14 @@ class Histogram(object):
         if MinCutoff is not None:
             assert (isinstance(MinCutoff, float))
             # MinCutoffCount = float(MinCutoff) * float(self.NumSamples)
-            MinCutoffValue = _FindValueAtPercentile(Bins=self.Bins, Percentile=MinCutoff, BinWidth=self.BinWidth,
-                                                    BinMinValue=self.MinValue)
+            MinCutoffValue = _FindValueAtPercentile(Bins=self._bins, Percentile=MinCutoff, BinWidth=self.BinWidth,
+                                                    BinMinValue=self.MinValue, Cumulative=self.CumulativeBins)
 
         if MaxCutoff is not None:
             assert (isinstance(MaxCutoff, float))
             # MaxCutoffCount = float(MaxCutoff) * float(self.NumSamples)
-            ReversedBins = list(copy.copy(self.Bins))
-            ReversedBins.reverse()
-            CutoffValue = _FindValueAtPercentile(Bins=ReversedBins, Percentile=MaxCutoff, BinWidth=self.BinWidth,
-                                                 BinMinValue=0)
+            CutoffValue = _FindValueAtPercentile(Bins=self._bins[::-1], Percentile=MaxCutoff, BinWidth=self.BinWidth,
+                                                 BinMinValue=0, Cumulative=self._ReverseCumulativeBins)
             MaxCutoffValue = self.MaxValue - CutoffValue
 
         #
@@ -338,38 +745,127 @@ class Histogram(object):
     def IncrementBin(self, intensity: float, count: int):
         '''Adds count to the bin that the intensity maps to'''
         iTargetBin = self.MapIntensityToBin(intensity)
-        self.Bins[iTargetBin] = self.Bins[iTargetBin] + count
+        self._AddToBins(iTargetBin, count)
         self.NumSamples = self.NumSamples + count
 
+    def _AddToBins(self, index, counts):
+        '''Add counts to the bins, promoting the bins to float64 if the counts are fractional'''
+        if not self._bins.flags.writeable:
+            raise ValueError("Histogram bins are a read-only view of another histogram, use copy() before adding to it")
+
+        counts = numpy.asarray(counts)
+        if counts.dtype.kind == 'f' and self._bins.dtype.kind != 'f':
+            self._bins = self._bins.astype(numpy.float64)
+
+        self._bins[index] += counts
+        self._InvalidateCache()
+
     def AddHistogram(self, h: Histogram):
         bins = None
         if isinstance(h, Histogram):
             assert (h.MinValue == self.MinValue)
             assert (h.BinWidth == self.BinWidth)
-            assert (len(h.Bins) == len(self.Bins))
-            bins = h.Bins
+            assert (len(h._bins) == len(self._bins))
+            bins = h._bins
         else:  # Otherwise assume an iterator
-            assert (len(self.Bins) == len(h))
-            bins = h
+            assert (len(self._bins) == len(h))
+            bins = _AsBinArray(h)
+
+        self._AddToBins(slice(None), bins)
+        self.NumSamples = self.NumSamples + _ScalarSum(bins)
+
+    def _MapValuesToBins(self, values) -> NDArray[numpy.intp]:
+        '''Vectorized MapIntensityToBin, values outside the histogram range are clamped to the first or last bin'''
+        iBins = numpy.floor((numpy.asarray(values, dtype=numpy.float64) - self.MinValue) / self.BinWidth)
+        if numpy.isnan(iBins).any():
+            raise ValueError("Cannot add NaN values to a histogram")
+
+        numpy.clip(iBins, 0, self.NumBins - 1, out=iBins)
+        return iBins.astype(numpy.intp)
+
+    def _CountArray(self, values: NDArray) -> NDArray[numpy.int64]:
+        ''':return: The number of values in a flat array that fall into each bin'''
+        binCounts = numpy.zeros(self.NumBins, dtype=numpy.int64)
+        if len(values) == 0:
+            return binCounts
+
+        if values.dtype.kind in 'iu':
+            vmin = values.min().item()
+            vmax = values.max().item()
+            if vmax - vmin < _DirectBincountRange:
+                # Count each distinct value, then map the distinct values to their bins
+                if values.dtype.kind == 'i':
+                    values = values.astype(numpy.int64, copy=False)
+                valueCounts = numpy.bincount(values - vmin if vmin != 0 else values)
+                valueBins = self._MapValuesToBins(numpy.arange(vmin, vmin + len(valueCounts)))
+                numpy.add.at(binCounts, valueBins, valueCounts)
+                return binCounts
+
+        for iStart in range(0, len(values), _AddArrayChunkSize):
+            chunk = values[iStart:iStart + _AddArrayChunkSize]
+            binCounts += numpy.bincount(self._MapValuesToBins(chunk), minlength=self.NumBins)
+
+        return binCounts
+
+    def _CountMaskedArray(self, values: NDArray, mask: NDArray | None, weights: NDArray | None) -> NDArray:
+        '''
+        :return: The number of included values in a flat array that fall into each bin, or the sum of
+                 their weights.  The mask is applied one chunk at a time so the array is never copied whole.
+        '''
+        binCounts = numpy.zeros(self.NumBins, dtype=numpy.int64 if weights is None else numpy.float64)
 
-        for i, count in enumerate(bins):
-            self.Bins[i] = self.Bins[i] + count
-            self.NumSamples = self.NumSamples + count
+        for iStart in range(0, len(values), _AddArrayChunkSize):
+            iEnd = iStart + _AddArrayChunkSize
+            chunk = values[iStart:iEnd]
+            chunkWeights = None if weights is None else weights[iStart:iEnd]
+            if mask is not None:
+                chunkMask = mask[iStart:iEnd].astype(bool, copy=False)
+                chunk = chunk[chunkMask]
+                if chunkWeights is not None:
+                    chunkWeights = chunkWeights[chunkMask]
 
-    def __mapaddfunc(self, value):
-        self.Bins[self.MapIntensityToBin(value)] += 1
+            binCounts += numpy.bincount(self._MapValuesToBins(chunk), weights=chunkWeights, minlength=self.NumBins)
 
-    def Add(self, values: list[float]):
-        '''Add a list of individual values to the histogram'''
+        return binCounts
+
+    def AddArray(self, values: NDArray, mask: NDArray | None = None, weights: NDArray | None = None):
+        '''
+        Add every value in an array of any shape, such as an image, to the histogram.
+        Values outside the histogram range are clamped to the first or last bin, as
+        MapIntensityToBin does.
+        :param mask: Optional boolean array the shape of values, only values where the mask is True are added
+        :param weights: Optional array the shape of values, each value adds its weight to its bin instead of one.
+                        The bins are converted to float64.
+        '''
+        values = numpy.asarray(values)
+        if mask is None and weights is None:
+            values = values.reshape(-1)
+            self._AddToBins(slice(None), self._CountArray(values))
+            self.NumSamples += len(values)
+            return
+
+        if mask is not None:
+            mask = numpy.asarray(mask)
+            if mask.shape != values.shape:
+                raise ValueError(f"Mask shape {mask.shape} does not match values shape {values.shape}")
 
-        for v in values:
-            self.__mapaddfunc(v)
+            mask = mask.reshape(-1)
 
-        #         for val in values:
-        #             iTargetBin = self.MapIntensityToBin(val)
-        #             self.Bins[iTargetBin] = self.Bins[iTargetBin] + 1
+        if weights is not None:
+            weights = numpy.asarray(weights)
+            if weights.shape != values.shape:
+                raise ValueError(f"Weights shape {weights.shape} does not match values shape {values.shape}")
 
-        self.NumSamples += len(values)
+            weights = weights.reshape(-1)
+
+        counts = self._CountMaskedArray(values.reshape(-1), mask, weights)
+        self._AddToBins(slice(None), counts)
+        self.NumSamples += _ScalarSum(counts)
+
+    def Add(self, values: list[float]):
+        '''Add a list of individual values to the histogram'''
+
+        self.AddArray(values)
 
         # prettyoutput.Log(str(self))
 
@@ -384,12 +880,11 @@ class Histogram(object):
         return iBin
 
     def BinsToString(self) -> str:
+        '''Each bin count preceded by a tab.  Fractional bins are written as floats that read back exactly.'''
+        if len(self._bins) == 0:
+            return ''
 
-        binsString = ''
-        for binVal in self.Bins:
-            binsString = binsString + '\t' + str(int(binVal))
-
-        return binsString
+        return '\t' + '\t'.join(map(repr, self._bins.tolist()))
 
     @classmethod
     def Trim(cls, hObj):
@@ -405,6 +900,94 @@ class Histogram(object):
 
         return hObj
 
+    def copy(self) -> Histogram:
+        '''A histogram with its own writable copy of the bins, use to detach a histogram returned by Trim or the outlier removal functions'''
+        obj = Histogram()
+        obj._bins = self._bins.copy()
+        obj.MinValue = self.MinValue
+        obj.MaxValue = self.MaxValue
+        obj.NumBins = self.NumBins
+        obj.NumSamples = self.NumSamples
+        return obj
+
+    def Rebin(self, factor: int | None = None, numBins: int | None = None) -> Histogram:
+        '''
+        Combine each group of factor adjacent bins into a single bin.  Counts are conserved exactly.
+        :param factor: Number of adjacent bins summed into each new bin
+        :param numBins: If factor is not specified the smallest factor that produces no more than numBins bins is used
+        If NumBins is not a multiple of factor the last bin is padded with empty bins, extending MaxValue
+        '''
+        if factor is None:
+            if numBins is None:
+                raise ValueError("Rebin requires either factor or numBins")
+
+            if numBins < 1:
+                raise ValueError(f"Rebin requires at least one bin, got numBins={numBins}")
+
+            factor = int(math.ceil(self.NumBins / numBins))
+
+        factor = int(factor)
+        if factor < 1:
+            raise ValueError(f"Rebin factor must be at least one, got {factor}")
+
+        if factor == 1:
+            return self.copy()
+
+        bins = self._bins
+        padding = -len(bins) % factor
+        if padding:
+            bins = numpy.concatenate((bins, numpy.zeros(padding, dtype=bins.dtype)))
+
+        obj = Histogram.FromArray(bins.reshape(-1, factor).sum(axis=1), self.MinValue, self.BinWidth * factor)
+        obj.NumSamples = self.NumSamples
+        return obj
+
+    def PyramidLevel(self, level: int) -> Histogram:
+        '''
+        :return: This histogram with each group of 2**level adjacent bins combined.  Level 0 is this histogram.
+                 Levels are built from the level below, cached until the bins change, and are read-only.
+        '''
+        if level <= 0:
+            return self
+
+        return self._CachedStat(('PyramidLevel', level), lambda: self._CalculatePyramidLevel(level))
+
+    def _CalculatePyramidLevel(self, level: int) -> Histogram:
+        obj = self.PyramidLevel(level - 1).Rebin(2)
+        obj._bins.flags.writeable = False
+        return obj
+
+    def ForResolution(self, maxBins: float) -> Histogram:
+        '''
+        :return: The finest pyramid level with no more than maxBins bins, for example the number of
+                 horizontal pixels a plot of the histogram will be drawn into
+        '''
+        level = 0
+        while (self.NumBins > (maxBins * (1 << level))) and ((1 << level) < self.NumBins):
+            level += 1
+
+        return self.PyramidLevel(level)
+
+    def _BinRangeView(self, iStart: int, iEnd: int) -> Histogram:
+        '''
+        :return: A histogram of bins [iStart, iEnd) sharing this histogram's bin storage.  The
+                 bins of the returned histogram are read-only, use copy() to modify them.
+        '''
+        if iStart == 0 and iEnd == len(self._bins):
+            return self
+
+        BinWidth = self.BinWidth
+        bins = self._bins[iStart:iEnd]
+        bins.flags.writeable = False
+
+        obj = Histogram()
+        obj._bins = bins
+        obj.NumBins = len(bins)
+        obj.MinValue = self.BinValue(iStart)
+        obj.MaxValue = (obj.MinValue + (BinWidth * obj.NumBins)) - 1
+        obj.NumSamples = _ScalarSum(bins)
+        return obj
+
     @staticmethod
     def TryRemoveMaxValueOutlier(hObj, TrimOnly=False):
         '''
@@ -412,36 +995,32 @@ class Histogram(object):
         the last bucket is removed, all zeros from the last data value are removed, and a new histogram is returned.
         
         If the last bucket is zero then it is also removed  
+
+        The returned histogram shares hObj's bins and is read-only, see copy()
         '''
 
         outlier_cutoff = math.ceil(hObj.NumSamples / 10000.0)
         if outlier_cutoff < 2:
             outlier_cutoff = 2
-        HasOutlier = ((hObj.Bins[-1] > 0 and hObj.Bins[-1] < outlier_cutoff) and hObj.Bins[-2] == 0) and not TrimOnly
-        Trimmable = hObj.Bins[-1] == 0
-
-        if not HasOutlier and not Trimmable:
-            return hObj
-
-        while HasOutlier or Trimmable:
 
-            # Remove empty buckets from the high-end of the histogram
-            for i in range(len(hObj.Bins) - 2, -1, -1):
-                if hObj.Bins[i] > 0:
-                    break
+        nonempty = numpy.flatnonzero(hObj._bins)
 
-            # This means no values were above zero, lets just leave the histogram alone.  Probably never happens
-            if i is None:
-                return hObj
+        # This means no values were above zero, lets just leave the histogram alone.  Probably never happens
+        if len(nonempty) == 0:
+            return hObj
 
-            newBins = hObj.Bins[0:i + 1]
+        iLast = nonempty[-1]
+        if not TrimOnly:
+            # A non-empty bucket is an outlier if it is below the cutoff and the bucket below it is empty.
+            # Outliers are removed from the top down, stopping at the first bucket that is not an outlier.
+            outlier = hObj._bins[nonempty] < outlier_cutoff
+            outlier[1:] &= numpy.diff(nonempty) > 1
+            outlier[0] &= nonempty[0] > 0
 
-            hObj = Histogram.FromArray(newBins, hObj.MinValue, hObj.BinWidth)
-            HasOutlier = ((hObj.Bins[-1] > 0 and hObj.Bins[-1] < outlier_cutoff) and hObj.Bins[
-                -2] == 0) and not TrimOnly
-            Trimmable = hObj.Bins[-1] == 0
+            retained = numpy.flatnonzero(~outlier)
+            iLast = nonempty[retained[-1]] if len(retained) > 0 else nonempty[0]
 
-        return hObj
+        return hObj._BinRangeView(0, int(iLast) + 1)
 
     @staticmethod
     def TryRemoveMinValueOutlier(hObj, TrimOnly=False):
@@ -450,93 +1029,688 @@ class Histogram(object):
         the first bucket is removed, all zero buckets beyond the first bucket are removed, and a new histogram is returned.
           
         If the first bucket is zero then it is also removed
+
+        The returned histogram shares hObj's bins and is read-only, see copy()
         '''
 
         outlier_cutoff = math.ceil(hObj.NumSamples / 100000.0)
         if outlier_cutoff < 2:
             outlier_cutoff = 2
-        HasOutlier = ((hObj.Bins[0] > 0 and hObj.Bins[0] < outlier_cutoff) and hObj.Bins[1] == 0) and not TrimOnly
-        Trimmable = hObj.Bins[0] == 0
-
-        if not HasOutlier and not Trimmable:
-            return hObj
-
-        while HasOutlier or Trimmable:
 
-            # Remove empty buckets from the low-end of the histogram
-            for i, count in enumerate(hObj.Bins):
-                if i == 0:
-                    continue  # Skip the first bucket since we know we need to trim
-                if count > 0:
-                    break
+        nonempty = numpy.flatnonzero(hObj._bins)
 
-            # This means no values were above zero, lets just leave the histogram alone.  Probably never happens
-            if i is None:
-                return hObj
+        # This means no values were above zero, lets just leave the histogram alone.  Probably never happens
+        if len(nonempty) == 0:
+            return hObj
 
-            newBins = hObj.Bins[i:]
+        iFirst = nonempty[0]
+        if not TrimOnly:
+            # A non-empty bucket is an outlier if it is below the cutoff and the bucket above it is empty.
+            # Outliers are removed from the bottom up, stopping at the first bucket that is not an outlier.
+            outlier = hObj._bins[nonempty] < outlier_cutoff
+            outlier[:-1] &= numpy.diff(nonempty) > 1
+            outlier[-1] &= nonempty[-1] < len(hObj._bins) - 1
 
-            hObj = Histogram.FromArray(newBins, hObj.BinValue(i), hObj.BinWidth)
-            HasOutlier = ((hObj.Bins[0] > 0 and hObj.Bins[0] < outlier_cutoff) and hObj.Bins[1] == 0) and not TrimOnly
-            Trimmable = hObj.Bins[0] == 0
+            retained = numpy.flatnonzero(~outlier)
+            iFirst = nonempty[retained[0]] if len(retained) > 0 else nonempty[-1]
 
-        return hObj
+        return hObj._BinRangeView(int(iFirst), len(hObj._bins))
 
-    def XAxis_Extrema_Using_Threshold(self, max_height: float) -> tuple[float, float]:
+    def XAxis_Extrema_Using_Threshold(self, max_height: float, max_width: float | None = None) -> tuple[float, float]:
         """
         This function helps with plotting.  It returns the min/max VISIBLE values for a given vertical resolution.
         So if we have 500 pixels in an image any bin with a count < 1/500 the bin with the highest count is considered
         empty.
+        :param max_width: Optional horizontal resolution.  If specified the extrema are found using the pyramid level
+                          with no more than max_width bins, matching the bins that can be drawn.
         :return:
         """
 
-        max_val = max(self.Bins)
-        cutoff = max_val / max_height
+        hist = self if max_width is None else self.ForResolution(max_width)
 
-        min_index = 0
-        for min_index in range(0, self.NumBins):
-            if self.Bins[min_index] >= cutoff:
-                break
+        max_val = hist._bins.max()
+        cutoff = max_val / max_height
 
-        for max_index in range(self.NumBins-1, -1, -1):
-            if self.Bins[max_index] >= cutoff:
-                break
+        visible = numpy.flatnonzero(hist._bins >= cutoff)
+        if len(visible) == 0:
+            min_index, max_index = hist.NumBins - 1, 0
+        else:
+            min_index, max_index = int(visible[0]), int(visible[-1])
 
-        min_x = self.BinValue(min_index)
-        max_x = self.BinValue(max_index, 1.0)
+        min_x = hist.BinValue(min_index)
+        max_x = hist.BinValue(max_index, 1.0)
 
         return min_x, max_x
 
     def ToXML(self) -> str:
-        impl = xml.dom.minidom.getDOMImplementation()
+        '''The histogram as XML, formatted identically to xml.dom.minidom's toprettyxml output'''
+        attributes = ' '.join([f'NumBins={quoteattr(str(int(self.NumBins)))}',
+                               f'NumSamples={quoteattr(_NumberString(self.NumSamples))}',
+                               f'MinValue={quoteattr(str(self.MinValue))}',
+                               f'MaxValue={quoteattr(str(self.MaxValue))}'])
 
-        xmlDoc = impl.createDocument(None, 'Histogram', None)
+        return ''.join(['<?xml version="1.0" ?>\n',
+                        f'<Histogram {attributes}>\n',
+                        '\t<Channel>', self.BinsToString(), '</Channel>\n',
+                        '</Histogram>\n'])
 
-        Elems = xmlDoc.getElementsByTagName('Histogram')
-        if len(Elems) != 1:
+    def Save(self, filename):
+        '''Save the histogram.  Files with the BinaryExtension are written as .npz, all others as XML'''
+        if IsBinaryHistogramFile(filename):
+            self.SaveBinary(filename)
             return
 
-        HistogramElem = Elems[0]
+        xmlStr = self.ToXML()
 
-        HistogramElem.setAttribute('NumBins', str(int(self.NumBins)))
-        HistogramElem.setAttribute('NumSamples', str(int(self.NumSamples)))
-        HistogramElem.setAttribute('MinValue', str(self.MinValue))
-        HistogramElem.setAttribute('MaxValue', str(self.MaxValue))
+        with open(filename, 'w') as xmlFile:
+            xmlFile.write(xmlStr)
+            xmlFile.close()
 
-        ChannelElem = xmlDoc.createElement('Channel')
-        binsString = self.BinsToString()
-        #       prettyoutput.Log( binsString)
-        channelText = xmlDoc.createTextNode(binsString)
+    def SaveBinary(self, filename):
+        '''Save the histogram as an uncompressed .npz file with little-endian bin counts'''
+        littleEndianBins = self._bins.astype(self._bins.dtype.newbyteorder('<'), copy=False)
+        with open(filename, 'wb') as npzFile:
+            numpy.savez(npzFile, Bins=littleEndianBins, MinValue=self.MinValue, MaxValue=self.MaxValue,
+                        NumBins=self.NumBins, NumSamples=self.NumSamples)
 
-        ChannelElem.appendChild(channelText)
-        ChannelElem = HistogramElem.appendChild(ChannelElem)
 
-        xmlStr = xmlDoc.toprettyxml()
-        return xmlStr
+class QuantileSketch(object):
+    '''
+    Mergeable streaming quantile sketch (KLL) for float data whose range is not known in advance.
+    Values are kept in levels, each value on level n stands for 2**n samples.  When a level fills
+    half of its values, chosen alternately from a random offset in sorted order, move up a level.
+    Memory is bounded by about 3 * k values regardless of the number of samples, and percentiles
+    are accurate to a rank error of roughly 1/k.  Sketches from different workers are combined with AddSketch.
+    '''
 
-    def Save(self, filename):
-        xmlStr = self.ToXML()
+    def __init__(self, k: int = 1024, seed: int | None = None):
+        '''
+        :param k: Capacity of the top level, larger values are more accurate and use more memory
+        :param seed: Seed for the random compaction offsets, for reproducible sketches
+        '''
+        if k < 2:
+            raise ValueError(f"QuantileSketch k must be at least 2, got {k}")
 
-        with open(filename, 'w') as xmlFile:
-            xmlFile.write(xmlStr)
-            xmlFile.close()
+        self.k = int(k)
+        self.NumSamples = 0
+        self.MinValue = float('NaN')
+        self.MaxValue = float('NaN')
+        self._levels = [numpy.zeros(0, dtype=numpy.float64)]
+        self._rng = numpy.random.default_rng(seed)
+        self._InvalidateCache()
+
+    def _InvalidateCache(self):
+        '''Discard the sorted values.  Must be called whenever the levels change.'''
+        self._sorted = None
+        self._cumulative = None
+
+    def __str__(self):
+        s = 'QuantileSketch\n'
+        s += 'k: ' + str(self.k) + '\n'
+        s += 'NumSamples: ' + str(self.NumSamples) + '\n'
+        s += 'MinValue: ' + str(self.MinValue) + '\n'
+        s += 'MaxValue: ' + str(self.MaxValue) + '\n'
+        return s
+
+    @property
+    def NumRetained(self) -> int:
+        '''Number of values stored by the sketch'''
+        return sum(len(values) for values in self._levels)
+
+    def _Capacity(self, level: int) -> int:
+        depth = len(self._levels) - 1 - level
+        return max(2, int(math.ceil(self.k * (_SketchCapacityDecay ** depth))))
+
+    def _Compress(self):
+        '''While the sketch holds more values than the total capacity of its levels, compact the lowest full level'''
+        while self.NumRetained > sum(self._Capacity(level) for level in range(len(self._levels))):
+            level = 0
+            while len(self._levels[level]) < self._Capacity(level):
+                level += 1
+
+            if level + 1 == len(self._levels):
+                self._levels.append(numpy.zeros(0, dtype=numpy.float64))
+
+            self._CompactLevel(level)
+
+        self._InvalidateCache()
+
+    def _CompactLevel(self, level: int):
+        '''Promote every other sorted value of a level to the next level, which conserves the total weight exactly'''
+        values = numpy.sort(self._levels[level])
+
+        # An odd value out stays on this level
+        numPaired = len(values) - (len(values) % 2)
+        offset = int(self._rng.integers(2))
+
+        self._levels[level] = values[numPaired:].copy()
+        self._levels[level + 1] = numpy.concatenate((self._levels[level + 1], values[offset:numPaired:2]))
+
+    def AddArray(self, values: NDArray):
+        '''Add every value in an array of any shape, such as an image, to the sketch'''
+        values = numpy.asarray(values).reshape(-1)
+
+        for iStart in range(0, len(values), _AddArrayChunkSize):
+            chunk = values[iStart:iStart + _AddArrayChunkSize].astype(numpy.float64)
+            chunkMin = chunk.min().item()
+            chunkMax = chunk.max().item()
+            if math.isnan(chunkMin) or math.isnan(chunkMax):
+                raise ValueError("Cannot add NaN values to a quantile sketch")
+
+            self.MinValue = chunkMin if self.NumSamples == 0 else min(self.MinValue, chunkMin)
+            self.MaxValue = chunkMax if self.NumSamples == 0 else max(self.MaxValue, chunkMax)
+            self.NumSamples += len(chunk)
+
+            self._levels[0] = numpy.concatenate((self._levels[0], chunk))
+            self._Compress()
+
+    def Add(self, values: list[float]):
+        '''Add a list of individual values to the sketch'''
+        self.AddArray(values)
+
+    def AddSketch(self, sketch: QuantileSketch):
+        '''Merge the samples of another sketch into this one'''
+        if sketch.NumSamples == 0:
+            return
+
+        for (level, values) in enumerate(sketch._levels):
+            if level == len(self._levels):
+                self._levels.append(numpy.zeros(0, dtype=numpy.float64))
+
+            self._levels[level] = numpy.concatenate((self._levels[level], values))
+
+        self.MinValue = sketch.MinValue if self.NumSamples == 0 else min(self.MinValue, sketch.MinValue)
+        self.MaxValue = sketch.MaxValue if self.NumSamples == 0 else max(self.MaxValue, sketch.MaxValue)
+        self.NumSamples += sketch.NumSamples
+        self._Compress()
+
+    def _SortedValues(self) -> tuple[NDArray, NDArray]:
+        ''':return: The retained values in sorted order and the cumulative weight of each'''
+        if self._sorted is None:
+            values = numpy.concatenate(self._levels)
+            weights = numpy.concatenate([numpy.full(len(levelValues), 1 << level, dtype=numpy.int64)
+                                         for (level, levelValues) in enumerate(self._levels)])
+            order = numpy.argsort(values, kind='stable')
+            self._sorted = values[order]
+            self._cumulative = numpy.cumsum(weights[order])
+
+        return self._sorted, self._cumulative
+
+    def ValueAtPercentile(self, Percentile: float, minVal: float | None = None, maxVal: float | None = None) -> float:
+        '''
+        :return: The first value where the count of samples exceeds Percentile of all samples, NaN if the sketch is empty
+        :param minVal: Optional, only samples >= minVal are considered
+        :param maxVal: Optional, only samples <= maxVal are considered
+        '''
+        if self.NumSamples == 0:
+            return float('NaN')
+
+        if minVal is None and maxVal is None:
+            if Percentile <= 0:
+                return self.MinValue
+            if Percentile >= 1:
+                return self.MaxValue
+
+        (values, cumulative) = self._SortedValues()
+
+        iMin = 0 if minVal is None else int(numpy.searchsorted(values, minVal, side='left'))
+        iMax = len(values) if maxVal is None else int(numpy.searchsorted(values, maxVal, side='right'))
+        if iMin >= iMax:
+            return float('NaN')
+
+        offset = cumulative[iMin - 1].item() if iMin > 0 else 0
+        total = cumulative[iMax - 1].item() - offset
+        cutoff = offset + math.floor(total * Percentile) + 1
+
+        iCutoff = iMin + int(numpy.searchsorted(cumulative[iMin:iMax], cutoff, side='left'))
+        return values[min(iCutoff, iMax - 1)].item()
+
+    def Median(self, minVal: float | None = None, maxVal: float | None = None) -> float:
+        return self.ValueAtPercentile(0.5, minVal, maxVal)
+
+    def AutoLevel(self, MinCutoff: float | None = None, MaxCutoff: float | None = None) -> tuple[float, float]:
+        '''As Histogram.AutoLevel, returns the values at MinCutoff from the bottom and MaxCutoff from the top of the samples'''
+        MinCutoffValue = self.MinValue
+        MaxCutoffValue = self.MaxValue
+
+        if MinCutoff is not None:
+            MinCutoffValue = self.ValueAtPercentile(MinCutoff)
+
+        if MaxCutoff is not None:
+            MaxCutoffValue = self.ValueAtPercentile(1.0 - MaxCutoff)
+
+        return MinCutoffValue, MaxCutoffValue
+
+    def ToHistogram(self, numBins: int, minVal: float | None = None, maxVal: float | None = None) -> Histogram:
+        '''
+        Export the sketch to a fixed bin histogram.  Each retained value adds its weight to the bin it maps to.
+        :param minVal: Passed to Histogram.Init, defaults to the smallest sample
+        :param maxVal: Passed to Histogram.Init, by default the bins are sized so the last bin ends at the largest sample
+        '''
+        if minVal is None:
+            minVal = self.MinValue
+
+        if maxVal is None:
+            BinWidth = (self.MaxValue - minVal) / numBins
+            if not BinWidth > 0:
+                BinWidth = 1.0
+
+            # Histogram.Init adds one to maxVal because it assumes integer data
+            maxVal = (minVal + (BinWidth * numBins)) - 1
+
+        if math.isnan(minVal) or math.isnan(maxVal):
+            raise ValueError("Cannot export an empty quantile sketch without minVal and maxVal")
+
+        hist = Histogram.Init(minVal, maxVal, numBins)
+        counts = numpy.zeros(hist.NumBins, dtype=numpy.int64)
+        for (level, values) in enumerate(self._levels):
+            counts += hist._CountArray(values) << level
+
+        hist._AddToBins(slice(None), counts)
+        hist.NumSamples = self.NumSamples
+        return hist
+
+
+class HistogramStack(object):
+    '''
+    Many histograms sharing MinValue, MaxValue and NumBins, stored as the rows of one 2-D array so
+    statistics for every histogram are calculated by single vectorized operations.  Results match
+    calling the Histogram method of the same name on each histogram.
+    '''
+
+    def __init__(self, minVal: float, maxVal: float, bins: NDArray, NumSamples: NDArray | None = None,
+                 Names: list[str] | None = None):
+        '''
+        :param bins: 2-D array with one histogram per row
+        :param Names: Optional name, such as the filename, of each histogram
+        '''
+        bins = _AsBinArray(bins)
+        if bins.ndim != 2:
+            raise ValueError(f"HistogramStack bins must be a 2-D array, got shape {bins.shape}")
+
+        self._bins = bins
+        self._geometry = Histogram.Init(minVal, maxVal, bins.shape[1])
+        self.NumSamples = bins.sum(axis=1) if NumSamples is None else numpy.asarray(NumSamples)
+        self.Names = Names
+        self._cumulative = None
+        self._reverse_cumulative = None
+
+    @classmethod
+    def FromHistograms(cls, histograms: typing.Sequence[Histogram], Names: list[str] | None = None) -> HistogramStack:
+        '''Stack histograms that share MinValue, MaxValue and NumBins'''
+        if len(histograms) == 0:
+            raise ValueError("HistogramStack requires at least one histogram")
+
+        first = histograms[0]
+        for h in histograms:
+            cls._CheckGeometry(first, h)
+
+        return cls(first.MinValue, first.MaxValue, numpy.stack([h._bins for h in histograms]),
+                   NumSamples=[h.NumSamples for h in histograms], Names=Names)
+
+    @staticmethod
+    def _CheckGeometry(expected, h, name: str | None = None):
+        if h.MinValue != expected.MinValue or h.MaxValue != expected.MaxValue or h.NumBins != expected.NumBins:
+            raise ValueError(f"Histogram {name if name is not None else ''} range {h.MinValue}-{h.MaxValue} with {h.NumBins} bins "
+                             f"does not match the stack range {expected.MinValue}-{expected.MaxValue} with {expected.NumBins} bins")
+
+    @classmethod
+    def Load(cls, filenames: typing.Iterable[str], workers: int | None = None,
+             tasks_per_worker: int = 4) -> HistogramStack:
+        '''
+        Load histogram files, in any format Histogram.Load reads, using a process pool
+        :param workers: Number of processes, defaults to the number of CPUs
+        '''
+        filenames = list(filenames)
+        if len(filenames) == 0:
+            raise ValueError("HistogramStack requires at least one histogram")
+
+        if workers is None:
+            workers = os.cpu_count()
+
+        numTasks = min(len(filenames), workers * tasks_per_worker)
+        if workers <= 1 or numTasks <= 1:
+            loaded = _LoadHistogramParts(filenames)
+        else:
+            groups = [filenames[i::numTasks] for i in range(numTasks)]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_LoadHistogramParts, groups))
+
+            # Restore the original file order from the interleaved groups
+            loaded = [None] * len(filenames)
+            for (i, group) in enumerate(results):
+                loaded[i::numTasks] = group
+
+        first = loaded[0]
+        bins = numpy.empty((len(filenames), first.NumBins),
+                           dtype=numpy.result_type(*[h._bins.dtype for h in loaded]))
+        for (i, h) in enumerate(loaded):
+            cls._CheckGeometry(first, h, filenames[i])
+            bins[i] = h._bins
+
+        return cls(first.MinValue, first.MaxValue, bins, NumSamples=[h.NumSamples for h in loaded], Names=filenames)
+
+    @classmethod
+    def LoadDirectory(cls, path: str, extensions: typing.Iterable[str] = ('.xml', BinaryExtension),
+                      workers: int | None = None) -> HistogramStack:
+        '''Load every histogram file in a directory, in sorted filename order, using a process pool'''
+        extensions = [ext.lower() for ext in extensions]
+        filenames = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                     if os.path.splitext(name)[1].lower() in extensions]
+        return cls.Load(filenames, workers=workers)
+
+    def __len__(self):
+        return self._bins.shape[0]
+
+    def __getitem__(self, index: int) -> Histogram:
+        '''The histogram in a row, its bins are a read-only view of the stack'''
+        bins = self._bins[index]
+        bins.flags.writeable = False
+
+        obj = Histogram()
+        obj._bins = bins
+        obj.NumBins = self.NumBins
+        obj.MinValue = self.MinValue
+        obj.MaxValue = self.MaxValue
+        obj.NumSamples = self.NumSamples[index].item()
+        return obj
+
+    @property
+    def MinValue(self) -> float:
+        return self._geometry.MinValue
+
+    @property
+    def MaxValue(self) -> float:
+        return self._geometry.MaxValue
+
+    @property
+    def NumBins(self) -> int:
+        return self._geometry.NumBins
+
+    @property
+    def BinWidth(self) -> float:
+        return self._geometry.BinWidth
+
+    @property
+    def BinArray(self) -> NDArray:
+        '''The bins, one histogram per row.  Not a copy, should be treated as read-only.'''
+        return self._bins
+
+    @property
+    def CumulativeBins(self) -> NDArray:
+        if self._cumulative is None:
+            self._cumulative = numpy.cumsum(self._bins, axis=1)
+
+        return self._cumulative
+
+    @property
+    def _ReverseCumulativeBins(self) -> NDArray:
+        if self._reverse_cumulative is None:
+            self._reverse_cumulative = numpy.cumsum(self._bins[:, ::-1], axis=1)
+
+        return self._reverse_cumulative
+
+    def AutoLevel(self, MinCutoff: float | None = None, MaxCutoff: float | None = None) -> tuple[NDArray, NDArray]:
+        ''':return: Arrays of the min and max cutoff values of each histogram, see Histogram.AutoLevel'''
+        MinCutoffValues = numpy.full(len(self), self.MinValue, dtype=numpy.float64)
+        MaxCutoffValues = numpy.full(len(self), self.MaxValue, dtype=numpy.float64)
+
+        if MinCutoff is not None:
+            MinCutoffValues = _FindValuesAtPercentile(self._bins, MinCutoff, self.BinWidth, self.MinValue,
+                                                      Cumulative=self.CumulativeBins)
+
+        if MaxCutoff is not None:
+            CutoffValues = _FindValuesAtPercentile(self._bins[:, ::-1], MaxCutoff, self.BinWidth, 0,
+                                                   Cumulative=self._ReverseCumulativeBins)
+            MaxCutoffValues = self.MaxValue - CutoffValues
+
+        return MinCutoffValues, MaxCutoffValues
+
+    def Median(self, minVal: float | None = None, maxVal: float | None = None) -> NDArray:
+        (iMin, iMax, AdjustedMin) = self._geometry._MinMaxBinIndicies(minVal, maxVal)
+
+        Cumulative = self.CumulativeBins
+        Offset = Cumulative[:, iMin - 1] if iMin > 0 else 0
+
+        return _FindValuesAtPercentile(self._bins[:, iMin:iMax], 0.5, self.BinWidth, AdjustedMin,
+                                       Cumulative=Cumulative[:, iMin:iMax], CumulativeOffset=Offset)
+
+    def Mean(self, minVal: float | None = None, maxVal: float | None = None) -> NDArray:
+        (iMin, iMax, AdjustedMin) = self._geometry._MinMaxBinIndicies(minVal, maxVal)
+
+        counts = self._bins[:, iMin:iMax]
+        totalcount = counts.sum(axis=1)
+
+        # The same int64 overflow guard as _IndexWeightedSum, applied to the largest histogram
+        largest_index = max(abs(iMin), abs(iMax))
+        if counts.dtype.kind == 'f' or int(totalcount.max(initial=0)) * largest_index < (1 << 62):
+            meanindex = numpy.dot(counts, numpy.arange(iMin, iMax, dtype=counts.dtype)) / totalcount
+        else:
+            meanindex = numpy.array([_IndexWeightedSum(row, iMin) / total if total else numpy.nan
+                                     for (row, total) in zip(counts, totalcount.tolist())])
+
+        return self.MinValue + (self.BinWidth * (meanindex + 0.5))
+
+    def PeakValue(self, minVal: float | None = None, maxVal: float | None = None) -> NDArray:
+        (iMin, iMax, AdjustedMin) = self._geometry._MinMaxBinIndicies(minVal, maxVal)
+
+        counts = self._bins[:, iMin:iMax]
+        if counts.shape[1] == 0:
+            return numpy.full(len(self), numpy.nan)
+
+        isPeak = counts == counts.max(axis=1, keepdims=True)
+        return numpy.dot(isPeak, self._geometry.BinCenters(iMin, iMax)) / isPeak.sum(axis=1)
+
+
+class SharedHistogram(object):
+    '''
+    Histogram bins in multiprocessing.shared_memory that worker processes accumulate into without
+    locks or returning their results.  The bins are split into slabs, one row of bins per slab, and
+    each worker process must add only to its own slab.  ToHistogram sums the slabs.
+    Requires Python 3.8 or later.
+
+    Pickling a SharedHistogram passes only the name of the shared memory, the unpickled copy in a
+    worker attaches to the same memory.  The process that created it must call Close, or use it as
+    a context manager, to release the shared memory.
+    '''
+
+    def __init__(self, minVal: float, maxVal: float, numBins: int | None = None, numSlabs: int | None = None):
+        '''
+        :param numSlabs: Number of processes that may add to the histogram at once, defaults to the number of CPUs
+        '''
+        if shared_memory is None:
+            raise RuntimeError(f"SharedHistogram requires multiprocessing.shared_memory, added in Python 3.8, running {platform.python_version()}")
+
+        if numSlabs is None:
+            numSlabs = os.cpu_count()
+
+        self._geometry = Histogram.Init(minVal, maxVal, numBins)
+        self.NumSlabs = int(numSlabs)
+
+        shape = (self.NumSlabs, self._geometry.NumBins)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, int(numpy.prod(shape)) * 8))
+        self._owner = True
+        self._slabs = numpy.ndarray(shape, dtype=numpy.int64, buffer=self._shm.buf)
+        self._slabs.fill(0)
+
+    def __getstate__(self):
+        return {'MinValue': self.MinValue, 'MaxValue': self.MaxValue, 'NumBins': self.NumBins,
+                'NumSlabs': self.NumSlabs, 'Name': self._shm.name}
+
+    def __setstate__(self, state):
+        self._geometry = Histogram.Init(state['MinValue'], state['MaxValue'], state['NumBins'])
+        self.NumSlabs = state['NumSlabs']
+        self._shm = shared_memory.SharedMemory(name=state['Name'])
+        self._owner = False
+        self._slabs = numpy.ndarray((self.NumSlabs, self._geometry.NumBins), dtype=numpy.int64, buffer=self._shm.buf)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Close(self):
+        '''Detach from the shared memory, and release it if this process created it'''
+        if self._shm is None:
+            return
+
+        self._slabs = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+        self._shm = None
+
+    @property
+    def MinValue(self) -> float:
+        return self._geometry.MinValue
+
+    @property
+    def MaxValue(self) -> float:
+        return self._geometry.MaxValue
+
+    @property
+    def NumBins(self) -> int:
+        return self._geometry.NumBins
+
+    @property
+    def BinWidth(self) -> float:
+        return self._geometry.BinWidth
+
+    def AddArray(self, slab: int, values: NDArray):
+        '''Add every value in an array of any shape to the bins of a slab, see Histogram.AddArray'''
+        values = numpy.asarray(values).reshape(-1)
+        self._slabs[slab] += self._geometry._CountArray(values)
+
+    def AddHistogram(self, slab: int, h: Histogram):
+        '''Add the integer bin counts of a histogram with the same range to the bins of a slab'''
+        HistogramStack._CheckGeometry(self, h)
+        self._slabs[slab] += h._bins
+
+    def ToHistogram(self) -> Histogram:
+        ''':return: A histogram of the sum of all slabs'''
+        return Histogram.Init(self.MinValue, self.MaxValue, self.NumBins, binVals=self._slabs.sum(axis=0))
+
+
+def _LoadHistogramParts(filenames: list[str]) -> list[Histogram]:
+    '''Worker for HistogramStack.Load'''
+    loaded = []
+    for filename in filenames:
+        h = Histogram.Load(filename)
+        if h is None:
+            raise ValueError(f"Could not load histogram {filename}")
+
+        loaded.append(h)
+
+    return loaded
+
+
+def FromImageFiles(paths: str | typing.Iterable[str], minVal: float, maxVal: float,
+                   numBins: int | None = None) -> Histogram:
+    '''
+    Build one histogram from the pixels of many image files.  Files are read one at a time and
+    added in row strips, .npy files are memory mapped, so memory use does not grow with the
+    number of files.
+    :param paths: Image file path or iterable of image file paths
+    '''
+    # Imported here so histograms can be used without PIL installed
+    from nornir_shared import imagereader
+
+    if isinstance(paths, str):
+        paths = [paths]
+
+    hist = Histogram.Init(minVal, maxVal, numBins)
+    for path in paths:
+        for strip in imagereader.IterRowStrips(path):
+            hist.AddArray(strip)
+
+    return hist
+
+
+def _ImageFilesBinCounts(paths: list[str], minVal: float, maxVal: float, numBins: int | None) -> NDArray:
+    '''Worker for BuildParallel, returns only the bin array to keep the result small to transfer'''
+    return FromImageFiles(paths, minVal, maxVal, numBins)._bins
+
+
+# The shared histogram and slab of a BuildParallel worker process, set by _AttachWorkerSlab
+_workerShared = None
+_workerSlab = None
+
+
+def _AttachWorkerSlab(shared: SharedHistogram, slabs: multiprocessing.Queue):
+    '''Initializer of BuildParallel worker processes, each process takes a different slab from the queue'''
+    global _workerShared, _workerSlab
+    _workerShared = shared
+    _workerSlab = slabs.get()
+
+
+def _AddImageFilesToSlab(paths: list[str]):
+    '''Worker for BuildParallel, adds the files to the slab of the worker process'''
+    from nornir_shared import imagereader
+
+    for path in paths:
+        for strip in imagereader.IterRowStrips(path):
+            _workerShared.AddArray(_workerSlab, strip)
+
+
+def _TreeReduce(arrays: list[NDArray]) -> NDArray:
+    '''Sum arrays by adding adjacent pairs until one array remains'''
+    while len(arrays) > 1:
+        pairs = [arrays[i] + arrays[i + 1] for i in range(0, len(arrays) - 1, 2)]
+        if len(arrays) % 2:
+            pairs.append(arrays[-1])
+        arrays = pairs
+
+    return arrays[0]
+
+
+def BuildParallel(paths: typing.Iterable[str], minVal: float, maxVal: float, numBins: int | None = None,
+                  workers: int | None = None, tasks_per_worker: int = 4, use_shared_memory: bool = False) -> Histogram:
+    '''
+    Build one histogram from the pixels of many image files using a process pool.  Each task
+    histograms a group of files and returns its bins as an array, the partial histograms are
+    then summed with a tree reduction.
+    :param workers: Number of processes, defaults to the number of CPUs
+    :param tasks_per_worker: Files are split into about this many groups per worker to balance the load
+    :param use_shared_memory: Each worker process adds its tasks to its own slab of a SharedHistogram instead of
+                              returning their bins.  Ignored before Python 3.8.
+    '''
+    paths = list(paths)
+    if workers is None:
+        workers = os.cpu_count()
+
+    hist = Histogram.Init(minVal, maxVal, numBins)
+    if len(paths) == 0:
+        return hist
+
+    numTasks = min(len(paths), workers * tasks_per_worker)
+    if workers <= 1 or numTasks <= 1:
+        return FromImageFiles(paths, minVal, maxVal, numBins)
+
+    groups = [paths[i::numTasks] for i in range(numTasks)]
+
+    if use_shared_memory and shared_memory is not None:
+        with SharedHistogram(minVal, maxVal, numBins, numSlabs=workers) as shared:
+            slabs = multiprocessing.Queue()
+            try:
+                for slab in range(workers):
+                    slabs.put(slab)
+
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_AttachWorkerSlab,
+                                                            initargs=(shared, slabs)) as executor:
+                    futures = [executor.submit(_AddImageFilesToSlab, group) for group in groups]
+                    for f in futures:
+                        f.result()
+            finally:
+                slabs.close()
+                slabs.join_thread()
+
+            return shared.ToHistogram()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_ImageFilesBinCounts, group, minVal, maxVal, numBins) for group in groups]
+        partials = [f.result() for f in futures]
+
+    hist.AddHistogram(_TreeReduce(partials))
+    return hist
@@ -0,0 +1,194 @@
+'''
+Persistent cache of per-tile partial histograms.
+
+Building the histogram of a section means histogramming every tile.  The cache stores each
+tile's histogram on disk, keyed by the tile's path, size and modification time, and optionally
+a checksum of its contents.  When a few tiles change only their partial histograms are rebuilt,
+the rest are loaded from the cache and everything is merged with Histogram.AddHistogram.
+
+The cache directory is capped in size.  Reading a partial marks it as recently used and the
+least recently used partials are evicted first.  The size of the directory is measured once and
+then tracked as partials are written, so the directory is only scanned when the cap is exceeded.
+Partials written by other processes are counted the next time the directory is scanned.
+'''
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import typing
+
+from nornir_shared import checksum
+from nornir_shared import files
+from nornir_shared import prettyoutput
+from nornir_shared.histogram import Histogram, BinaryExtension, FromImageFiles
+
+# Default cap on the total size of the partial histograms in a cache directory
+DefaultMaxBytes = 1 << 30
+
+
+class HistogramCache(object):
+    '''
+    A directory of partial histograms, one .npz file per tile and histogram range.  Safe to share
+    between processes, partials are written to a temporary file and renamed into place.
+    '''
+
+    def __init__(self, cache_dir: str, max_bytes: int = DefaultMaxBytes, use_checksum: bool = False):
+        '''
+        :param cache_dir: Directory the partial histograms are stored in, created if it does not exist
+        :param max_bytes: Least recently used partials are evicted once the directory exceeds this size
+        :param use_checksum: Include a checksum of the tile contents in the key.  Detects changes that
+                             keep the size and modification time, at the cost of reading every tile.
+        '''
+        self.CacheDir = cache_dir
+        self.MaxBytes = max_bytes
+        self.UseChecksum = use_checksum
+        self.Hits = 0
+        self.Misses = 0
+
+        # Bytes of partials in the directory, measured on the first write
+        self._numBytes = None
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def Key(self, path: str, minVal: float, maxVal: float, numBins: int) -> str:
+        ''':return: The key of the partial histogram of a tile, which changes whenever the tile does'''
+        stats = os.stat(path)
+        parts = [os.path.abspath(path), str(stats.st_size), str(stats.st_mtime_ns),
+                 repr(minVal), repr(maxVal), str(numBins)]
+        if self.UseChecksum:
+            parts.append(checksum.BinaryFileChecksum(path))
+
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def _CachePath(self, key: str) -> str:
+        return os.path.join(self.CacheDir, key + BinaryExtension)
+
+    def Get(self, key: str) -> Histogram | None:
+        ''':return: The cached histogram for a key, or None if it is not cached'''
+        path = self._CachePath(key)
+        try:
+            hist = Histogram.LoadBinary(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            prettyoutput.Log(f"Removing unreadable cached histogram {path}: {e}")
+            self._TryRemove(path)
+            return None
+
+        if hist is None:
+            prettyoutput.Log(f"Removing invalid cached histogram {path}")
+            self._TryRemove(path)
+            return None
+
+        # Modification time orders the partials for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return hist
+
+    def Put(self, key: str, hist: Histogram):
+        '''Store a histogram, then evict partials if the cache exceeds its size cap'''
+        path = self._CachePath(key)
+        # The temporary file is not given the partial's extension so it is never counted or evicted as an entry
+        with files.AtomicWrite(path, suffix='.tmp') as tempPath:
+            hist.SaveBinary(tempPath)
+            numBytes = os.path.getsize(tempPath)
+            try:
+                numBytes -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            if self._numBytes is None:
+                self._numBytes = sum(size for (mtime, size, entryPath) in self._EntryStats())
+            else:
+                self._numBytes += numBytes
+
+            exceeded = self._numBytes > self.MaxBytes
+
+        if exceeded:
+            self.Evict()
+
+    def TileHistogram(self, path: str, minVal: float, maxVal: float, numBins: int | None = None) -> Histogram:
+        ''':return: The histogram of one tile, built and cached if the tile changed or was never cached'''
+        if numBins is None:
+            numBins = Histogram.Init(minVal, maxVal).NumBins
+
+        key = self.Key(path, minVal, maxVal, numBins)
+        hist = self.Get(key)
+        if hist is not None:
+            self.Hits += 1
+            return hist
+
+        self.Misses += 1
+        hist = FromImageFiles(path, minVal, maxVal, numBins)
+        self.Put(key, hist)
+        return hist
+
+    def Build(self, paths: typing.Iterable[str], minVal: float, maxVal: float, numBins: int | None = None) -> Histogram:
+        ''':return: The histogram of all tiles, merged from their cached partial histograms'''
+        hist = Histogram.Init(minVal, maxVal, numBins)
+        for path in paths:
+            hist.AddHistogram(self.TileHistogram(path, minVal, maxVal, hist.NumBins))
+
+        return hist
+
+    def _EntryStats(self) -> list[tuple[int, int, str]]:
+        ''':return: (mtime_ns, size, path) of every partial in the cache directory'''
+        entries = []
+        with os.scandir(self.CacheDir) as it:
+            for entry in it:
+                if not entry.name.endswith(BinaryExtension):
+                    continue
+
+                try:
+                    stats = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                entries.append((stats.st_mtime_ns, stats.st_size, entry.path))
+
+        return entries
+
+    def Evict(self, max_bytes: int | None = None) -> int:
+        '''
+        Remove least recently used partials until the cache is no larger than max_bytes
+        :param max_bytes: Defaults to the MaxBytes of the cache
+        :return: Number of partials removed
+        '''
+        if max_bytes is None:
+            max_bytes = self.MaxBytes
+
+        entries = sorted(self._EntryStats())
+        totalBytes = sum(size for (mtime, size, path) in entries)
+
+        numRemoved = 0
+        for (mtime, size, path) in entries:
+            if totalBytes <= max_bytes:
+                break
+
+            if self._TryRemove(path):
+                numRemoved += 1
+
+            totalBytes -= size
+
+        with self._lock:
+            self._numBytes = totalBytes
+
+        return numRemoved
+
+    def Clear(self):
+        '''Remove every partial from the cache'''
+        self.Evict(0)
+
+    @staticmethod
+    def _TryRemove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
@@ -0,0 +1,175 @@
+'''
+In-process replacement for the ``magick convert`` commands built by images.ConvertImagesInDict.
+
+The transforms are applied in the order of the ImageMagick command line: negate, bitwise and,
+bit shifts, level, grayscale, depth, flip and flop.  Values are processed in ImageMagick's 16-bit
+quantum range, so 8-bit images are scaled by 257 on reading and the AndValue, RightLeftShift
+and MinMax parameters have the same meaning they have for a 16-bit (Q16) ImageMagick build.
+Intermediate values are not clamped until the depth is reduced, as in an HDRI build.
+
+Images are processed in row strips and written to a temporary file that is renamed over the
+target, so an interrupted conversion never leaves a partially written image.
+'''
+from __future__ import annotations
+
+import concurrent.futures
+import os
+
+import numpy
+from numpy.typing import NDArray
+
+from PIL import Image
+
+from nornir_shared import files
+from nornir_shared import imagereader
+
+# ImageMagick's QuantumRange for a 16-bit build
+QuantumRange = 65535
+
+# Depths the converted image can be written with
+SupportedBpp = (8, 16)
+
+# Rec. 709 luma weights ImageMagick uses for -colorspace Gray
+_GrayWeights = numpy.array([0.212656, 0.715158, 0.072186])
+
+
+def _ToQuantum(strip: NDArray) -> NDArray[numpy.float64]:
+    '''Scale pixel values of any depth to the 16-bit quantum range'''
+    if strip.dtype == bool:
+        return strip.astype(numpy.float64) * QuantumRange
+    if strip.dtype == numpy.uint8:
+        return strip.astype(numpy.float64) * (QuantumRange / 255)
+    if numpy.issubdtype(strip.dtype, numpy.floating):
+        # Floating point images are normalized to 0-1, as ImageMagick reads floating point TIFFs
+        return strip.astype(numpy.float64) * QuantumRange
+
+    return strip.astype(numpy.float64)
+
+
+def _ToGray(strip: NDArray[numpy.float64]) -> NDArray[numpy.float64]:
+    '''Remove the alpha channel and combine colors into luma'''
+    if strip.ndim < 3:
+        return strip
+
+    if strip.shape[2] <= 2:
+        return strip[:, :, 0]
+
+    return numpy.dot(strip[:, :, :3], _GrayWeights)
+
+
+def ConvertImageArray(image: NDArray, Flip: bool = False, Flop: bool = False, Bpp: int = 8, Invert: bool = False,
+                      RightLeftShift: tuple[int, int] | None = None, AndValue: int | None = None,
+                      MinMax: tuple[float, float] | None = None) -> NDArray:
+    '''
+    Apply the transforms of ConvertImagesInDict to an image array.  The parameters match ConvertImagesInDict.
+    :return: A grayscale uint8 or uint16 array for Bpp 8 or 16
+    '''
+    if Bpp not in SupportedBpp:
+        raise ValueError(f"Cannot convert images to {Bpp} bits per pixel, expected one of {SupportedBpp}")
+
+    if MinMax is not None and MinMax[0] > MinMax[1]:
+        raise ValueError(f"Invalid MinMax {MinMax}, the minimum is greater than the maximum")
+
+    outputType = numpy.uint8 if Bpp == 8 else numpy.uint16
+    output = numpy.empty(image.shape[:2], dtype=outputType)
+
+    iRow = 0
+    for strip in imagereader.IterRowStrips(image):
+        values = _ToQuantum(strip)
+
+        if Invert:
+            values = QuantumRange - values
+
+        if AndValue is not None:
+            values = (values.astype(numpy.int64) & int(AndValue + 0.5)).astype(numpy.float64)
+
+        if RightLeftShift is not None:
+            # The same shifts ConvertImagesInDict passes to -evaluate rightshift and leftshift
+            if RightLeftShift[0] > 0:
+                values = (values.astype(numpy.int64) >> RightLeftShift[0]).astype(numpy.float64)
+
+            leftShift = RightLeftShift[0] + RightLeftShift[1] if RightLeftShift[1] > 0 else RightLeftShift[0]
+            values = (values.astype(numpy.int64) << leftShift).astype(numpy.float64)
+        elif MinMax is not None:
+            # ConvertImagesInDict ignores MinMax when shifting
+            scale = 1.0 / (MinMax[1] - MinMax[0]) if MinMax[1] != MinMax[0] else 1.0
+            values = (values - MinMax[0]) * (scale * QuantumRange)
+
+        values = numpy.clip(_ToGray(values), 0, QuantumRange)
+        if Bpp == 8:
+            values = values / (QuantumRange / 255)
+
+        output[iRow:iRow + strip.shape[0]] = numpy.floor(values + 0.5)
+        iRow += strip.shape[0]
+
+    if Flip:
+        output = output[::-1, :]
+
+    if Flop:
+        output = output[:, ::-1]
+
+    return numpy.ascontiguousarray(output)
+
+
+def WriteImageAtomic(image: NDArray, path: str, **kwargs):
+    '''
+    Write an image array to a temporary file in the target directory, then rename it over the target
+    :param kwargs: Passed to PIL's Image.save
+    '''
+    with files.AtomicWrite(path) as tempPath:
+        if imagereader.IsNumpyFile(path):
+            numpy.save(tempPath, image)
+        else:
+            Image.fromarray(image).save(tempPath, **kwargs)
+
+
+def ConvertImage(source: str, target: str, Flip: bool = False, Flop: bool = False, Bpp: int = 8,
+                 Invert: bool = False, RightLeftShift: tuple[int, int] | None = None, AndValue: int | None = None,
+                 MinMax: tuple[float, float] | None = None):
+    '''Convert one image file, see ConvertImageArray.  The source and target may be the same file.'''
+    converted = ConvertImageArray(imagereader.ReadImagePixels(source), Flip=Flip, Flop=Flop, Bpp=Bpp, Invert=Invert,
+                                  RightLeftShift=RightLeftShift, AndValue=AndValue, MinMax=MinMax)
+
+    # ImageMagick's -quality 106 used for 8-bit images is zlib level 1 with adaptive filtering
+    options = {'compress_level': 1} if Bpp <= 8 and target.lower().endswith('.png') else {}
+    WriteImageAtomic(converted, target, **options)
+
+
+def _ConvertImageTask(source: str, target: str, options: dict) -> str | None:
+    '''Worker for ConvertImages, returns an error message instead of raising'''
+    try:
+        ConvertImage(source, target, **options)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+
+    return None
+
+
+def ConvertImages(ImagesToConvert: dict[str, str], workers: int | None = None, **options) -> dict[str, str]:
+    '''
+    Convert images in a process pool, see ConvertImage for the options
+    :param ImagesToConvert: Maps each source path to its target path
+    :param workers: Number of processes, defaults to the executor default
+    :return: The error message of each source image that could not be converted
+    '''
+    items = list(ImagesToConvert.items())
+    if len(items) == 0:
+        return {}
+
+    errors = {}
+    if workers == 1 or len(items) == 1:
+        for (source, target) in items:
+            error = _ConvertImageTask(source, target, options)
+            if error is not None:
+                errors[source] = error
+
+        return errors
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_ConvertImageTask, source, target, options): source for (source, target) in items}
+        for future in concurrent.futures.as_completed(futures):
+            error = future.result()
+            if error is not None:
+                errors[futures[future]] = error
+
+    return errors
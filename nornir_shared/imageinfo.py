@@ -0,0 +1,309 @@
+'''
+Image metadata read in-process with PIL and numpy instead of launching ImageMagick.
+
+Bit depth, colorspace and dimensions are read from the file header without decoding
+the pixels.  Statistics decode the pixels and are calculated in row strips.  .npy files
+are memory mapped so reading their header does not load the image.
+
+Formats PIL cannot open raise PIL.UnidentifiedImageError, which callers such as
+nornir_shared.images catch to fall back to ImageMagick.
+'''
+from __future__ import annotations
+
+import concurrent.futures
+import math
+import os
+import typing
+
+import numpy
+from numpy.typing import NDArray
+
+from PIL import Image
+
+from nornir_shared import imagereader
+from nornir_shared.histogram import Histogram
+
+# Bits per channel of PIL image modes, matching ImageMagick's depth (%z)
+_ModeDepth = {'1': 1, 'L': 8, 'LA': 8, 'La': 8, 'P': 8, 'PA': 8, 'RGB': 8, 'RGBA': 8, 'RGBa': 8, 'RGBX': 8,
+              'CMYK': 8, 'YCbCr': 8, 'LAB': 8, 'HSV': 8, 'I': 32, 'F': 32,
+              'I;16': 16, 'I;16L': 16, 'I;16B': 16, 'I;16N': 16}
+
+# ImageMagick colorspace names for PIL image modes
+_ModeColorspace = {'1': 'Gray', 'L': 'Gray', 'LA': 'Gray', 'La': 'Gray', 'I': 'Gray', 'F': 'Gray',
+                   'I;16': 'Gray', 'I;16L': 'Gray', 'I;16B': 'Gray', 'I;16N': 'Gray',
+                   'P': 'sRGB', 'PA': 'sRGB', 'RGB': 'sRGB', 'RGBA': 'sRGB', 'RGBa': 'sRGB', 'RGBX': 'sRGB',
+                   'CMYK': 'CMYK', 'YCbCr': 'YCbCr', 'LAB': 'Lab', 'HSV': 'HSB'}
+
+# TIFF BitsPerSample tag
+_TiffBitsPerSampleTag = 258
+
+
+class ImageInfo(object):
+    '''Metadata from an image file header'''
+
+    def __init__(self, path: str, width: int, height: int, bpp: int, colorspace: str, mode: str, format: str):
+        self.Path = path
+        self.Width = width
+        self.Height = height
+        self.Bpp = bpp
+        self.Colorspace = colorspace
+        self.Mode = mode
+        self.Format = format
+
+    @property
+    def Size(self) -> NDArray[int]:
+        '''(Height, Width), as returned by images.GetImageSize'''
+        return numpy.array((self.Height, self.Width), dtype=numpy.int32)
+
+    def __str__(self):
+        return f'{self.Path}: {self.Format} {self.Width}x{self.Height} {self.Bpp}-bit {self.Colorspace} ({self.Mode})'
+
+
+def _ImageDepth(im: Image.Image) -> int:
+    ''':return: Bits per channel of an opened PIL image'''
+    tags = getattr(im, 'tag_v2', None)
+    if tags is not None and _TiffBitsPerSampleTag in tags:
+        bits = tags[_TiffBitsPerSampleTag]
+        return int(bits[0] if isinstance(bits, tuple) else bits)
+
+    # Older PIL versions open 16-bit grayscale PNGs in 32-bit mode I
+    if im.mode == 'I' and im.format == 'PNG':
+        return 16
+
+    return _ModeDepth.get(im.mode, 8)
+
+
+def _NumpyImageInfo(path: str) -> ImageInfo:
+    image = numpy.load(path, mmap_mode='r')
+    height = image.shape[0] if image.ndim > 0 else 1
+    width = image.shape[1] if image.ndim > 1 else 1
+    colorspace = 'sRGB' if image.ndim == 3 and image.shape[2] in (3, 4) else 'Gray'
+    return ImageInfo(path, width, height, image.dtype.itemsize * 8, colorspace, image.dtype.name, 'NPY')
+
+
+def ReadImageInfo(path: str) -> ImageInfo:
+    '''
+    Read the metadata of an image from its header, the pixels are not decoded
+    :raises PIL.UnidentifiedImageError: PIL cannot open the image format
+    '''
+    if imagereader.IsNumpyFile(path):
+        return _NumpyImageInfo(path)
+
+    with Image.open(path) as im:
+        return ImageInfo(path, im.width, im.height, _ImageDepth(im),
+                         _ModeColorspace.get(im.mode, im.mode), im.mode, im.format)
+
+
+def GetImageBpp(path: str) -> int:
+    ''':return: Bits per channel of the image, as ImageMagick's depth'''
+    return ReadImageInfo(path).Bpp
+
+
+def GetImageColorspace(path: str) -> str:
+    ''':return: ImageMagick's name for the colorspace of the image, such as Gray or sRGB'''
+    return ReadImageInfo(path).Colorspace
+
+
+class ImageStats(object):
+    '''Statistics of every value in an image, see CalculateStats'''
+
+    def __init__(self, count: int, minVal: float, maxVal: float, mean: float, variance: float):
+        self.Count = count
+        self.Min = minVal
+        self.Max = maxVal
+        self.Mean = mean
+        self.Variance = variance
+
+    @property
+    def StdDev(self) -> float:
+        return math.sqrt(self.Variance)
+
+    def AsTuple(self) -> tuple[float, float, float, float]:
+        ''':return: (Min, Mean, Max, StdDev), the order returned by GetImageStats'''
+        return self.Min, self.Mean, self.Max, self.StdDev
+
+    def __str__(self):
+        return f'Count: {self.Count} Min: {self.Min} Max: {self.Max} Mean: {self.Mean} StdDev: {self.StdDev}'
+
+
+def CalculateStats(image: str | NDArray, hist: Histogram | None = None) -> ImageStats:
+    '''
+    Calculate statistics in a single pass over the image in row strips.  Min and max are exact.  The
+    mean and sum of squared deviations of each strip are merged into the running totals (Welford's
+    method generalized to batches), so the variance does not lose precision to cancellation.
+    :param image: Image array or path.  Files are read with imagereader.IterDecodedStrips.  .npy files and
+                  non-interlaced PNGs, including 16-bit grayscale, are read one strip at a time so images
+                  larger than memory can be measured.  Other formats, such as TIFF, are decoded entirely.
+                  Palette images are measured by their colors.
+    :param hist: Optional histogram the values are added to in the same pass
+    :raises ValueError: The image is empty or contains NaN
+    :raises PIL.UnidentifiedImageError: PIL cannot open the image format
+    '''
+    if isinstance(image, str):
+        strips = imagereader.IterDecodedStrips(image, expand_palette=True)
+    else:
+        strips = imagereader.IterRowStrips(image)
+
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    minVal = None
+    maxVal = None
+
+    for strip in strips:
+        if strip.size == 0:
+            continue
+
+        stripMin = strip.min().item()
+        stripMax = strip.max().item()
+        if isinstance(stripMin, float) and (math.isnan(stripMin) or math.isnan(stripMax)):
+            raise ValueError("Cannot calculate statistics of an image containing NaN")
+
+        minVal = stripMin if minVal is None else min(minVal, stripMin)
+        maxVal = stripMax if maxVal is None else max(maxVal, stripMax)
+
+        values = strip.astype(numpy.float64).reshape(-1)
+        stripCount = len(values)
+        stripMean = values.mean().item()
+        deviations = values - stripMean
+        stripM2 = numpy.dot(deviations, deviations).item()
+
+        delta = stripMean - mean
+        total = count + stripCount
+        mean += delta * (stripCount / total)
+        m2 += stripM2 + (delta * delta * count * stripCount / total)
+        count = total
+
+        if hist is not None:
+            hist.AddArray(strip)
+
+    if count == 0:
+        raise ValueError("Cannot calculate statistics of an empty image")
+
+    return ImageStats(count, minVal, maxVal, mean, m2 / count)
+
+
+def ArrayStats(image: NDArray) -> tuple[float, float, float, float]:
+    ''':return: (Min, Mean, Max, StdDev) of every value in the array, see CalculateStats'''
+    return CalculateStats(image).AsTuple()
+
+
+def GetImageStats(path: str) -> tuple[float, float, float, float]:
+    '''
+    :return: (Min, Mean, Max, StdDev) of the pixel values of an image, in the range of the image's
+             data type.  All channels are included.  See CalculateStats.
+    '''
+    return CalculateStats(path).AsTuple()
+
+
+# Fields GetImageInfoBatch reads from image headers, and the fields that require decoding the pixels
+HeaderFields = ('width', 'height', 'bpp', 'colorspace', 'mode', 'format', 'filesize')
+StatFields = ('min', 'mean', 'max', 'stddev')
+DefaultBatchFields = ('width', 'height', 'bpp', 'mode')
+
+# Integer columns record unreadable images as -1, the other header fields are strings which record None
+_IntFieldMissing = -1
+_IntFields = ('width', 'height', 'bpp', 'filesize')
+
+
+def _TryReadHeader(path: str) -> tuple[ImageInfo | None, int]:
+    '''Worker for GetImageInfoBatch, returns (None, filesize) if the image cannot be read'''
+    try:
+        filesize = os.stat(path).st_size
+    except OSError:
+        return None, _IntFieldMissing
+
+    try:
+        return ReadImageInfo(path), filesize
+    except (OSError, ValueError):
+        return None, filesize
+
+
+def _TryGetImageStats(path: str) -> tuple[float, float, float, float] | None:
+    '''Worker for GetImageInfoBatch'''
+    try:
+        return GetImageStats(path)
+    except (OSError, ValueError):
+        return None
+
+
+def GetImageInfoBatch(paths: typing.Iterable[str], fields: typing.Iterable[str] | None = None,
+                      workers: int | None = None) -> dict[str, NDArray]:
+    '''
+    Read the metadata of many images in one call.  Headers are read by a thread pool, statistics,
+    which decode every pixel, are calculated by a process pool.
+    :param fields: Any of HeaderFields and StatFields, 'stats' selects every StatField.  Defaults to DefaultBatchFields.
+    :param workers: Number of threads and processes, defaults to the executor defaults
+    :return: Columns as a dictionary of arrays in the order of paths.  'path' and 'valid' are always
+             included, images that could not be read are not valid and have -1, NaN or None in each field.
+    '''
+    paths = list(paths)
+    if fields is None:
+        fields = DefaultBatchFields
+
+    expanded = []
+    for field in fields:
+        expanded.extend(StatFields if field == 'stats' else [field])
+
+    for field in expanded:
+        if field not in HeaderFields and field not in StatFields:
+            raise ValueError(f"Unknown image info field {field}, expected one of {HeaderFields + StatFields}")
+
+    columns = {'path': numpy.array(paths, dtype=object),
+               'valid': numpy.ones(len(paths), dtype=bool)}
+
+    headerFields = [field for field in expanded if field in HeaderFields]
+    if len(headerFields) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            headers = list(executor.map(_TryReadHeader, paths))
+
+        columns['valid'] &= numpy.array([info is not None for (info, filesize) in headers], dtype=bool)
+        for field in headerFields:
+            if field == 'filesize':
+                columns[field] = numpy.array([filesize for (info, filesize) in headers], dtype=numpy.int64)
+            elif field in _IntFields:
+                attribute = field.capitalize()
+                columns[field] = numpy.array([_IntFieldMissing if info is None else getattr(info, attribute)
+                                              for (info, filesize) in headers], dtype=numpy.int64)
+            else:
+                attribute = field.capitalize()
+                columns[field] = numpy.array([None if info is None else getattr(info, attribute)
+                                              for (info, filesize) in headers], dtype=object)
+
+    statFields = [field for field in expanded if field in StatFields]
+    if len(statFields) > 0:
+        if workers == 1 or len(paths) <= 1:
+            stats = [_TryGetImageStats(path) for path in paths]
+        else:
+            numWorkers = os.cpu_count() if workers is None else workers
+            with concurrent.futures.ProcessPoolExecutor(max_workers=numWorkers) as executor:
+                stats = list(executor.map(_TryGetImageStats, paths,
+                                          chunksize=max(1, len(paths) // (numWorkers * 4))))
+
+        columns['valid'] &= numpy.array([s is not None for s in stats], dtype=bool)
+        for field in statFields:
+            iStat = StatFields.index(field)
+            columns[field] = numpy.array([numpy.nan if s is None else s[iStat] for s in stats], dtype=numpy.float64)
+
+    return columns
+
+
+def GetImageError(path: str) -> str | None:
+    ''':return: None if PIL can verify the image file, or numpy can map the .npy file, otherwise why it cannot'''
+    try:
+        if imagereader.IsNumpyFile(path):
+            numpy.load(path, mmap_mode='r')
+        else:
+            with Image.open(path) as im:
+                im.verify()
+    except OSError as os_e:
+        return os_e.strerror if os_e.strerror else str(os_e)
+    except Exception as e:
+        return str(e)
+
+    return None
+
+
+def VerifyImage(path: str) -> bool:
+    ''':return: True if PIL can verify the image file, or numpy can map the .npy file'''
+    return GetImageError(path) is None
@@ -0,0 +1,196 @@
+'''
+Persistent cache of image metadata.
+
+Raw tiles are immutable, yet their size, bit depth and validity are read again by every
+pipeline stage.  ImageInfoCache stores the metadata in a SQLite database, by default a
+sidecar file in the directory of the images, keyed by the image path, size and modification
+time.  A changed file no longer matches its row and is read again.
+
+SQLite allows many processes to read the database at once.  Rows are written one statement
+at a time, and writers wait for each other instead of failing.  If the database cannot be
+written, for example in a read-only directory, values are still returned but not cached.
+'''
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+
+from numpy.typing import NDArray
+
+from nornir_shared import imageinfo
+from nornir_shared import prettyoutput
+
+# Name of the sidecar database created by ImageInfoCache.ForDirectory
+DefaultCacheFilename = '.nornir_imageinfo.sqlite'
+
+# Seconds a connection waits for another process to finish writing
+_BusyTimeout = 30.0
+
+_Columns = ('path', 'size', 'mtime_ns', 'valid', 'width', 'height', 'bpp', 'colorspace', 'mode', 'format',
+            'min', 'mean', 'max', 'stddev')
+
+_CreateTable = '''CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    valid INTEGER,
+    width INTEGER,
+    height INTEGER,
+    bpp INTEGER,
+    colorspace TEXT,
+    mode TEXT,
+    format TEXT,
+    min REAL,
+    mean REAL,
+    max REAL,
+    stddev REAL)'''
+
+
+class ImageInfoCache(object):
+    '''
+    Memoizes ImageInfo, validity and statistics of image files in a SQLite database.  Each thread
+    uses its own connection.  Pickling passes only the database path.
+    '''
+
+    def __init__(self, db_path: str):
+        self.DBPath = db_path
+        self.Hits = 0
+        self.Misses = 0
+        self._local = threading.local()
+
+        try:
+            with self._Connection() as connection:
+                connection.execute(_CreateTable)
+        except sqlite3.Error as e:
+            prettyoutput.Log(f"Could not open image info cache {self.DBPath}: {e}")
+
+    @classmethod
+    def ForDirectory(cls, directory: str) -> ImageInfoCache:
+        ''':return: The cache stored in a sidecar file in the directory'''
+        return cls(os.path.join(directory, DefaultCacheFilename))
+
+    def __getstate__(self):
+        return {'DBPath': self.DBPath}
+
+    def __setstate__(self, state):
+        self.DBPath = state['DBPath']
+        self.Hits = 0
+        self.Misses = 0
+        self._local = threading.local()
+
+    def _Connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.DBPath, timeout=_BusyTimeout)
+            try:
+                # Readers do not block the writer, or each other, in write-ahead logging mode
+                connection.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                pass
+
+            self._local.connection = connection
+
+        return connection
+
+    def Close(self):
+        '''Close this thread's connection to the database'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    @staticmethod
+    def _Key(path: str) -> tuple[str, int, int]:
+        ''':return: (path, size, mtime_ns) of a file'''
+        stats = os.stat(path)
+        return os.path.abspath(path), stats.st_size, stats.st_mtime_ns
+
+    def _Lookup(self, key: tuple[str, int, int]) -> dict | None:
+        ''':return: The cached row for the file, or None if it is not cached or the file changed'''
+        try:
+            row = self._Connection().execute(f'SELECT {", ".join(_Columns)} FROM images WHERE path = ?',
+                                             (key[0],)).fetchone()
+        except sqlite3.Error:
+            return None
+
+        if row is None:
+            return None
+
+        row = dict(zip(_Columns, row))
+        if row['size'] != key[1] or row['mtime_ns'] != key[2]:
+            return None
+
+        return row
+
+    def _Store(self, key: tuple[str, int, int], row: dict):
+        '''Write a row for the file, replacing any row for an earlier version of it'''
+        row = dict(row)
+        row['path'], row['size'], row['mtime_ns'] = key
+        values = [row.get(column) for column in _Columns]
+        try:
+            with self._Connection() as connection:
+                connection.execute(f'INSERT OR REPLACE INTO images ({", ".join(_Columns)}) '
+                                   f'VALUES ({", ".join("?" * len(_Columns))})', values)
+        except sqlite3.Error as e:
+            prettyoutput.Log(f"Could not write image info cache {self.DBPath}: {e}")
+
+    def _Row(self, path: str) -> tuple[tuple[str, int, int], dict]:
+        ''':return: The key and current row for a file, reading the header if the file is not cached'''
+        key = self._Key(path)
+        row = self._Lookup(key)
+        if row is not None:
+            self.Hits += 1
+            return key, row
+
+        self.Misses += 1
+        row = {}
+        try:
+            info = imageinfo.ReadImageInfo(path)
+            row.update({'width': info.Width, 'height': info.Height, 'bpp': info.Bpp,
+                        'colorspace': info.Colorspace, 'mode': info.Mode, 'format': info.Format})
+        except (OSError, ValueError):
+            row['valid'] = 0
+
+        self._Store(key, row)
+        return key, row
+
+    def GetInfo(self, path: str) -> imageinfo.ImageInfo | None:
+        ''':return: The ImageInfo of the image, or None if the image header cannot be read'''
+        (key, row) = self._Row(path)
+        if row.get('width') is None:
+            return None
+
+        return imageinfo.ImageInfo(path, row['width'], row['height'], row['bpp'], row['colorspace'],
+                                   row['mode'], row['format'])
+
+    def GetImageSize(self, path: str) -> NDArray[int] | None:
+        ''':return: (Height, Width) of the image, as images.GetImageSize'''
+        info = self.GetInfo(path)
+        return None if info is None else info.Size
+
+    def GetImageBpp(self, path: str) -> int | None:
+        info = self.GetInfo(path)
+        return None if info is None else info.Bpp
+
+    def IsValidImage(self, path: str) -> bool:
+        ''':return: True if the whole image file can be verified, see imageinfo.VerifyImage'''
+        try:
+            (key, row) = self._Row(path)
+        except FileNotFoundError:
+            return False
+
+        if row.get('valid') is None:
+            row['valid'] = int(imageinfo.VerifyImage(path))
+            self._Store(key, row)
+
+        return bool(row['valid'])
+
+    def GetImageStats(self, path: str) -> tuple[float, float, float, float]:
+        ''':return: (Min, Mean, Max, StdDev) of the image, see imageinfo.GetImageStats'''
+        (key, row) = self._Row(path)
+        if row.get('mean') is None:
+            (row['min'], row['mean'], row['max'], row['stddev']) = imageinfo.GetImageStats(path)
+            self._Store(key, row)
+
+        return row['min'], row['mean'], row['max'], row['stddev']
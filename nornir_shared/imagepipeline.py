@@ -0,0 +1,147 @@
+'''
+Overlap reading, processing and writing of many images.
+
+ProcessImages reads images on a pool of I/O threads ahead of the images being processed,
+processes them in a process pool, and writes the results on the I/O threads while later
+images are processed.  On high latency storage, such as NFS, the processors then spend their
+time processing instead of waiting for reads and writes.
+
+Each stage is bounded, so no more than prefetch decoded images, a few images per worker and
+write_behind results are held in memory however many paths are processed.  Results are yielded
+in the order of the paths.
+'''
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import itertools
+import typing
+
+import numpy
+from numpy.typing import NDArray
+
+from nornir_shared import imagereader
+
+DefaultPrefetch = 4
+DefaultWriteBehind = 4
+DefaultIOThreads = 4
+
+
+class PipelineResult(object):
+    '''The outcome of processing one image'''
+
+    def __init__(self, path: str, value=None, error: Exception | None = None):
+        self.Path = path
+        self.Value = value
+        self.Error = error
+
+    @property
+    def Succeeded(self) -> bool:
+        return self.Error is None
+
+    def __str__(self):
+        return f'{self.Path}: {self.Error}' if self.Error is not None else f'{self.Path}: succeeded'
+
+
+def ReadImage(path: str) -> NDArray:
+    ''':return: The pixels of an image in memory, .npy files are read rather than memory mapped so they can be sent to other processes'''
+    image = imagereader.ReadImageArray(path)
+    return numpy.array(image) if isinstance(image, numpy.memmap) else image
+
+
+def _Failed(error: Exception) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    future.set_exception(error)
+    return future
+
+
+def ProcessImages(paths: typing.Iterable[str], func: typing.Callable[[NDArray], typing.Any],
+                  write: typing.Callable[[str, typing.Any], None] | None = None,
+                  read: typing.Callable[[str], NDArray] | None = None,
+                  prefetch: int = DefaultPrefetch, write_behind: int = DefaultWriteBehind,
+                  workers: int | None = None, io_threads: int = DefaultIOThreads,
+                  use_processes: bool = True) -> typing.Iterator[PipelineResult]:
+    '''
+    Read, process and write images with the three stages running at the same time
+    :param func: Called with the pixels of each image.  Must be a module level function when use_processes is True.
+    :param write: Optional, called with the path and the value func returned on an I/O thread
+    :param read: Called with each path on an I/O thread, defaults to ReadImage
+    :param prefetch: Number of images read ahead of the images being processed
+    :param write_behind: Number of results that may be waiting to be written before processing waits for them
+    :param workers: Number of processes, defaults to the executor default
+    :param io_threads: Number of threads reading and writing
+    :param use_processes: Process images in a process pool, otherwise a thread pool for functions that release the GIL
+    :return: A PipelineResult for each path, in the order of the paths.  Errors reading, processing or writing an
+             image are recorded in its result and the remaining images are still processed.
+    '''
+    if read is None:
+        read = ReadImage
+
+    prefetch = max(1, prefetch)
+    write_behind = max(0, write_behind)
+
+    if use_processes:
+        computePool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        computePool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # Enough images in the compute pool that each worker has the next image waiting
+    maxComputing = max(1, computePool._max_workers * 2)
+    maxWriting = write_behind if write is not None else 0
+
+    ioPool = concurrent.futures.ThreadPoolExecutor(max_workers=io_threads)
+    paths = iter(paths)
+    reading = collections.deque()
+    computing = collections.deque()
+    writing = collections.deque()
+
+    def FillReads():
+        while len(reading) < prefetch:
+            path = next(paths, None)
+            if path is None:
+                return
+
+            reading.append((path, ioPool.submit(read, path)))
+
+    try:
+        FillReads()
+        while len(reading) > 0 or len(computing) > 0 or len(writing) > 0:
+            while len(reading) > 0 and len(computing) < maxComputing:
+                (path, future) = reading.popleft()
+                try:
+                    computing.append((path, computePool.submit(func, future.result())))
+                except Exception as e:
+                    computing.append((path, _Failed(e)))
+
+                FillReads()
+
+            if len(computing) > 0:
+                (path, future) = computing.popleft()
+                try:
+                    value = future.result()
+                    writeFuture = ioPool.submit(write, path, value) if write is not None else None
+                    writing.append((PipelineResult(path, value), writeFuture))
+                except Exception as e:
+                    writing.append((PipelineResult(path, error=e), None))
+
+            # Wait for writes only when too many are pending, or nothing else is left to do
+            while len(writing) > maxWriting or (len(writing) > 0 and len(computing) == 0 and len(reading) == 0):
+                (result, writeFuture) = writing.popleft()
+                if writeFuture is not None:
+                    try:
+                        writeFuture.result()
+                    except Exception as e:
+                        result.Error = e
+
+                yield result
+    finally:
+        # Cancel work that has not started when the caller stops early, so shutdown waits only for running work
+        for (path, future) in itertools.chain(reading, computing):
+            future.cancel()
+
+        for (result, writeFuture) in writing:
+            if writeFuture is not None:
+                writeFuture.cancel()
+
+        computePool.shutdown(wait=True)
+        ioPool.shutdown(wait=True)
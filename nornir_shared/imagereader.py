@@ -0,0 +1,543 @@
+'''
+Read image pixels into numpy arrays without depending on ImageMagick or nornir_pools.
+
+Large images are processed in row strips so the temporary arrays created while
+processing them stay small.  .npy files are memory mapped so only the rows being
+processed are read from disk.  IterDecodedStrips also decodes non-interlaced PNGs a strip
+at a time, so they can be processed without holding the whole image in memory.
+
+ReadRegion reads a rectangle of an image, decoding as little of the file as the format allows.
+Non-interlaced PNGs are decompressed here a strip of rows at a time and each strip is decoded by
+PIL as a small PNG of its own, so the rows above a region are discarded as they are decoded.
+Uncompressed TIFF strips and tiles are located from the image's tile descriptors, the one part of
+PIL used that it does not document.  If the installed PIL describes them differently such images
+are decoded entirely instead.
+'''
+from __future__ import annotations
+
+import collections
+import io
+import os
+import struct
+import threading
+import typing
+import zlib
+
+import numpy
+from numpy.typing import NDArray
+
+from PIL import Image
+from PIL import ImageMode
+# Disable decompression bomb protection since we are dealing with huge images on purpose
+Image.MAX_IMAGE_PIXELS = None
+
+# Default number of pixels in each row strip
+DefaultStripPixels = 1 << 20
+
+
+def IsNumpyFile(path: str) -> bool:
+    (root, ext) = os.path.splitext(path)
+    return ext.lower() == '.npy'
+
+
+def ReadImageArray(path: str) -> NDArray:
+    '''
+    :return: A read-only memory map of a .npy file, otherwise the decoded pixels of the image
+    '''
+    if IsNumpyFile(path):
+        return numpy.load(path, mmap_mode='r')
+
+    with Image.open(path) as im:
+        return numpy.asarray(im)
+
+
+def ReadImagePixels(path: str) -> NDArray:
+    '''
+    :return: The pixel values of an image, as ReadImageArray but palette images are expanded to their
+             colors instead of returning palette indices.  .npy files are memory mapped.
+    '''
+    if IsNumpyFile(path):
+        return numpy.load(path, mmap_mode='r')
+
+    with Image.open(path) as im:
+        return numpy.asarray(_ExpandPalette(im))
+
+
+def _ExpandPalette(im: Image.Image) -> Image.Image:
+    ''':return: The image converted to the colors of its palette, or the image itself if it has no palette'''
+    if im.mode in ('P', 'PA'):
+        return im.convert('RGBA' if im.mode == 'PA' else 'RGB')
+
+    return im
+
+
+def RowsPerStrip(image: NDArray, strip_pixels: int | None = None) -> int:
+    ''':return: The number of rows of the image that fit in a strip of strip_pixels pixels, at least one'''
+    if strip_pixels is None:
+        strip_pixels = DefaultStripPixels
+
+    row_pixels = int(numpy.prod(image.shape[1:], dtype=numpy.int64)) if image.ndim > 1 else 1
+    return max(1, strip_pixels // max(1, row_pixels))
+
+
+def IterRowStrips(image: str | NDArray, rows_per_strip: int | None = None) -> typing.Iterator[NDArray]:
+    '''
+    Yield consecutive row strips of an image.  Strips are views of the image, not copies.
+    :param image: Image array or path to an image file
+    :param rows_per_strip: Rows in each strip, defaults to rows totaling about DefaultStripPixels pixels
+    '''
+    if isinstance(image, str):
+        image = ReadImageArray(image)
+
+    if image.ndim == 0:
+        image = image.reshape(1)
+
+    if rows_per_strip is None:
+        rows_per_strip = RowsPerStrip(image)
+
+    for iRow in range(0, image.shape[0], rows_per_strip):
+        yield image[iRow:iRow + rows_per_strip]
+
+
+# Default size of DefaultStripCache, the decoded rows of images ReadRegion cannot read at random
+DefaultStripCacheBytes = 1 << 28
+
+
+class DecodedStripCache(object):
+    '''
+    Least recently used cache of row strips of decoded images, bounded by the bytes of the strips.
+    Entries are keyed by the path, size and modification time of the file, so changed files are decoded again.
+    '''
+
+    def __init__(self, max_bytes: int = DefaultStripCacheBytes):
+        self.MaxBytes = max_bytes
+        self.Hits = 0
+        self.Misses = 0
+        self._strips = collections.OrderedDict()
+        self._numBytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def NumBytes(self) -> int:
+        return self._numBytes
+
+    def Get(self, key) -> NDArray | None:
+        with self._lock:
+            strip = self._strips.get(key)
+            if strip is None:
+                self.Misses += 1
+                return None
+
+            self.Hits += 1
+            self._strips.move_to_end(key)
+            return strip
+
+    def Put(self, key, strip: NDArray):
+        '''Store a strip, removing the least recently used strips to stay within MaxBytes'''
+        if strip.nbytes > self.MaxBytes:
+            return
+
+        with self._lock:
+            if key in self._strips:
+                self._numBytes -= self._strips.pop(key).nbytes
+
+            self._strips[key] = strip
+            self._numBytes += strip.nbytes
+            while self._numBytes > self.MaxBytes:
+                (oldKey, oldStrip) = self._strips.popitem(last=False)
+                self._numBytes -= oldStrip.nbytes
+
+    def Clear(self):
+        with self._lock:
+            self._strips.clear()
+            self._numBytes = 0
+
+
+DefaultStripCache = DecodedStripCache()
+
+
+def _RawModeBytes(rawmode: str) -> int | None:
+    ''':return: Bytes per pixel of a PIL raw mode, or None if pixels are not a whole number of bytes'''
+    try:
+        mode = ImageMode.getmode(rawmode)
+    except KeyError:
+        return None
+
+    if rawmode == '1':
+        return None
+
+    return numpy.dtype(mode.typestr).itemsize * len(mode.bands)
+
+
+def _RawTiles(im: Image.Image) -> list | None:
+    '''
+    :return: The tiles of an image whose pixels are stored uncompressed and top down, such as
+             uncompressed TIFF strips and tiles.  None if the image must be decoded as a whole.
+             im.tile is not a documented interface of PIL, so None is also returned if it does not
+             have the (name, extents, offset, args) layout of PIL 9 through 12.
+    '''
+    tiles = []
+    try:
+        for (name, extents, offset, args) in getattr(im, 'tile', ()):
+            if isinstance(args, str):
+                args = (args, 0, 1)
+
+            if name != 'raw' or len(args) < 2 or (len(args) > 2 and args[2] != 1) or _RawModeBytes(args[0]) is None:
+                return None
+
+            (tx0, ty0, tx1, ty1) = extents
+            tiles.append(((int(tx0), int(ty0), int(tx1), int(ty1)), int(offset), (args[0], int(args[1]))))
+    except (TypeError, ValueError):
+        return None
+
+    return tiles if len(tiles) > 0 else None
+
+
+def _ReadRawTileRows(path: str, mode: str, tile, row0: int, row1: int) -> NDArray:
+    '''Decode rows [row0, row1) of the image, which must be within the tile, without reading the rest of the file'''
+    ((tx0, ty0, tx1, ty1), offset, (rawmode, stride)) = tile
+    if stride <= 0:
+        stride = (tx1 - tx0) * _RawModeBytes(rawmode)
+
+    with open(path, 'rb') as f:
+        f.seek(offset + (row0 - ty0) * stride)
+        data = f.read((row1 - row0) * stride)
+
+    return numpy.asarray(Image.frombytes(mode, (tx1 - tx0, row1 - row0), data, 'raw', rawmode, stride))
+
+
+def _ReadRawRegion(path: str, mode: str, tiles: list, shape: tuple, dtype: numpy.dtype,
+                   y0: int, y1: int, x0: int, x1: int) -> NDArray:
+    region = numpy.empty((y1 - y0, x1 - x0) + shape[2:], dtype=dtype)
+    for tile in tiles:
+        (tx0, ty0, tx1, ty1) = tile[0]
+        (ix0, iy0, ix1, iy1) = (max(tx0, x0), max(ty0, y0), min(tx1, x1, shape[1]), min(ty1, y1, shape[0]))
+        if ix0 >= ix1 or iy0 >= iy1:
+            continue
+
+        rows = _ReadRawTileRows(path, mode, tile, iy0, iy1)
+        region[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = rows[:, ix0 - tx0:ix1 - tx0]
+
+    return region
+
+
+_PngSignature = b'\x89PNG\r\n\x1a\n'
+
+# Largest piece of compressed or decompressed PNG data held at once while streaming
+_PngReadBytes = 1 << 20
+
+# Samples per pixel of each PNG colour type
+_PngSamples = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# 8-bit colour types PIL decodes to exactly the stored bytes, by bytes per pixel.  PNG filters depend only on
+# the bytes per pixel, so any scanlines with the same bytes per pixel are unfiltered by decoding them as this type.
+_PngByteColorTypes = {1: 0, 2: 4, 3: 2, 4: 6}
+
+
+class _PngHeader(object):
+    '''The fields of a PNG's IHDR and the chunks needed to decode its scanlines the way PIL decodes the file'''
+
+    def __init__(self, width: int, height: int, bit_depth: int, color_type: int, chunks: list[bytes]):
+        self.Width = width
+        self.Height = height
+        self.BitDepth = bit_depth
+        self.ColorType = color_type
+        self.Chunks = chunks
+
+        bitsPerPixel = _PngSamples[color_type] * bit_depth
+        self.RowBytes = (width * bitsPerPixel + 7) // 8
+        self.PixelBytes = max(1, bitsPerPixel // 8)
+
+
+def _IterPngChunks(f: typing.BinaryIO) -> typing.Iterator[tuple[bytes, int]]:
+    '''Yield (type, length) of each chunk following the signature, with the file positioned at the chunk's data'''
+    position = f.tell()
+    while True:
+        f.seek(position)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+
+        (length, chunkType) = struct.unpack('>I4s', header)
+        yield chunkType, length
+        if chunkType == b'IEND':
+            return
+
+        position += 12 + length
+
+
+def _ReadPngHeader(path: str) -> _PngHeader | None:
+    ''':return: The header of a non-interlaced PNG whose scanlines can be decoded in strips, otherwise None'''
+    with open(path, 'rb') as f:
+        if f.read(len(_PngSignature)) != _PngSignature:
+            return None
+
+        ihdr = None
+        chunks = []
+        for (chunkType, length) in _IterPngChunks(f):
+            if chunkType == b'IHDR':
+                ihdr = f.read(length)
+            elif chunkType in (b'PLTE', b'tRNS'):
+                chunks.append(_PngChunk(chunkType, f.read(length)))
+            elif chunkType == b'IDAT':
+                break
+
+    if ihdr is None or len(ihdr) != 13:
+        return None
+
+    (width, height, bitDepth, colorType, compression, filterMethod, interlace) = struct.unpack('>IIBBBBB', ihdr)
+    if colorType not in _PngSamples or compression != 0 or filterMethod != 0 or interlace != 0 or width == 0:
+        return None
+
+    header = _PngHeader(width, height, bitDepth, colorType, chunks)
+    if header.PixelBytes not in _PngByteColorTypes:
+        # 16-bit RGB and RGBA, which PIL reduces to 8 bits
+        return None
+
+    return header
+
+
+def _PngChunk(chunkType: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data))
+
+
+def _DecodePng(width: int, height: int, bit_depth: int, color_type: int, chunks: list[bytes], scanlines: bytes,
+               expand_palette: bool = False) -> NDArray:
+    ''':return: The pixels PIL decodes from filtered scanlines written as a PNG of their own'''
+    ihdr = struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0)
+    png = b''.join([_PngSignature, _PngChunk(b'IHDR', ihdr)] + chunks +
+                   [_PngChunk(b'IDAT', zlib.compress(scanlines, 0)), _PngChunk(b'IEND', b'')])
+    with Image.open(io.BytesIO(png)) as im:
+        return numpy.asarray(_ExpandPalette(im) if expand_palette else im)
+
+
+def _IterPngData(f: typing.BinaryIO, path: str) -> typing.Iterator[bytes]:
+    '''Yield the decompressed contents of the IDAT chunks in pieces of at most _PngReadBytes'''
+    decompressor = zlib.decompressobj()
+    for (chunkType, length) in _IterPngChunks(f):
+        if chunkType == b'IEND':
+            break
+
+        if chunkType != b'IDAT':
+            continue
+
+        crc = zlib.crc32(chunkType)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(remaining, _PngReadBytes))
+            if len(data) == 0:
+                raise OSError(f"Truncated PNG file {path}")
+
+            remaining -= len(data)
+            crc = zlib.crc32(data, crc)
+            while True:
+                decompressed = decompressor.decompress(data, _PngReadBytes)
+                data = decompressor.unconsumed_tail
+                if len(decompressed) > 0:
+                    yield decompressed
+
+                if len(data) == 0 and len(decompressed) < _PngReadBytes:
+                    break
+
+        stored = f.read(4)
+        if len(stored) == 4 and struct.unpack('>I', stored)[0] != crc:
+            raise OSError(f"Broken PNG file {path}, IDAT checksum does not match")
+
+    remaining = decompressor.flush()
+    if len(remaining) > 0:
+        yield remaining
+
+
+def _IterPngStrips(path: str, header: _PngHeader, rows_per_strip: int, expand_palette: bool = False) -> typing.Iterator[NDArray]:
+    '''
+    Yield row strips of a non-interlaced PNG from the top, decompressing only as far as the strip being yielded.
+    Each strip is decoded with the unfiltered last row of the previous strip in front of it, so PIL can undo
+    the filters of its first row.  Only the strip being decoded and that row are held in memory.
+    '''
+    rowLength = header.RowBytes + 1
+    byteColorType = _PngByteColorTypes[header.PixelBytes]
+    byteWidth = header.RowBytes // header.PixelBytes
+    sameFormat = (byteColorType, 8) == (header.ColorType, header.BitDepth)
+
+    pending = bytearray()
+    previousRow = None
+    iRow = 0
+    with open(path, 'rb') as f:
+        f.seek(len(_PngSignature))
+        data = _IterPngData(f, path)
+        while iRow < header.Height:
+            numRows = min(rows_per_strip, header.Height - iRow)
+            while len(pending) < numRows * rowLength:
+                piece = next(data, None)
+                if piece is None:
+                    raise OSError(f"Truncated PNG file {path}, only {iRow} of {header.Height} rows could be read")
+
+                pending += piece
+
+            scanlines = bytes(pending[:numRows * rowLength])
+            del pending[:numRows * rowLength]
+
+            if previousRow is not None:
+                scanlines = b'\x00' + previousRow + scanlines
+
+            rows = _DecodePng(byteWidth, numRows + (previousRow is not None), 8, byteColorType, [], scanlines)
+            if previousRow is not None:
+                rows = rows[1:]
+
+            previousRow = rows[-1].tobytes()
+            if sameFormat:
+                yield rows
+            else:
+                unfiltered = numpy.zeros((numRows, rowLength), dtype=numpy.uint8)
+                unfiltered[:, 1:] = rows.reshape(numRows, header.RowBytes)
+                yield _DecodePng(header.Width, numRows, header.BitDepth, header.ColorType, header.Chunks, unfiltered.tobytes(),
+                                 expand_palette=expand_palette)
+
+            iRow += numRows
+
+
+def IterDecodedStrips(path: str, rows_per_strip: int | None = None,
+                      expand_palette: bool = False) -> typing.Iterator[NDArray]:
+    '''
+    Yield row strips of an image file from the top, holding as little of the image in memory as the format allows.
+
+    * .npy files are memory mapped and the strips are views of the map.
+    * Non-interlaced PNGs, including 16-bit grayscale, are decoded one strip at a time, so images larger
+      than memory can be processed.  Only the strip being decoded is held in memory.
+    * Other formats, including TIFF, interlaced PNGs and 16-bit RGB PNGs, are decoded entirely before the
+      first strip is yielded.
+
+    :param rows_per_strip: Rows in each strip, defaults to rows totaling about DefaultStripPixels pixels
+    :param expand_palette: Yield the colors of palette images, as ReadImagePixels, instead of palette indices
+    '''
+    if IsNumpyFile(path):
+        yield from IterRowStrips(numpy.load(path, mmap_mode='r'), rows_per_strip)
+        return
+
+    header = _ReadPngHeader(path)
+    if header is not None:
+        if rows_per_strip is None:
+            rows_per_strip = max(1, DefaultStripPixels // header.Width)
+
+        yield from _IterPngStrips(path, header, rows_per_strip, expand_palette=expand_palette)
+        return
+
+    image = ReadImagePixels(path) if expand_palette else ReadImageArray(path)
+    for strip in IterRowStrips(image, rows_per_strip):
+        yield numpy.array(strip)
+
+
+def _ReadCachedRegion(path: str, shape: tuple, y0: int, y1: int, x0: int, x1: int,
+                      cache: DecodedStripCache) -> NDArray:
+    '''Read a region from decoded row strips, decoding the image up to the region's last strip if any are not cached'''
+    stats = os.stat(path)
+    rowsPerStrip = max(1, DefaultStripPixels // max(1, shape[1]))
+    iFirst = y0 // rowsPerStrip
+    iLast = (y1 - 1) // rowsPerStrip
+
+    def Key(iStrip):
+        return os.path.abspath(path), stats.st_size, stats.st_mtime_ns, rowsPerStrip, iStrip
+
+    strips = [cache.Get(Key(iStrip)) for iStrip in range(iFirst, iLast + 1)]
+    if any(strip is None for strip in strips):
+        strips = []
+        # Strips above the region are cached and then discarded.  The cache keeps the most recently decoded
+        # strips, those nearest the region, and the region's strips are stored last so they are kept longest.
+        for (iStrip, strip) in enumerate(IterDecodedStrips(path, rowsPerStrip)):
+            cache.Put(Key(iStrip), strip)
+            if iStrip >= iFirst:
+                strips.append(strip)
+
+            if iStrip == iLast:
+                break
+
+    rows = numpy.concatenate(strips, axis=0) if len(strips) > 1 else strips[0]
+    offset = iFirst * rowsPerStrip
+    return numpy.array(rows[y0 - offset:y1 - offset, x0:x1])
+
+
+def _BlockMean(image: NDArray, downsample: int) -> NDArray:
+    '''Average each downsample x downsample block of pixels, blocks at the edge average the pixels they contain'''
+    rows = numpy.arange(0, image.shape[0], downsample)
+    cols = numpy.arange(0, image.shape[1], downsample)
+    sums = numpy.add.reduceat(numpy.add.reduceat(image.astype(numpy.float64), rows, axis=0), cols, axis=1)
+
+    counts = numpy.outer(numpy.minimum(downsample, image.shape[0] - rows), numpy.minimum(downsample, image.shape[1] - cols))
+    if image.ndim > 2:
+        counts = counts.reshape(counts.shape + (1,) * (image.ndim - 2))
+
+    means = sums / counts
+    if numpy.issubdtype(image.dtype, numpy.floating):
+        return means.astype(image.dtype)
+
+    return numpy.floor(means + 0.5).astype(image.dtype)
+
+
+def ReadRegion(path: str, y: int, x: int, height: int, width: int, downsample: int = 1,
+               cache: DecodedStripCache | None = None) -> NDArray:
+    '''
+    Read a rectangle of an image without decoding the whole image where the format allows it.
+
+    * .npy files are memory mapped and only the region is read.
+    * Uncompressed images stored in strips or tiles, such as uncompressed TIFFs, decode only the rows of the strips
+      and tiles the region overlaps.
+    * Other formats are decoded once into row strips kept in a cache.  PNGs that are not interlaced are decoded a
+      strip at a time only as far as the last row of the region, so memory use does not grow with the image.
+
+    :param downsample: Average blocks of downsample x downsample pixels, starting at the corner of the region
+    :param cache: Cache of decoded strips, defaults to DefaultStripCache
+    :return: The region, clipped to the image bounds, with the data type numpy.asarray gives for the image
+    '''
+    if y < 0 or x < 0 or height < 0 or width < 0:
+        raise ValueError(f"Invalid region y={y} x={x} height={height} width={width}")
+
+    if downsample < 1 or int(downsample) != downsample:
+        raise ValueError(f"Downsample must be a positive integer, got {downsample}")
+
+    downsample = int(downsample)
+    if cache is None:
+        cache = DefaultStripCache
+
+    tiles = None
+    if IsNumpyFile(path):
+        image = numpy.load(path, mmap_mode='r')
+        shape = image.shape
+        dtype = image.dtype
+
+        def Read(y0, y1, x0, x1):
+            return numpy.array(image[y0:y1, x0:x1])
+    else:
+        with Image.open(path) as im:
+            # The channels and data type numpy.asarray gives for images of this mode
+            pixel = numpy.asarray(Image.new(im.mode, (1, 1)))
+            shape = (im.height, im.width) + pixel.shape[2:]
+            dtype = pixel.dtype
+            mode = im.mode
+            tiles = _RawTiles(im)
+
+        if tiles is not None:
+            def Read(y0, y1, x0, x1):
+                return _ReadRawRegion(path, mode, tiles, shape, dtype, y0, y1, x0, x1)
+        else:
+            def Read(y0, y1, x0, x1):
+                return _ReadCachedRegion(path, shape, y0, y1, x0, x1, cache)
+
+    y1 = min(y + height, shape[0])
+    x1 = min(x + width, shape[1])
+    y0 = min(y, y1)
+    x0 = min(x, x1)
+
+    if y0 == y1 or x0 == x1:
+        return numpy.empty((y1 - y0, x1 - x0) + shape[2:], dtype=dtype)
+
+    if downsample == 1:
+        return Read(y0, y1, x0, x1)
+
+    # Strips of random access formats are read and averaged one at a time, so memory use depends on the output size
+    if tiles is not None or IsNumpyFile(path):
+        bandRows = downsample * max(1, DefaultStripPixels // max(1, (x1 - x0) * downsample))
+    else:
+        bandRows = y1 - y0
+
+    bands = [_BlockMean(Read(yBand, min(yBand + bandRows, y1), x0, x1), downsample) for yBand in range(y0, y1, bandRows)]
+    return numpy.concatenate(bands, axis=0) if len(bands) > 1 else bands[0]
@@ -20,18 +20,42 @@ Image.MAX_IMAGE_PIXELS = None
 import PIL.ImageOps
 import nornir_pools
 
+from . import chunkedimage
+from . import imageconvert
+from . import imageinfo
+from .imageinfo import GetImageInfoBatch
+from .imageinfocache import ImageInfoCache
+from .imagepipeline import ProcessImages
+from .imagereader import ReadRegion
+from . import imagevalidation
+from . import tilepyramid
+from .tilepyramid import WriteTilesetXML
 from . import prettyoutput
 from . import processoutputinterceptor
 
-def GetImageBpp(path: str):
-    '''Returns how many bits per pixel the image at the provided path uses'''
+def GetImageBpp(path: str, cache: ImageInfoCache | None = None):
+    '''Returns how many bits per pixel the image at the provided path uses, or None if the image cannot be read
+    :param cache: Optional persistent cache of image metadata
+    :raises ValueError: The image does not exist'''
 
     if not os.path.exists(path):
         raise ValueError('GetImageBpp File not found ' + path)
-# 
-#     im = Image.open(path)
-#     return im.bits
-#     
+
+    if cache is not None:
+        bpp = cache.GetImageBpp(path)
+        if bpp is not None:
+            return bpp
+
+    try:
+        return imageinfo.GetImageBpp(path)
+    except PIL.UnidentifiedImageError:
+        return _MagickImageBpp(path)
+    except OSError:
+        return None
+
+
+def _MagickImageBpp(path: str):
+    '''GetImageBpp for formats PIL cannot read'''
     cmd = 'magick identify -format "%z" -verbose ' + path
     proc = subprocess.Popen(cmd + " && exit", shell=True, stdout=subprocess.PIPE)
     proc.wait()
@@ -47,10 +71,21 @@ def GetImageBpp(path: str):
     return bpp
 
 def GetImageColorspace(path: str):
+    '''Returns ImageMagick's name for the colorspace of the image, such as Gray or sRGB, or None if the image cannot be read'''
+    try:
+        return imageinfo.GetImageColorspace(path)
+    except PIL.UnidentifiedImageError:
+        return _MagickImageColorspace(path)
+    except OSError:
+        return None
+
+
+def _MagickImageColorspace(path: str):
+    '''GetImageColorspace for formats PIL cannot read'''
     cmd = 'magick identify -verbose -format "colorspace:%[colorspace]\\n" ' + path
     colorspace = None
     try:
-        proc = subprocess.Popen(cmd + " && exit", shell=True, stdout=subprocess.PIPE)
+        proc = subprocess.Popen(cmd + " && exit", shell=True, stdout=subprocess.PIPE, text=True)
         [stdoutdata, stderrdata] = proc.communicate()
 
         lines = stdoutdata.splitlines()
@@ -67,17 +102,35 @@ def GetImageColorspace(path: str):
 
 
 def GetImageStats(path: str) -> (float, float, float, float):
-    '''Returns [Min, Mean, Max, StdDev] of an image via ImageMagick'''
+    '''Returns (Min, Mean, Max, StdDev) of an image's pixel values, or four Nones if the image cannot be read.
+
+       Values are in the range of the image's data type, so 0-255 for an 8-bit image.  Earlier
+       versions returned ImageMagick's statistics in its quantum range, 0-65535 for every image
+       on a Q16 build, and did not read the image in-process.  Min and Max are now ints for
+       integer images and Mean and StdDev are floats.  Formats PIL cannot read are still
+       measured by ImageMagick, scaled to the range of the image's bit depth.'''
+    try:
+        return imageinfo.GetImageStats(path)
+    except PIL.UnidentifiedImageError:
+        return _MagickImageStats(path)
+    except (OSError, ValueError):
+        return (None, None, None, None)
+
+
+def _MagickImageStats(path: str) -> (float, float, float, float):
+    '''GetImageStats via ImageMagick, scaled to the range of the image's bit depth'''
 
-    cmd = 'magick identify -verbose -format "min:%[min]\\nmean:%[mean]\\nmax:%[max]\\nstandard deviation:%[standard-deviation]\\n" ' + path
+    # fx statistics are normalized to 0-1 whatever quantum depth ImageMagick was built with
+    cmd = 'magick identify -precision 16 -format "min:%[fx:minima]\\nmean:%[fx:mean]\\nmax:%[fx:maxima]\\nstandard deviation:%[fx:standard_deviation]\\ndepth:%z\\n" ' + path
 
     StdDev = None
     Mean = None
     Min = None
     Max = None
+    Depth = None
 
     try:
-        proc = subprocess.Popen(cmd + " && exit", shell=True, stdout=subprocess.PIPE)
+        proc = subprocess.Popen(cmd + " && exit", shell=True, stdout=subprocess.PIPE, text=True)
         (stdoutdata, stderrdata) = proc.communicate()
 
         lines = stdoutdata.splitlines()
@@ -98,15 +151,22 @@ def GetImageStats(path: str) -> (float, float, float, float):
             if Header == 'standard deviation':
                 StdDev = float(Parts[1].strip('()'))
 
+            if Header == 'depth':
+                Depth = int(Parts[1])
+
     except:
         pass
 
-    return (Min, Mean, Max, StdDev)
+    if Depth is None:
+        return (None, None, None, None)
+
+    scale = float((1 << Depth) - 1)
+    return tuple(None if value is None else value * scale for value in (Min, Mean, Max, StdDev))
 
 
 
 def IdentifyImage(ImageFilePath: str):
-    '''Returns all output from identify as a dictionary'''
+    '''Returns all output from identify as a dictionary.  imageinfo.ReadImageInfo reads the common fields without ImageMagick.'''
     cmd = 'magick identify -verbose ' + ImageFilePath
     try:
         NewP = subprocess.Popen(cmd + " && exit", shell=True, stdout=subprocess.PIPE)
@@ -124,9 +184,10 @@ def IsImageNumpyFormat(path: str):
     return '.npy' == ext
 
 
-def GetImageSize(image_param: str | NDArray) -> NDArray[int]:
+def GetImageSize(image_param: str | NDArray, cache: ImageInfoCache | None = None) -> NDArray[int]:
     """
     :param image_param:
+    :param cache: Optional persistent cache of image metadata
     """
 
     # if not os.path.exists(ImageFullPath):
@@ -134,15 +195,23 @@ def GetImageSize(image_param: str | NDArray) -> NDArray[int]:
         
     if isinstance(image_param, numpy.ndarray):
         return image_param.shape
-        
+
     (root, ext) = os.path.splitext(image_param)
     
     im = None
     try:
-        if ext == '.npy':
+        if chunkedimage.IsChunkedImage(image_param):
+            return chunkedimage.ChunkedImage(image_param).Shape
+        elif ext == '.npy':
             im = numpy.load(image_param,'c')
             return im.shape
         else:
+            # Only the size of images PIL reads is cached, the full shape of .npy files is read from their header
+            if cache is not None:
+                size = cache.GetImageSize(image_param)
+                if size is not None:
+                    return size
+
             with Image.open(image_param) as im:
                 shape = (im.size[1], im.size[0])
                 return numpy.array(shape, dtype=numpy.int32)
@@ -152,24 +221,25 @@ def GetImageSize(image_param: str | NDArray) -> NDArray[int]:
         del im
  
 
-def IsValidImage(filename: str) -> bool:
-    ''':return: true/false if passed a single image.  Returns a list of bad images if passed a list.  Return empty list if filename is an empty list'''
-    try:
-        with Image.open(filename) as im:
-            im.verify()
-            im.close()
-    except OSError as os_e:
-        prettyoutput.Log("{0} -> {1}".format(filename, os_e.strerror))
-        return False
-    except Exception as e:
-        prettyoutput.Log("{0} -> {1}".format(filename, str(e)))
+def IsValidImage(filename: str, cache: ImageInfoCache | None = None) -> bool:
+    ''':return: true/false if passed a single image.  Returns a list of bad images if passed a list.  Return empty list if filename is an empty list
+    :param cache: Optional persistent cache of image metadata'''
+    if cache is not None and cache.IsValidImage(filename):
+        return True
+
+    # Images the cache reports as invalid are checked again to log why, the cache does not store the reason
+    error = imageinfo.GetImageError(filename)
+    if error is not None:
+        prettyoutput.Log("{0} -> {1}".format(filename, error))
         return False
     
     return True
 
 
 def AreValidImages(filenames: list[str], ImageDir: str = None, Pool=None):
-    ''':return: true/false if passed a single image.  Returns a list of bad images if passed a list.  Return empty list if filename is an empty list'''
+    ''':return: true/false if passed a single image.  Returns a list of bad images if passed a list.  Return empty list if filename is an empty list
+    :param Pool: Optional nornir_pools pool to run the checks on.  By default imagevalidation checks the images
+                 in a thread pool, use imagevalidation.ValidateImages directly for a full report or a deeper check.'''
 
     filenamelist = filenames
     if not isinstance(filenames, list):
@@ -178,18 +248,21 @@ def AreValidImages(filenames: list[str], ImageDir: str = None, Pool=None):
     if len(filenamelist) == 0:
         return []
     
-    num_threads = multiprocessing.cpu_count() * 2
-    #if num_threads > len(filenames):
-    #    num_threads = len(filenames) + 1
-        
-    if Pool is None:
-        #Pool = nornir_pools.GetThreadPool('IsValidImage {0}'.format(filenamelist[0]), multiprocessing.cpu_count() * 2)
-        #Pool = nornir_pools.GetGlobalLocalMachinePool()
-        Pool = nornir_pools.GetLocalMachinePool("IOBound", num_threads=num_threads)
-
     if ImageDir is None:
         ImageDir = ""
 
+    if Pool is None:
+        imageFilenames = [filename for filename in filenamelist if os.path.splitext(filename)[1] != '.npy']
+        fullPaths = {os.path.join(ImageDir, filename): filename for filename in imageFilenames}
+        report = imagevalidation.ValidateImages(fullPaths.keys(), imagevalidation.ValidationMode.Verify,
+                                                workers=multiprocessing.cpu_count() * 2)
+        for result in report.Results:
+            if not result.Valid:
+                prettyoutput.Log("{0} -> {1}".format(result.Path, result.Error))
+
+        invalid = set(report.InvalidPaths)
+        return [fullPaths[path] for path in fullPaths if path in invalid]
+
     TaskList = []
     SingleParameterProc = None
 
@@ -259,7 +332,11 @@ def InvertImage(input_image_fullpath: str, output_image_fullpath: str):
         inverted_img.save(output_image_fullpath)
         
 
-def ConvertImagesInDict(ImagesToConvertDict, Flip=False, Flop=False, Bpp=None, Invert=False, bDeleteOriginal=False, RightLeftShift=None, AndValue=None, MinMax=None, Async=False):
+# Backends ConvertImagesInDict can convert images with
+ConvertEngines = ('magick', 'native')
+
+
+def ConvertImagesInDict(ImagesToConvertDict, Flip=False, Flop=False, Bpp=None, Invert=False, bDeleteOriginal=False, RightLeftShift=None, AndValue=None, MinMax=None, Async=False, Engine='magick'):
     '''
     The key and value in the dictionary have the full path of an image to convert.
     MinMax is a tuple [Min,Max] passed to the -level parameter if it is not None
@@ -267,15 +344,25 @@ def ConvertImagesInDict(ImagesToConvertDict, Flip=False, Flop=False, Bpp=None, I
     I do not use an and because I do not calculate ImageMagick's quantum size yet.
     Every image must share the same colorspace
     
+    :param str Engine: 'magick' runs ImageMagick on the cluster pool, 'native' converts in a local process
+                       pool with imageconvert.  The native engine always finishes before returning.
     :return: True if images were converted
     :rtype: bool 
     '''
 
+    if Engine not in ConvertEngines:
+        raise ValueError(f"Unknown image conversion engine {Engine}, expected one of {ConvertEngines}")
+
     if len(ImagesToConvertDict) == 0:
         return False
 
     if Bpp is None:
-        Bpp = GetImageBpp(ImagesToConvertDict.keys[0])
+        Bpp = GetImageBpp(list(ImagesToConvertDict.keys())[0])
+
+    if Engine == 'native':
+        return __ConvertImagesInDictNative(ImagesToConvertDict, Flip=Flip, Flop=Flop, Bpp=Bpp, Invert=Invert,
+                                           bDeleteOriginal=bDeleteOriginal, RightLeftShift=RightLeftShift,
+                                           AndValue=AndValue, MinMax=MinMax)
 
     prettyoutput.CurseString('Stage', "ConvertImagesInDict")
     # numProcs = Config.NumProcs * 1.25 #ir-flip spends about half the time loading from disk...
@@ -392,8 +479,52 @@ def ConvertImagesInDict(ImagesToConvertDict, Flip=False, Flop=False, Bpp=None, I
     return len(tasks) > 0
 
 
-def TilesFromImage(ImageFullPath, OutputPath, ImageExt=None, TileSize=None, DownsampleList=None, GridTileCoordFormat=None, Logger=None):
-    '''Create tiles for a single image'''
+def __ConvertImagesInDictNative(ImagesToConvertDict, bDeleteOriginal=False, MinMax=None, **options):
+    '''ConvertImagesInDict using imageconvert instead of ImageMagick'''
+    prettyoutput.CurseString('Stage', "ConvertImagesInDict")
+
+    if MinMax is not None and MinMax[0] > MinMax[1]:
+        prettyoutput.Log("Invalid MinMax parameter passed to ConvertImagesInDict")
+        MinMax = None
+
+    toConvert = {}
+    for (source, target) in ImagesToConvertDict.items():
+        if source == target:
+            if not (options['Flip'] or options['Flop']):
+                # Nothing to do, source and target names match and no flipping required
+                continue
+        elif os.path.exists(target):
+            prettyoutput.Log('Skipping existing file: ' + target)
+            continue
+
+        toConvert[source] = target
+
+    errors = imageconvert.ConvertImages(toConvert, MinMax=MinMax, **options)
+    for (source, error) in errors.items():
+        prettyoutput.LogErr("Failed to convert " + source + ' -> ' + toConvert[source] + ': ' + error)
+
+    if bDeleteOriginal:
+        for (source, target) in toConvert.items():
+            # Don't delete unless the target file was created
+            if source != target and source not in errors and os.path.exists(target):
+                prettyoutput.Log("Deleting: " + source)
+                os.remove(source)
+
+    return len(toConvert) > 0
+
+
+def TilesFromImage(ImageFullPath, OutputPath, ImageExt=None, TileSize=None, DownsampleList=None, GridTileCoordFormat=None, Logger=None, Engine='magick'):
+    '''Create tiles for a single image
+    :param str Engine: 'magick' cuts the first level with ImageMagick.  'native' builds every level of the
+                       DownsampleList with tilepyramid.BuildTilePyramid.
+    :return: (GridDimX, GridDimY) of the first level'''
+
+    if Engine not in ConvertEngines:
+        raise ValueError(f"Unknown image conversion engine {Engine}, expected one of {ConvertEngines}")
+
+    if Engine == 'native':
+        return tilepyramid.BuildTilePyramid(ImageFullPath, OutputPath, TileSize=TileSize, DownsampleList=DownsampleList,
+                                            GridTileCoordFormat=GridTileCoordFormat, ImageExt=ImageExt)
 
     if(GridTileCoordFormat is None):
         GridTileCoordFormat = 'd'
@@ -487,18 +618,6 @@ def TilesFromImage(ImageFullPath, OutputPath, ImageExt=None, TileSize=None, Down
 
     return (XGridDim, YGridDim)
 
-def WriteTilesetXML(XMLOutputPath, XDim, YDim, TileXDim, TileYDim, DownsampleTarget, FilePrefix, FilePostfix=".png"):
-    # Write a new XML file
-    prettyoutput.CurseString('Stage', "WriteTilesetXML : " + XMLOutputPath)
-    with  open(XMLOutputPath, 'w') as newXML:
-
-        newXML.write('<?xml version="1.0" ?> \n')
-        newXML.write('<Level GridDimX=\"' + '%d' % XDim + '\" GridDimY=\"' + '%d' % YDim + 
-                     '\" TileXDim=\"' + '%d' % TileXDim + '\" TileYDim=\"' + '%d' % TileYDim + 
-                     '\" Downsample=\"' + '%d' % DownsampleTarget + '\" FilePrefix=\"' + 
-                     FilePrefix + '\" FilePostfix=\"' + FilePostfix + '\" /> \n')
-    return
-
 
 if __name__ == '__main__':
     print(IsValidImage(' C:\data\\rc2_mini_pipeline\\TEM\\0022\TEM\Raw8\TilePyramid\\004\\007.png'))
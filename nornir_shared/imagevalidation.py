@@ -0,0 +1,186 @@
+'''
+Check many image files for damage using a thread or process pool.
+
+Three levels of checking are offered, from cheapest to most thorough:
+
+* ``Header``: The file exists, is not empty, and its header can be read with a non-zero size.
+* ``Verify``: PIL's verify, which checks the file structure and the PNG chunk CRCs without decoding.
+  This is what images.IsValidImage has always done.
+* ``Deep``: Verify, then decode every pixel, which finds truncated or corrupt compressed data.
+
+Results are yielded as each file finishes, and a ValidationReport collects them.
+'''
+from __future__ import annotations
+
+import concurrent.futures
+import enum
+import os
+import typing
+
+import numpy
+
+from PIL import Image
+
+from nornir_shared import imageinfo
+from nornir_shared import imagereader
+
+
+class ValidationMode(enum.Enum):
+    Header = 'header'
+    Verify = 'verify'
+    Deep = 'deep'
+
+
+class ValidationResult(object):
+    '''The outcome of validating one image'''
+
+    def __init__(self, path: str, valid: bool, error: str | None = None, info: imageinfo.ImageInfo | None = None):
+        self.Path = path
+        self.Valid = valid
+        self.Error = error
+        self.Info = info
+
+    def __str__(self):
+        return f'{self.Path}: valid' if self.Valid else f'{self.Path}: {self.Error}'
+
+
+class ValidationReport(object):
+    '''The results of validating many images, in the order they completed'''
+
+    def __init__(self, mode: ValidationMode, results: list[ValidationResult] | None = None, stopped_early: bool = False):
+        self.Mode = mode
+        self.Results = [] if results is None else results
+        self.StoppedEarly = stopped_early
+
+    def __len__(self):
+        return len(self.Results)
+
+    @property
+    def AllValid(self) -> bool:
+        return all(r.Valid for r in self.Results)
+
+    @property
+    def ValidPaths(self) -> list[str]:
+        return [r.Path for r in self.Results if r.Valid]
+
+    @property
+    def InvalidPaths(self) -> list[str]:
+        return [r.Path for r in self.Results if not r.Valid]
+
+    @property
+    def Errors(self) -> dict[str, str]:
+        ''':return: The error message of each invalid image, by path'''
+        return {r.Path: r.Error for r in self.Results if not r.Valid}
+
+    def __str__(self):
+        s = f'Validated {len(self.Results)} images in {self.Mode.value} mode, {len(self.InvalidPaths)} invalid'
+        if self.StoppedEarly:
+            s += ', stopped at the first invalid image'
+
+        for r in self.Results:
+            if not r.Valid:
+                s += '\n' + str(r)
+
+        return s
+
+
+def _DecodeNumpy(path: str):
+    '''Read every value of a .npy file, which fails if the file is shorter than its header declares'''
+    image = numpy.load(path, mmap_mode='r')
+    for strip in imagereader.IterRowStrips(image):
+        numpy.asarray(strip).sum()
+
+
+def ValidateImage(path: str, mode: ValidationMode = ValidationMode.Verify) -> ValidationResult:
+    ''':return: The result of checking one image file, never raises for damaged or missing files'''
+    mode = ValidationMode(mode)
+
+    try:
+        if os.path.getsize(path) == 0:
+            return ValidationResult(path, False, 'File is empty')
+
+        info = imageinfo.ReadImageInfo(path)
+        if info.Width <= 0 or info.Height <= 0:
+            return ValidationResult(path, False, f'Invalid dimensions {info.Width}x{info.Height}', info)
+
+        if mode == ValidationMode.Header:
+            return ValidationResult(path, True, info=info)
+
+        if imagereader.IsNumpyFile(path):
+            if mode == ValidationMode.Deep:
+                _DecodeNumpy(path)
+
+            return ValidationResult(path, True, info=info)
+
+        with Image.open(path) as im:
+            im.verify()
+
+        if mode == ValidationMode.Deep:
+            # verify leaves the image unusable, so it is opened again to decode the pixels
+            with Image.open(path) as im:
+                im.load()
+
+    except Exception as e:
+        message = e.strerror if isinstance(e, OSError) and e.strerror else str(e)
+        return ValidationResult(path, False, f'{type(e).__name__}: {message}')
+
+    return ValidationResult(path, True, info=info)
+
+
+def IterValidateImages(paths: typing.Iterable[str], mode: ValidationMode = ValidationMode.Verify,
+                       workers: int | None = None, use_processes: bool = False,
+                       stop_on_first_invalid: bool = False) -> typing.Iterator[ValidationResult]:
+    '''
+    Validate images in a pool, yielding each result as it completes.  At most a few tasks per
+    worker are queued at once, so stopping early does not wait for every file to be checked.
+    :param workers: Number of threads or processes, defaults to the executor defaults
+    :param use_processes: Use a process pool, which helps Deep mode decode in parallel
+    :param stop_on_first_invalid: Stop validating once an invalid image is found
+    '''
+    mode = ValidationMode(mode)
+    paths = iter(paths)
+
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # The number of workers the executor chose when workers is None
+    maxPending = max(1, executor._max_workers * 4)
+    pending = set()
+    try:
+        while True:
+            for path in paths:
+                pending.add(executor.submit(ValidateImage, path, mode))
+                if len(pending) >= maxPending:
+                    break
+
+            if len(pending) == 0:
+                return
+
+            (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                yield result
+
+                if stop_on_first_invalid and not result.Valid:
+                    return
+    finally:
+        for future in pending:
+            future.cancel()
+
+        executor.shutdown(wait=True)
+
+
+def ValidateImages(paths: typing.Iterable[str], mode: ValidationMode = ValidationMode.Verify,
+                   workers: int | None = None, use_processes: bool = False,
+                   stop_on_first_invalid: bool = False) -> ValidationReport:
+    ''':return: A report of validating every image, see IterValidateImages for the parameters'''
+    mode = ValidationMode(mode)
+    report = ValidationReport(mode)
+    for result in IterValidateImages(paths, mode, workers, use_processes, stop_on_first_invalid):
+        report.Results.append(result)
+        if stop_on_first_invalid and not result.Valid:
+            report.StoppedEarly = True
+
+    return report
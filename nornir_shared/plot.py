@@ -126,8 +126,6 @@ def Histogram(HistogramOrFilename, ImageFilename=None, MinCutoffPercent=None,
         else:
             [MinCutoff, MaxCutoff] = Hist.AutoLevel(MinCutoffPercent, MaxCutoffPercent)
 
-    BinValues = [(float(x) * float(Hist.BinWidth) + Hist.MinValue) for x in range(0, Hist.NumBins)]
-
     if len(Hist.Bins) != Hist.NumBins:
         return
 
@@ -141,20 +139,44 @@ def Histogram(HistogramOrFilename, ImageFilename=None, MinCutoffPercent=None,
     if ShowCutoffs:
         prettyoutput.Log(f'Histogram cutoffs: {MinCutoff},{MaxCutoff}')
 
-    yMax = max(Hist.Bins)
-#  print 'Bins: ' + str(Hist.Bins)
-#  print 'Bin Sum: ' + str(sum(Hist.Bins))
-
-    # print Hist.Bins
     plt.clf()
-    plt.bar(BinValues, Hist.Bins, color='blue', edgecolor=None, linewidth=0, width=Hist.BinWidth)
+    plt.gcf().set_dpi(150)
     plt.title(Title)
     plt.ylabel(ylabel)
     plt.xlabel(xlabel)
     # plt.xticks([])
     plt.yticks([])
+
+    width_pixels, height_pixels = GetPlotSizeInPixels(plt.gcf(), plt.gca())
+
+    visible_min_x, visible_max_x = None, None
+    if minX is None or maxX is None:
+        #If we do not have enough horizontal space to display the entire histogram, attempt to trim it to the visible region
+        if width_pixels < (Hist.MaxValue - Hist.MinValue) / Hist.BinWidth:
+            visible_min_x, visible_max_x = Hist.XAxis_Extrema_Using_Threshold(height_pixels, max_width=width_pixels)
+        else:
+            visible_min_x, visible_max_x = Hist.MinValue, Hist.MaxValue
+
+    if minX is None:
+        options = LinePosList + [visible_min_x]
+        minX = min(options)
+
+    if maxX is None:
+        options = LinePosList + [visible_max_x]
+        maxX = max(options)
     
-    
+    #adjust range to a power of two 
+    if range_is_power_of_two:
+        minX, maxX = EnsureAxisLimitsArePowerOfTwo(minX, maxX)
+
+    #Draw from the pyramid level with about one bin per horizontal pixel across the visible range
+    visible_fraction = max(maxX - minX, Hist.BinWidth) / (Hist.BinWidth * Hist.NumBins)
+    PlotHist = Hist.ForResolution(width_pixels / visible_fraction)
+    BinValues = (numpy.arange(PlotHist.NumBins) * PlotHist.BinWidth) + PlotHist.MinValue
+
+    yMax = PlotHist.BinArray.max()
+    plt.bar(BinValues, PlotHist.BinArray, color='blue', edgecolor=None, linewidth=0, width=PlotHist.BinWidth)
+
     # For a time ticks were rendering very slowly, this turned out to be specific to numpy.linalg.inv on Python 2.7.6
 
     if ShowCutoffs:
@@ -186,31 +208,7 @@ def Histogram(HistogramOrFilename, ImageFilename=None, MinCutoffPercent=None,
                     
             plt.plot([linePos, linePos], [0, yMax], color=color)
             plt.annotate(f'{linePos:g}', [linePos, yMax * 0.9])
-            
-    plt.gcf().set_dpi(150)
-
-    visible_min_x, visible_max_x = None, None
-    if minX is None or maxX is None:
-        
-        width_pixels, height_pixels = GetPlotSizeInPixels(plt.gcf(), plt.gca())
-        #If we do not have enough horizontal space to display the entire histogram, attempt to trim it to the visible region
-        if width_pixels < (Hist.MaxValue - Hist.MinValue) / Hist.BinWidth:
-            visible_min_x, visible_max_x = Hist.XAxis_Extrema_Using_Threshold(height_pixels)
-        else:
-            visible_min_x, visible_max_x = Hist.MinValue, Hist.MaxValue
 
-    if minX is None:
-        options = LinePosList + [visible_min_x]
-        minX = min(options)
-
-    if maxX is None:
-        options = LinePosList + [visible_max_x]
-        maxX = max(options)
-    
-    #adjust range to a power of two 
-    if range_is_power_of_two:
-        minX, maxX = EnsureAxisLimitsArePowerOfTwo(minX, maxX)
-        
     plt.xlim([minX - Hist.BinWidth, maxX + Hist.BinWidth])
 
     if ImageFilename is not None:
@@ -103,7 +103,7 @@ def CurseString(topic, text):
         y = 0
         x = 0
 
-        if (cursesCoords.has_key(topic)):
+        if topic in cursesCoords:
             y = cursesCoords[topic]
 
         (yMax, xMax) = statusWindow.getmaxyx()
@@ -0,0 +1,252 @@
+'''
+Build a pyramid of image tiles in-process, the native engine of images.TilesFromImage.
+
+The source image is read in bands of one tile row with imagereader.IterDecodedStrips.  .npy
+files are memory mapped and non-interlaced PNGs are decoded one band at a time, so neither is
+held in memory.  Other formats, such as TIFF, are decoded entirely before the first band.  Each
+band is cut into tiles for the first level and reduced by a 2x2 box filter into the rows of the
+next level, which passes its own rows up the pyramid in the same way.  Every level in the
+DownsampleList is written in a single pass over the source while at most one tile row of each
+level is held in memory.  Tiles are encoded and written by a thread pool.
+
+Each level is written to a directory named by its downsample, along with an XML file describing
+the tile grid which is written after every tile of the level.
+'''
+from __future__ import annotations
+
+import concurrent.futures
+import math
+import os
+
+import numpy
+from numpy.typing import NDArray
+
+from PIL import Image
+
+from nornir_shared import files
+from nornir_shared import imageconvert
+from nornir_shared import imageinfo
+from nornir_shared import imagereader
+from nornir_shared import prettyoutput
+
+DefaultDownsampleList = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+DefaultTileSize = (256, 256)
+
+
+def WriteTilesetXML(XMLOutputPath, XDim, YDim, TileXDim, TileYDim, DownsampleTarget, FilePrefix, FilePostfix=".png"):
+    # Write a new XML file
+    prettyoutput.CurseString('Stage', "WriteTilesetXML : " + XMLOutputPath)
+    with  open(XMLOutputPath, 'w') as newXML:
+
+        newXML.write('<?xml version="1.0" ?> \n')
+        newXML.write('<Level GridDimX=\"' + '%d' % XDim + '\" GridDimY=\"' + '%d' % YDim +
+                     '\" TileXDim=\"' + '%d' % TileXDim + '\" TileYDim=\"' + '%d' % TileYDim +
+                     '\" Downsample=\"' + '%d' % DownsampleTarget + '\" FilePrefix=\"' +
+                     FilePrefix + '\" FilePostfix=\"' + FilePostfix + '\" /> \n')
+    return
+
+
+def BoxReduce(image: NDArray) -> NDArray:
+    '''
+    Halve the size of an image by averaging each 2x2 block of pixels, rounding to the nearest integer.
+    An odd last row or column is averaged with itself.
+    '''
+    if image.shape[0] % 2:
+        image = numpy.concatenate((image, image[-1:]), axis=0)
+    if image.shape[1] % 2:
+        image = numpy.concatenate((image, image[:, -1:]), axis=1)
+
+    total = image[0::2, 0::2].astype(numpy.uint32) + image[1::2, 0::2] + image[0::2, 1::2] + image[1::2, 1::2]
+    return ((total + 2) // 4).astype(image.dtype)
+
+
+class _PyramidLevel(object):
+    '''Rows of one pyramid level waiting to be cut into tiles or reduced into the next level'''
+
+    def __init__(self, downsample: int, directory: str, height: int, width: int, tile_size: tuple[int, int]):
+        self.Downsample = downsample
+        self.Directory = directory
+        self.Height = height
+        self.Width = width
+        self.TileSize = tile_size
+        self.GridDimX = int(math.ceil(width / tile_size[0]))
+        self.GridDimY = int(math.ceil(height / tile_size[1]))
+
+        # Number of 2x2 reductions from this level to the next, zero for the last level
+        self.Reductions = 0
+        self.Next = None
+
+        self._tileRows = []
+        self._numTileRows = 0
+        self._iTileRow = 0
+
+        # Rows of each reduction waiting for a partner row
+        self._carry = []
+
+    @property
+    def XMLPath(self) -> str:
+        return os.path.join(self.Directory, str(self.Downsample) + '.xml')
+
+    def Add(self, rows: NDArray, write_tile):
+        '''Add rows to the level, writing each tile row that is complete'''
+        self._tileRows.append(rows)
+        self._numTileRows += rows.shape[0]
+        while self._numTileRows >= self.TileSize[1]:
+            self._WriteTileRow(write_tile)
+
+        if self.Next is not None:
+            for iReduction in range(self.Reductions):
+                rows = numpy.concatenate((self._carry[iReduction], rows), axis=0)
+                numPairedRows = rows.shape[0] - (rows.shape[0] % 2)
+                self._carry[iReduction] = rows[numPairedRows:]
+                rows = BoxReduce(rows[:numPairedRows])
+
+            if rows.shape[0] > 0:
+                self.Next.Add(rows, write_tile)
+
+    def Flush(self, write_tile):
+        '''Write the last, partial, tile row and pass any unpaired rows to the next level'''
+        if self._numTileRows > 0:
+            self._WriteTileRow(write_tile)
+
+        if self.Next is not None:
+            rows = None
+            for iReduction in range(self.Reductions):
+                if rows is not None:
+                    rows = numpy.concatenate((self._carry[iReduction], rows), axis=0)
+                else:
+                    rows = self._carry[iReduction]
+
+                self._carry[iReduction] = rows[:0]
+                rows = BoxReduce(rows) if rows.shape[0] > 0 else rows
+
+            if rows is not None and rows.shape[0] > 0:
+                self.Next.Add(rows, write_tile)
+
+            self.Next.Flush(write_tile)
+
+    def _WriteTileRow(self, write_tile):
+        rows = numpy.concatenate(self._tileRows, axis=0)
+        (tileWidth, tileHeight) = self.TileSize
+        tileRow = rows[:tileHeight]
+        remaining = rows[tileHeight:]
+        self._tileRows = [remaining] if remaining.shape[0] > 0 else []
+        self._numTileRows = remaining.shape[0]
+
+        # Edge tiles are padded with black to the full tile size
+        paddedWidth = self.GridDimX * tileWidth
+        if tileRow.shape[0] < tileHeight or tileRow.shape[1] < paddedWidth:
+            padded = numpy.zeros((tileHeight, paddedWidth), dtype=tileRow.dtype)
+            padded[:tileRow.shape[0], :tileRow.shape[1]] = tileRow
+            tileRow = padded
+
+        for iX in range(self.GridDimX):
+            write_tile(self, iX, self._iTileRow, tileRow[:, iX * tileWidth:(iX + 1) * tileWidth])
+
+        self._iTileRow += 1
+
+
+def _PyramidLevels(OutputPath: str, height: int, width: int, TileSize: tuple[int, int],
+                   DownsampleList: list[int]) -> list[_PyramidLevel]:
+    levels = []
+    for downsample in DownsampleList:
+        scale = downsample // DownsampleList[0]
+        if downsample % DownsampleList[0] or scale & (scale - 1):
+            raise ValueError(f"Downsample {downsample} is not a power of two multiple of the first level {DownsampleList[0]}")
+
+        # Each 2x2 reduction rounds up, as BoxReduce keeps an odd last row and column
+        numReductions = scale.bit_length() - 1
+        levelHeight = height
+        levelWidth = width
+        for i in range(numReductions):
+            levelHeight = (levelHeight + 1) // 2
+            levelWidth = (levelWidth + 1) // 2
+
+        directory = os.path.join(OutputPath, files.DownsampleFormat % downsample)
+        level = _PyramidLevel(downsample, directory, levelHeight, levelWidth, TileSize)
+        level.Reductions = numReductions
+        levels.append(level)
+
+    for (level, nextLevel) in zip(levels[:-1], levels[1:]):
+        level.Next = nextLevel
+        level.Reductions = nextLevel.Reductions - level.Reductions
+        level._carry = [numpy.zeros((0, int(math.ceil(level.Width / (1 << i)))), dtype=numpy.uint8)
+                        for i in range(level.Reductions)]
+
+    levels[-1].Reductions = 0
+    return levels
+
+
+def BuildTilePyramid(ImageFullPath: str, OutputPath: str, TileSize: tuple[int, int] | None = None,
+                     DownsampleList: list[int] | None = None, GridTileCoordFormat: str | None = None,
+                     ImageExt: str | None = None, workers: int | None = None) -> tuple[int, int]:
+    '''
+    Cut an image into 8-bit grayscale tiles for every level of the DownsampleList.  The image is the
+    first level of the pyramid, each later level must be a power of two multiple of the first.
+    Levels whose XML file is newer than the image are not rebuilt.
+    :param TileSize: (Width, Height) of the tiles
+    :param workers: Number of threads writing tiles
+    :return: (GridDimX, GridDimY) of the first level
+    '''
+    if GridTileCoordFormat is None:
+        GridTileCoordFormat = 'd'
+
+    if ImageExt is None:
+        ImageExt = 'png'
+
+    if TileSize is None:
+        TileSize = DefaultTileSize
+
+    if DownsampleList is None:
+        DownsampleList = DefaultDownsampleList
+
+    TileSize = (int(TileSize[0]), int(TileSize[1]))
+    DownsampleList = sorted(DownsampleList)
+    GridTileNameTemplate = 'X%(X)' + GridTileCoordFormat + '_Y%(Y)' + GridTileCoordFormat + '.' + ImageExt
+
+    info = imageinfo.ReadImageInfo(ImageFullPath)
+    levels = _PyramidLevels(OutputPath, info.Height, info.Width, TileSize, DownsampleList)
+
+    for level in levels:
+        files.RemoveOutdatedFile(ImageFullPath, level.XMLPath)
+
+    if all(os.path.exists(level.XMLPath) for level in levels):
+        return levels[0].GridDimX, levels[0].GridDimY
+
+    prettyoutput.CurseString('Stage', "Tiles from Image")
+    for level in levels:
+        os.makedirs(level.Directory, exist_ok=True)
+
+    # PIL releases the GIL while compressing tiles
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        maxPending = max(1, executor._max_workers * 4)
+        pending = set()
+
+        def WriteTile(level: _PyramidLevel, iX: int, iY: int, tile: NDArray):
+            nonlocal pending
+            if len(pending) >= maxPending:
+                (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+            path = os.path.join(level.Directory, GridTileNameTemplate % {'X': iX, 'Y': iY})
+            pending.add(executor.submit(_SaveTile, numpy.ascontiguousarray(tile), path))
+
+        for strip in imagereader.IterDecodedStrips(ImageFullPath, rows_per_strip=TileSize[1], expand_palette=True):
+            levels[0].Add(imageconvert.ConvertImageArray(strip, Bpp=8), WriteTile)
+
+        levels[0].Flush(WriteTile)
+
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+
+    for level in levels:
+        WriteTilesetXML(level.XMLPath, level.GridDimX, level.GridDimY, TileSize[0], TileSize[1], level.Downsample,
+                        "", FilePostfix='.' + ImageExt)
+
+    return levels[0].GridDimX, levels[0].GridDimY
+
+
+def _SaveTile(tile: NDArray, path: str):
+    # -quality 106, zlib level 1 with adaptive filtering, as the ImageMagick tiles were written
+    Image.fromarray(tile).save(path, compress_level=1)
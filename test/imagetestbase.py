@@ -0,0 +1,43 @@
+'''
+Base class for tests that write images and other files to the test output directory
+'''
+import os
+import shutil
+import unittest
+
+import numpy
+
+
+class ImageTestBase(unittest.TestCase):
+    '''
+    Each test starts with an empty directory under TESTOUTPUTPATH, named for the test module and
+    class, and a random number generator with a fixed seed so test images are identical every run.
+    '''
+
+    @property
+    def classname(self):
+        return str(self.__class__.__name__)
+
+    @property
+    def TestOutputPath(self):
+        if 'TESTOUTPUTPATH' in os.environ:
+            moduleName = self.__class__.__module__.split('.')[-1]
+            return os.path.join(os.environ["TESTOUTPUTPATH"], moduleName, self.classname)
+        else:
+            self.fail("TESTOUTPUTPATH environment variable should specify test output directory")
+
+        return None
+
+    def setUp(self):
+        self.OutputDir = self.TestOutputPath
+        if os.path.exists(self.OutputDir):
+            shutil.rmtree(self.OutputDir)
+
+        os.makedirs(self.OutputDir)
+        self.Rng = numpy.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.OutputDir, ignore_errors=True)
+
+    def _Path(self, *names):
+        return os.path.join(self.OutputDir, *names)
@@ -0,0 +1,78 @@
+'''
+Tests for images stored as chunked .npy directories
+'''
+import json
+import os
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_shared import chunkedimage
+from nornir_shared.chunkedimage import ChunkedImage
+
+from test.imagetestbase import ImageTestBase
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.Image = self.Rng.integers(0, 1 << 16, size=(250, 330), dtype=numpy.uint16)
+
+    def testReadWrite(self):
+        path = self._Path('section' + chunkedimage.ChunkedImageExtension)
+        store = ChunkedImage.Create(path, self.Image.shape, numpy.uint16, chunk_shape=(64, 100), fill_value=7)
+        self.assertTrue(chunkedimage.IsChunkedImage(path))
+        self.assertEqual(store.GridShape, (4, 4))
+
+        with open(os.path.join(path, chunkedimage.HeaderFilename)) as f:
+            header = json.load(f)
+        self.assertEqual(header['shape'], [250, 330])
+        self.assertEqual(header['chunk_shape'], [64, 100])
+
+        # Unwritten chunks read as the fill value
+        self.assertTrue((store.Read() == 7).all())
+
+        # A region spanning partial chunks, some of which do not exist yet
+        store.WriteRegion(30, 90, self.Image[30:200, 90:250])
+        expected = numpy.full(self.Image.shape, 7, dtype=numpy.uint16)
+        expected[30:200, 90:250] = self.Image[30:200, 90:250]
+
+        reopened = ChunkedImage(path)
+        self.assertEqual(reopened.Dtype, numpy.uint16)
+        self.assertTrue(numpy.array_equal(reopened.Read(), expected))
+        self.assertTrue(numpy.array_equal(reopened.ReadRegion(60, 80, 50, 50), expected[60:110, 80:130]))
+
+        # Regions are clipped to the image, edge chunks are only as large as the image
+        self.assertEqual(reopened.ReadRegion(240, 320, 100, 100).shape, (10, 10))
+        self.assertEqual(reopened.ReadChunk(3, 3).shape, (250 - 192, 330 - 300))
+
+        store.Write(self.Image)
+        self.assertTrue(numpy.array_equal(store.Read(), self.Image))
+        self.assertEqual(sorted(name for name in os.listdir(path) if name.startswith('.tmp_')), [])
+
+        self.assertRaises(ValueError, store.WriteRegion, 200, 300, self.Image[:100, :100])
+        self.assertRaises(ValueError, store.ReadRegion, -1, 0, 10, 10)
+        self.assertRaises(FileExistsError, ChunkedImage.Create, path, (10, 10), numpy.uint8)
+
+        store = ChunkedImage.Create(path, (10, 10), numpy.uint8, overwrite=True)
+        self.assertTrue((store.Read() == 0).all())
+
+    def testFromImage(self):
+        rgb = numpy.random.default_rng(1).integers(0, 256, size=(90, 70, 3), dtype=numpy.uint8)
+        numpy.save(self._Path('gray16.npy'), self.Image)
+        for (name, pixels) in [('gray16.png', self.Image), ('rgb.png', rgb), ('gray16.npy', self.Image)]:
+            if name.endswith('.png'):
+                Image.fromarray(pixels).save(self._Path(name))
+            store = chunkedimage.FromImage(self._Path(name), self._Path(name + '.npyc'), chunk_shape=(32, 32))
+            self.assertEqual(store.Shape, pixels.shape)
+            self.assertTrue(numpy.array_equal(ChunkedImage(self._Path(name + '.npyc')).Read(), pixels))
+
+        self.assertRaises(FileNotFoundError, ChunkedImage, self._Path('missing.npyc'))
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -3,8 +3,11 @@ Created on Mar 5, 2013
 
 @author: u0490822
 '''
+import os
 import unittest
 
+import numpy
+
 from nornir_shared.histogram import *
 
 
@@ -287,6 +290,428 @@ class Test(unittest.TestCase):
         self.assertEqual(MinCutoff, 0)
         self.assertEqual(MaxCutoff, maxVal)
 
+    def testHistogramArrayStorage(self):
+        '''Bins are stored in a numpy array but still behave as a list'''
+        import pickle
+
+        binVals = list(range(0, 256))
+        hist = Histogram.Init(minVal=0, maxVal=255, binVals=binVals)
+        self.assertIsInstance(hist.BinArray, numpy.ndarray)
+        self.assertEqual(hist.BinArray.dtype, numpy.int64)
+        self.assertEqual(hist.Bins, binVals)
+        self.assertEqual(hist.Bins[0:4], [0, 1, 2, 3])
+        self.assertEqual(max(hist.Bins), 255)
+        self.assertEqual(sum(hist.Bins), hist.NumSamples)
+
+        hist.Bins[0] = 10
+        self.assertEqual(hist.BinArray[0], 10)
+
+        restored = pickle.loads(pickle.dumps(hist))
+        self.assertEqual(restored.Bins, hist.Bins)
+        self.assertEqual(restored.NumSamples, hist.NumSamples)
+
+        # Old pickles stored the bins as a list
+        restored = Histogram()
+        restored.__setstate__({'MinValue': 0, 'MaxValue': 255, 'NumBins': 256, 'NumSamples': sum(binVals), 'Bins': binVals})
+        self.assertEqual(restored.Bins, binVals)
+        self.assertEqual(restored.Median(), Histogram.Init(minVal=0, maxVal=255, binVals=binVals).Median())
+
+        # Arrays made from the bins are copies and BinArray is read-only, so neither can make cached statistics stale
+        (cumulative, median, mean) = (hist.CumulativeBins.copy(), hist.Median(), hist.Mean())
+        copied = numpy.array(hist.Bins)
+        copied[0] = 99
+        self.assertEqual(hist.Bins[0], 10)
+        self.assertTrue(numpy.array_equal(hist.CumulativeBins, cumulative))
+        self.assertEqual((hist.Median(), hist.Mean()), (median, mean))
+        self.assertEqual(hist.Median(), Histogram.Init(minVal=0, maxVal=255, binVals=hist.Bins).Median())
+        self.assertRaises(ValueError, hist.BinArray.__setitem__, 0, 99)
+
+        other = Histogram.Init(minVal=0, maxVal=255, binVals=hist.BinArray)
+        other.Bins[1] = 5
+        self.assertEqual(hist.Bins[1], 1)
+
+    def testHistogramAddArray(self):
+        '''AddArray should produce the same bins as adding values one at a time, including clamping'''
+
+        image = numpy.arange(-64, 1 << 16, 61, dtype=numpy.int32).reshape((-1, 1))
+        minVal = 0
+        maxVal = (1 << 16) - 1
+        numBins = 1024
+
+        expected = Histogram.Init(minVal=minVal, maxVal=maxVal, numBins=numBins)
+        for value in image.flat:
+            expected.IncrementBin(value, 1)
+
+        hist = Histogram.Init(minVal=minVal, maxVal=maxVal, numBins=numBins)
+        hist.AddArray(image)
+        self.assertEqual(hist.Bins, expected.Bins)
+        self.assertEqual(hist.NumSamples, image.size)
+
+        hist = Histogram.Init(minVal=minVal, maxVal=maxVal, numBins=numBins)
+        hist.AddArray(image.astype(numpy.float64) + 0.5)
+        self.assertEqual(hist.Bins, expected.Bins)
+
+        hist = Histogram.FromImageArray(numpy.clip(image, 0, maxVal).astype(numpy.uint16), numBins=numBins)
+        self.assertEqual(hist.MinValue, minVal)
+        self.assertEqual(hist.MaxValue, maxVal)
+        self.assertEqual(hist.Bins, expected.Bins)
+
+        self.assertRaises(ValueError, hist.AddArray, numpy.array([numpy.nan]))
+        self.assertRaises(ValueError, Histogram.FromImageArray, image.astype(numpy.float32))
+
+    def testHistogramFromImageFiles(self):
+        '''Histograms built from image files in strips should match one built from the pixels in memory'''
+        import tempfile
+        from PIL import Image
+        import nornir_shared.imagereader as imagereader
+
+        rng = numpy.random.default_rng(0)
+        tiles = [rng.integers(0, 256, size=(300, 200), dtype=numpy.uint8) for i in range(3)]
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = []
+            for i, tile in enumerate(tiles):
+                path = os.path.join(tempdir, f'{i}.npy' if i % 2 else f'{i}.png')
+                if path.endswith('.npy'):
+                    numpy.save(path, tile)
+                else:
+                    Image.fromarray(tile).save(path)
+                paths.append(path)
+
+            strips = list(imagereader.IterRowStrips(paths[0], rows_per_strip=64))
+            self.assertEqual(len(strips), 5)
+            self.assertTrue(numpy.array_equal(numpy.concatenate(strips), tiles[0]))
+
+            hist = FromImageFiles(paths, 0, 255, 64)
+
+            parallel_hist = BuildParallel(paths * 3, 0, 255, 64, workers=2)
+            shared_hist = BuildParallel(paths * 3, 0, 255, 64, workers=2, use_shared_memory=True)
+
+        expected = Histogram.FromImageArray(numpy.stack(tiles), numBins=64)
+        self.assertEqual(hist.Bins, expected.Bins)
+        self.assertEqual(hist.NumSamples, sum(t.size for t in tiles))
+
+        self.assertEqual(parallel_hist.BinArray.tolist(), (expected.BinArray * 3).tolist())
+        self.assertEqual(parallel_hist.NumSamples, expected.NumSamples * 3)
+        self.assertEqual(shared_hist.Bins, parallel_hist.Bins)
+
+    def testHistogramCumulativeCache(self):
+        '''Percentile queries use a cached cumulative count that must be rebuilt when bins change'''
+
+        def assertMatchesUncached(hist):
+            uncached = Histogram.Init(minVal=hist.MinValue, maxVal=hist.MaxValue, binVals=list(hist.Bins))
+            self.assertEqual(hist.CumulativeBins[-1], sum(hist.Bins))
+            self.assertEqual(hist.Median(), uncached.Median())
+            self.assertEqual(hist.Median(64, 192), uncached.Median(64, 192))
+            self.assertEqual(hist.AutoLevel(0.1, 0.1), uncached.AutoLevel(0.1, 0.1))
+
+        hist = Histogram.Init(minVal=0, maxVal=255, binVals=[10] * 256)
+        self.assertEqual(hist.Median(), 127.5)
+        assertMatchesUncached(hist)
+
+        hist.IncrementBin(0, 2560)
+        assertMatchesUncached(hist)
+
+        hist.Add([255] * 5000)
+        assertMatchesUncached(hist)
+
+        hist.AddHistogram([0] * 128 + [100] * 128)
+        assertMatchesUncached(hist)
+
+        hist.Bins[0] = 0
+        assertMatchesUncached(hist)
+
+    def testHistogramSaveLoad(self):
+        '''Histograms saved in XML and binary formats should load identically'''
+        import tempfile
+
+        hist = Histogram.Init(minVal=0, maxVal=(1 << 16) - 1, numBins=1024)
+        hist.AddArray(numpy.arange(0, 1 << 16, 7))
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            for filename in ['hist.xml', 'hist' + BinaryExtension]:
+                path = os.path.join(tempdir, filename)
+                hist.Save(path)
+                loaded = Histogram.Load(path)
+                self.assertEqual(loaded.Bins, hist.Bins)
+                self.assertEqual(loaded.NumBins, hist.NumBins)
+                self.assertEqual(loaded.NumSamples, hist.NumSamples)
+                self.assertEqual(loaded.MinValue, hist.MinValue)
+                self.assertEqual(loaded.MaxValue, hist.MaxValue)
+                self.assertEqual(loaded.AutoLevel(0.1, 0.1), hist.AutoLevel(0.1, 0.1))
+
+            self.assertIsNone(Histogram.Load(os.path.join(tempdir, 'missing' + BinaryExtension)))
+
+            # Both formats return None when the number of bins does not match NumBins
+            badBinary = os.path.join(tempdir, 'bad' + BinaryExtension)
+            numpy.savez(badBinary, MinValue=0, MaxValue=255, NumBins=8, NumSamples=3, Bins=numpy.ones(3, dtype=numpy.int64))
+            badXML = os.path.join(tempdir, 'bad.xml')
+            with open(badXML, 'w') as f:
+                f.write('<Histogram NumBins="8" NumSamples="3" MinValue="0" MaxValue="255"><Channel>1 1 1</Channel></Histogram>')
+
+            self.assertIsNone(Histogram.Load(badBinary))
+            self.assertIsNone(Histogram.Load(badXML))
+
+    def testHistogramXML(self):
+        '''XML output must stay byte compatible with the minidom based writer used by earlier versions'''
+
+        hist = Histogram.Init(minVal=0, maxVal=255, numBins=4, binVals=[1, 2, 3, 4])
+        expected = '<?xml version="1.0" ?>\n' \
+                   '<Histogram NumBins="4" NumSamples="10" MinValue="0" MaxValue="255">\n' \
+                   '\t<Channel>\t1\t2\t3\t4</Channel>\n' \
+                   '</Histogram>\n'
+        self.assertEqual(hist.ToXML(), expected)
+
+        loaded = Histogram.FromXML(expected)
+        self.assertEqual(loaded.Bins, [1, 2, 3, 4])
+        self.assertEqual(loaded.NumSamples, 10)
+        self.assertEqual(loaded.MinValue, 0.0)
+        self.assertEqual(loaded.MaxValue, 255.0)
+
+        # Mismatched bin counts are rejected
+        self.assertIsNone(Histogram.FromXML(expected.replace('NumBins="4"', 'NumBins="5"')))
+
+    def testHistogramCachedStatistics(self):
+        '''Derived statistics are cached and must be recalculated when the bins or bin geometry change'''
+
+        binVals = [0, 4, 10, 3, 0, 7, 1, 0]
+        hist = Histogram.Init(minVal=0, maxVal=79, binVals=binVals)
+        centers = hist.BinCenters()
+        samples = numpy.repeat(centers[:-1], binVals[:-1])
+
+        self.assertEqual(hist.BinWidth, 10)
+        self.assertEqual(hist.TotalCount, sum(binVals))
+        self.assertAlmostEqual(hist.Mean(), samples.mean())
+        self.assertAlmostEqual(hist.Variance(), samples.var())
+        self.assertEqual(hist.PeakValue(), 25.0)
+        self.assertEqual(hist.MinNonEmptyBin(), 1)
+        self.assertEqual(hist.MaxNonEmptyBin(), 6)
+
+        hist.IncrementBin(5, 100)
+        samples = numpy.concatenate((samples, [5.0] * 100))
+        self.assertEqual(hist.TotalCount, sum(binVals) + 100)
+        self.assertAlmostEqual(hist.Mean(), samples.mean())
+        self.assertAlmostEqual(hist.Variance(), samples.var())
+        self.assertEqual(hist.PeakValue(), 5.0)
+        self.assertEqual(hist.MinNonEmptyBin(), 0)
+
+        hist.MinValue = 100
+        self.assertEqual(hist.BinWidth, -2.5)
+        self.assertAlmostEqual(hist.Mean(), 100 + ((samples.mean() / 10.0) * -2.5))
+
+        hist = Histogram.Init(minVal=0, maxVal=7, binVals=[0.5, 1.5, 0, 0, 0, 0, 0, 2])
+        self.assertAlmostEqual(hist.Variance(), 0.1875)
+
+    def testHistogramTrim(self):
+        '''Trim and outlier removal return read-only views of the original bins'''
+
+        binVals = [0, 0, 1, 0, 0, 50, 60, 70, 0, 1, 0, 0]
+        hist = Histogram.Init(minVal=0, maxVal=119, binVals=binVals)
+
+        trimmed = Histogram.Trim(hist)
+        self.assertEqual(trimmed.Bins, [1, 0, 0, 50, 60, 70, 0, 1])
+        self.assertEqual(trimmed.MinValue, 20)
+        self.assertEqual(trimmed.MaxValue, 99)
+        self.assertEqual(trimmed.NumSamples, sum(binVals))
+        self.assertTrue(numpy.shares_memory(trimmed.BinArray, hist.BinArray))
+
+        trimmed = Histogram.TryRemoveMaxValueOutlier(hist)
+        self.assertEqual(trimmed.Bins, binVals[:8])
+        trimmed = Histogram.TryRemoveMinValueOutlier(trimmed)
+        self.assertEqual(trimmed.Bins, [50, 60, 70])
+        self.assertEqual(trimmed.MinValue, 50)
+        self.assertEqual(trimmed.MaxValue, 79)
+
+        self.assertRaises(ValueError, trimmed.IncrementBin, 55, 1)
+
+        independent = trimmed.copy()
+        independent.IncrementBin(55, 1)
+        self.assertEqual(independent.Bins, [51, 60, 70])
+        self.assertEqual(trimmed.Bins, [50, 60, 70])
+        self.assertEqual(hist.Bins, binVals)
+
+        # Histograms without anything to trim are returned unchanged
+        self.assertIs(Histogram.Trim(independent), independent)
+
+    def testHistogramRebin(self):
+        '''Rebinned histograms and pyramid levels conserve counts exactly'''
+        values = numpy.random.RandomState(0).randint(0, 1000, size=5000)
+        hist = Histogram.Init(0, 999, numBins=1000)
+        hist.AddArray(values)
+
+        coarse = hist.Rebin(4)
+        self.assertEqual(coarse.NumBins, 250)
+        self.assertEqual(coarse.BinWidth, 4 * hist.BinWidth)
+        self.assertEqual(coarse.MinValue, hist.MinValue)
+        self.assertEqual(coarse.MaxValue, hist.MaxValue)
+        self.assertEqual(coarse.TotalCount, hist.TotalCount)
+        self.assertTrue(numpy.array_equal(coarse.BinArray, hist.BinArray.reshape(-1, 4).sum(axis=1)))
+
+        # Factors that do not divide NumBins pad the last bin
+        padded = hist.Rebin(numBins=300)
+        self.assertEqual(padded.NumBins, 250)
+        uneven = hist.Rebin(3)
+        self.assertEqual(uneven.NumBins, 334)
+        self.assertEqual(uneven.TotalCount, hist.TotalCount)
+        self.assertEqual(uneven.Bins[-1], hist.Bins[-1])
+
+        self.assertIs(hist.PyramidLevel(0), hist)
+        level = hist.PyramidLevel(3)
+        self.assertEqual(level.NumBins, 125)
+        self.assertEqual(level.TotalCount, hist.TotalCount)
+        self.assertIs(hist.PyramidLevel(3), level, "Pyramid levels should be cached")
+        self.assertIs(hist.ForResolution(200), level)
+        self.assertIs(hist.ForResolution(2000), hist)
+        self.assertEqual(hist.ForResolution(0).NumBins, 1)
+
+        # Changing the bins discards the pyramid
+        hist.IncrementBin(0, 1)
+        self.assertEqual(hist.PyramidLevel(3).TotalCount, hist.TotalCount)
+        self.assertIsNot(hist.PyramidLevel(3), level)
+
+        (minX, maxX) = hist.XAxis_Extrema_Using_Threshold(100, max_width=125)
+        self.assertEqual(minX, hist.MinValue)
+        self.assertEqual(maxX, hist.MaxValue + 1)
+
+    def testQuantileSketch(self):
+        '''Sketches use bounded memory, merge across workers and approximate exact percentiles'''
+        values = numpy.random.RandomState(0).lognormal(0, 1, size=200000)
+        sortedValues = numpy.sort(values)
+
+        sketch = QuantileSketch(k=256, seed=0)
+        partials = [QuantileSketch(k=256, seed=i) for i in range(4)]
+        for (i, partial) in enumerate(partials):
+            partial.AddArray(values[i::4])
+            sketch.AddSketch(partial)
+
+        self.assertEqual(sketch.NumSamples, len(values))
+        self.assertEqual(sketch.MinValue, values.min())
+        self.assertEqual(sketch.MaxValue, values.max())
+        self.assertLess(sketch.NumRetained, 4 * 256)
+
+        for percentile in [0.01, 0.25, 0.5, 0.75, 0.99]:
+            rank = numpy.searchsorted(sortedValues, sketch.ValueAtPercentile(percentile)) / len(values)
+            self.assertAlmostEqual(rank, percentile, delta=0.01)
+
+        (minCutoff, maxCutoff) = sketch.AutoLevel(0.0, 0.0)
+        self.assertEqual(minCutoff, values.min())
+        self.assertEqual(maxCutoff, values.max())
+        self.assertEqual(sketch.Median(), sketch.ValueAtPercentile(0.5))
+        self.assertTrue(numpy.isnan(QuantileSketch().Median()))
+
+        hist = sketch.ToHistogram(100)
+        self.assertEqual(hist.NumBins, 100)
+        self.assertEqual(hist.TotalCount, len(values))
+        self.assertEqual(hist.MinValue, values.min())
+        self.assertAlmostEqual(hist.MinValue + (hist.BinWidth * hist.NumBins), values.max())
+
+    def testHistogramStack(self):
+        '''Vectorized statistics of a stack must match the statistics of each histogram'''
+        import tempfile
+
+        rng = numpy.random.default_rng(0)
+        histograms = []
+        for i in range(6):
+            hist = Histogram.Init(minVal=0, maxVal=4095, numBins=512)
+            hist.AddArray(rng.normal(1000 + (300 * i), 50 + (20 * i), size=20000).clip(0, 4095))
+            histograms.append(hist)
+
+        stack = HistogramStack.FromHistograms(histograms)
+        self.assertEqual(len(stack), len(histograms))
+
+        (minCutoffs, maxCutoffs) = stack.AutoLevel(0.01, 0.02)
+        medians = stack.Median()
+        rangeMedians = stack.Median(800, 3000)
+        means = stack.Mean()
+        peaks = stack.PeakValue()
+        for (i, hist) in enumerate(histograms):
+            self.assertEqual((minCutoffs[i], maxCutoffs[i]), hist.AutoLevel(0.01, 0.02))
+            self.assertEqual(medians[i], hist.Median())
+            self.assertEqual(rangeMedians[i], hist.Median(800, 3000))
+            self.assertAlmostEqual(means[i], hist.Mean())
+            self.assertAlmostEqual(peaks[i], hist.PeakValue())
+            self.assertEqual(stack[i].Bins, hist.Bins)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            for (i, hist) in enumerate(histograms):
+                hist.Save(os.path.join(tempdir, f'{i}.xml' if i % 2 else f'{i}{BinaryExtension}'))
+
+            loaded = HistogramStack.LoadDirectory(tempdir, workers=2)
+
+        self.assertTrue(numpy.array_equal(loaded.BinArray, stack.BinArray))
+        self.assertEqual([os.path.basename(name) for name in loaded.Names],
+                         [f'{i}.xml' if i % 2 else f'{i}{BinaryExtension}' for i in range(len(histograms))])
+
+        mismatched = Histogram.Init(minVal=0, maxVal=255, numBins=512)
+        self.assertRaises(ValueError, HistogramStack.FromHistograms, histograms + [mismatched])
+
+        # Counts whose index weighted sum overflows int64
+        large = HistogramStack(0, 4096, numpy.full((2, 4096), 1 << 50, dtype=numpy.int64))
+        self.assertTrue(numpy.allclose(large.Mean(), Histogram.Init(0, 4096, 4096, binVals=large.BinArray[0]).Mean()))
+
+    def testHistogramTransport(self):
+        '''Bins are pickled as out-of-band buffers, shared histograms accumulate in shared memory'''
+        import pickle
+
+        hist = Histogram.Init(minVal=0, maxVal=4095, numBins=4096)
+        hist.AddArray(numpy.arange(0, 4096, 3))
+
+        buffers = []
+        data = pickle.dumps(hist, protocol=5, buffer_callback=buffers.append)
+        self.assertEqual(len(buffers), 1)
+        self.assertLess(len(data), 1024)
+        restored = pickle.loads(data, buffers=[bytes(b.raw()) for b in buffers])
+        self.assertEqual(restored.Bins, hist.Bins)
+        restored.IncrementBin(0, 1)
+
+        with SharedHistogram(0, 4095, 4096, numSlabs=2) as shared:
+            attached = pickle.loads(pickle.dumps(shared))
+            attached.AddArray(0, numpy.arange(0, 4096, 3))
+            attached.AddHistogram(1, hist)
+            attached.Close()
+
+            merged = shared.ToHistogram()
+
+        self.assertEqual(merged.BinArray.tolist(), (hist.BinArray * 2).tolist())
+        self.assertEqual(merged.NumSamples, hist.NumSamples * 2)
+
+    def testHistogramMaskedWeightedAdd(self):
+        '''Masked values are skipped and weighted values add their weight to float bins'''
+        rng = numpy.random.default_rng(0)
+        image = rng.normal(2000, 300, size=(200, 300))
+        image[0, :] = numpy.nan
+        mask = numpy.ones(image.shape, dtype=bool)
+        mask[0, :] = False
+        mask[:, :10] = False
+        weights = rng.random(image.shape)
+
+        masked = Histogram.Init(minVal=0, maxVal=4095, numBins=256)
+        masked.AddArray(image, mask=mask)
+        expected = Histogram.Init(minVal=0, maxVal=4095, numBins=256)
+        expected.AddArray(image[mask])
+        self.assertEqual(masked.Bins, expected.Bins)
+        self.assertEqual(masked.BinArray.dtype, numpy.int64)
+        self.assertEqual(masked.NumSamples, mask.sum())
+
+        weighted = Histogram.Init(minVal=0, maxVal=4095, numBins=256)
+        weighted.AddArray(image, mask=mask, weights=weights)
+        expected = Histogram.Init(minVal=0, maxVal=4095, numBins=256)
+        for (value, weight) in zip(image[mask], weights[mask]):
+            expected.IncrementBin(value, weight)
+
+        self.assertEqual(weighted.BinArray.dtype, numpy.float64)
+        self.assertTrue(numpy.allclose(weighted.BinArray, expected.BinArray))
+        self.assertAlmostEqual(weighted.NumSamples, weights[mask].sum())
+        self.assertAlmostEqual(weighted.Median(), expected.Median())
+
+        self.assertRaises(ValueError, weighted.AddArray, image, mask=mask[1:])
+
+        # Fractional bins and sample counts survive an XML round trip
+        loaded = Histogram.FromXML(weighted.ToXML())
+        self.assertEqual(loaded.BinArray.dtype, numpy.float64)
+        self.assertTrue(numpy.array_equal(loaded.BinArray, weighted.BinArray))
+        self.assertEqual(loaded.NumSamples, weighted.NumSamples)
+
 #     def testHugeAdd(self):
 #         '''Wrote to compare performance, OK to disable'''
 #         minVal = 0
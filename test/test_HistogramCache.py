@@ -0,0 +1,95 @@
+'''
+Tests for the persistent cache of per-tile partial histograms
+'''
+import os
+import unittest
+
+import numpy
+
+from nornir_shared.histogram import Histogram, FromImageFiles
+from nornir_shared.histogramcache import HistogramCache
+
+from test.imagetestbase import ImageTestBase
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.TileDir = self._Path('tiles')
+        self.CacheDir = self._Path('cache')
+        os.makedirs(self.TileDir)
+
+        self.Paths = []
+        for i in range(4):
+            path = os.path.join(self.TileDir, f'{i}.npy')
+            numpy.save(path, self.Rng.integers(0, 1 << 12, size=(64, 64), dtype=numpy.uint16))
+            self.Paths.append(path)
+
+    def testRebuildsOnlyChangedTiles(self):
+        cache = HistogramCache(self.CacheDir)
+        hist = cache.Build(self.Paths, 0, 4095, 256)
+        self.assertEqual(hist.Bins, FromImageFiles(self.Paths, 0, 4095, 256).Bins)
+        self.assertEqual((cache.Hits, cache.Misses), (0, 4))
+
+        cache.Build(self.Paths, 0, 4095, 256)
+        self.assertEqual((cache.Hits, cache.Misses), (4, 4))
+
+        # A changed tile has a new size, so only its partial is rebuilt
+        numpy.save(self.Paths[1], numpy.zeros((32, 32), dtype=numpy.uint16))
+        hist = cache.Build(self.Paths, 0, 4095, 256)
+        self.assertEqual((cache.Hits, cache.Misses), (7, 5))
+        self.assertEqual(hist.Bins, FromImageFiles(self.Paths, 0, 4095, 256).Bins)
+
+        # A different range is a different partial
+        cache.Build(self.Paths[:1], 0, 4095, 64)
+        self.assertEqual(cache.Misses, 6)
+
+    def testChecksumKey(self):
+        cache = HistogramCache(self.CacheDir, use_checksum=True)
+        cache.Build(self.Paths, 0, 4095, 256)
+
+        # Same size and modification time but different contents
+        stats = os.stat(self.Paths[0])
+        numpy.save(self.Paths[0], numpy.zeros((64, 64), dtype=numpy.uint16))
+        os.utime(self.Paths[0], ns=(stats.st_atime_ns, stats.st_mtime_ns))
+
+        hist = cache.Build(self.Paths, 0, 4095, 256)
+        self.assertEqual((cache.Hits, cache.Misses), (3, 5))
+        self.assertEqual(hist.Bins[0], 64 * 64 + FromImageFiles(self.Paths[1:], 0, 4095, 256).Bins[0])
+
+    def testEviction(self):
+        cache = HistogramCache(self.CacheDir)
+        cache.Build(self.Paths, 0, 4095, 256)
+        entrySize = os.path.getsize(os.path.join(self.CacheDir, os.listdir(self.CacheDir)[0]))
+
+        # Reading the first tile makes it the most recently used
+        cache.TileHistogram(self.Paths[0], 0, 4095, 256)
+        self.assertEqual(cache.Evict(2 * entrySize), 2)
+        self.assertEqual(len(os.listdir(self.CacheDir)), 2)
+
+        hits = cache.Hits
+        cache.TileHistogram(self.Paths[0], 0, 4095, 256)
+        self.assertEqual(cache.Hits, hits + 1)
+
+        cache.MaxBytes = entrySize
+        cache.TileHistogram(self.Paths[1], 0, 4095, 256)
+        self.assertEqual(len(os.listdir(self.CacheDir)), 1)
+
+        cache.Clear()
+        self.assertEqual(os.listdir(self.CacheDir), [])
+
+    def testUnreadableEntry(self):
+        cache = HistogramCache(self.CacheDir)
+        key = cache.Key(self.Paths[0], 0, 4095, 256)
+        with open(os.path.join(self.CacheDir, key + '.npz'), 'w') as f:
+            f.write('not a histogram')
+
+        hist = cache.TileHistogram(self.Paths[0], 0, 4095, 256)
+        self.assertEqual(hist.Bins, FromImageFiles(self.Paths[0], 0, 4095, 256).Bins)
+        self.assertIsInstance(cache.Get(key), Histogram)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
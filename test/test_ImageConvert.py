@@ -0,0 +1,96 @@
+'''
+Tests for converting images without ImageMagick
+'''
+import os
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_shared import imageconvert
+
+from test.imagetestbase import ImageTestBase
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.Gray16 = self.Rng.integers(0, 1 << 16, size=(64, 48), dtype=numpy.uint16)
+        self.Gray8 = self.Rng.integers(0, 256, size=(64, 48), dtype=numpy.uint8)
+
+    def testDepth(self):
+        # 16 to 8 bits rounds to the nearest value, as ImageMagick's -depth 8
+        converted = imageconvert.ConvertImageArray(self.Gray16, Bpp=8)
+        self.assertEqual(converted.dtype, numpy.uint8)
+        self.assertTrue(numpy.array_equal(converted, numpy.floor(self.Gray16 / 257 + 0.5).astype(numpy.uint8)))
+
+        # 8 bit values survive a round trip through 16 bits
+        converted = imageconvert.ConvertImageArray(self.Gray8, Bpp=16)
+        self.assertTrue(numpy.array_equal(converted, self.Gray8.astype(numpy.uint16) * 257))
+        self.assertTrue(numpy.array_equal(imageconvert.ConvertImageArray(converted, Bpp=8), self.Gray8))
+
+        self.assertRaises(ValueError, imageconvert.ConvertImageArray, self.Gray8, Bpp=12)
+
+    def testTransforms(self):
+        converted = imageconvert.ConvertImageArray(self.Gray16, Bpp=16, Invert=True, Flip=True, Flop=True)
+        self.assertTrue(numpy.array_equal(converted, (65535 - self.Gray16)[::-1, ::-1]))
+
+        # -evaluate rightshift 4 -evaluate leftshift 4 clears the low bits
+        converted = imageconvert.ConvertImageArray(self.Gray16, Bpp=16, RightLeftShift=(4, 0))
+        self.assertTrue(numpy.array_equal(converted, self.Gray16 & 0xFFF0))
+
+        # Shifting left past the quantum range saturates
+        converted = imageconvert.ConvertImageArray(self.Gray16, Bpp=16, RightLeftShift=(4, 2))
+        expected = numpy.minimum((self.Gray16.astype(numpy.int64) >> 4) << 6, 65535)
+        self.assertTrue(numpy.array_equal(converted, expected))
+
+        converted = imageconvert.ConvertImageArray(self.Gray16, Bpp=16, AndValue=0xFF00)
+        self.assertTrue(numpy.array_equal(converted, self.Gray16 & 0xFF00))
+
+        # -level stretches MinMax to the full range and clamps values outside it
+        (minVal, maxVal) = (1000, 50000)
+        converted = imageconvert.ConvertImageArray(self.Gray16, Bpp=8, MinMax=(minVal, maxVal))
+        stretched = numpy.clip((self.Gray16.astype(numpy.float64) - minVal) / (maxVal - minVal), 0, 1) * 255
+        self.assertLessEqual(numpy.abs(converted - stretched).max(), 0.5 + 1e-9)
+
+        rgb = numpy.stack([self.Gray8, numpy.zeros_like(self.Gray8), self.Gray8], axis=2)
+        converted = imageconvert.ConvertImageArray(rgb, Bpp=8)
+        self.assertEqual(converted.shape, self.Gray8.shape)
+        self.assertLessEqual(numpy.abs(converted - self.Gray8 * (0.212656 + 0.072186)).max(), 0.5 + 1e-9)
+
+    def testConvertFiles(self):
+        sources = {}
+        for i in range(3):
+            path = self._Path(f'{i}.png')
+            Image.fromarray(self.Gray16 >> i).save(path)
+            sources[path] = self._Path(f'{i}_8bit.png')
+
+        badPath = self._Path('bad.png')
+        with open(badPath, 'wb') as f:
+            f.write(b'not an image')
+        sources[badPath] = self._Path('bad_8bit.png')
+
+        errors = imageconvert.ConvertImages(sources, workers=2, Bpp=8, Invert=True)
+        self.assertEqual(list(errors.keys()), [badPath])
+        self.assertFalse(os.path.exists(sources[badPath]))
+
+        for i in range(3):
+            with Image.open(sources[self._Path(f'{i}.png')]) as im:
+                self.assertEqual(im.mode, 'L')
+                expected = imageconvert.ConvertImageArray(self.Gray16 >> i, Bpp=8, Invert=True)
+                self.assertTrue(numpy.array_equal(numpy.asarray(im), expected))
+
+        # Converting in place leaves no temporary files behind
+        path = self._Path('0.png')
+        imageconvert.ConvertImage(path, path, Flip=True, Bpp=16)
+        with Image.open(path) as im:
+            self.assertTrue(numpy.array_equal(numpy.asarray(im), self.Gray16[::-1]))
+
+        self.assertEqual([name for name in os.listdir(self.OutputDir) if name.startswith('.tmp_')], [])
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,140 @@
+'''
+Tests for reading image metadata without ImageMagick
+'''
+import unittest
+
+import numpy
+import PIL
+from PIL import Image
+
+from nornir_shared import imageinfo
+from nornir_shared import imagereader
+
+from test.imagetestbase import ImageTestBase
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.Gray16 = self.Rng.integers(0, 1 << 16, size=(120, 80), dtype=numpy.uint16)
+        self.RGB = self.Rng.integers(0, 256, size=(40, 60, 3), dtype=numpy.uint8)
+
+    def testHeaderInfo(self):
+        Image.fromarray(self.Gray16).save(self._Path('gray16.png'))
+        Image.fromarray(self.Gray16).save(self._Path('gray16.tif'))
+        Image.fromarray((self.Gray16 >> 8).astype(numpy.uint8)).save(self._Path('gray8.png'))
+        Image.fromarray(self.RGB).save(self._Path('rgb.png'))
+        numpy.save(self._Path('gray16.npy'), self.Gray16)
+
+        expected = {'gray16.png': (16, 'Gray'),
+                    'gray16.tif': (16, 'Gray'),
+                    'gray8.png': (8, 'Gray'),
+                    'rgb.png': (8, 'sRGB'),
+                    'gray16.npy': (16, 'Gray')}
+
+        for (name, (bpp, colorspace)) in expected.items():
+            info = imageinfo.ReadImageInfo(self._Path(name))
+            self.assertEqual(info.Bpp, bpp, name)
+            self.assertEqual(info.Colorspace, colorspace, name)
+            self.assertEqual(imageinfo.GetImageBpp(self._Path(name)), bpp)
+            self.assertEqual(imageinfo.GetImageColorspace(self._Path(name)), colorspace)
+
+        self.assertEqual(imageinfo.ReadImageInfo(self._Path('gray16.png')).Size.tolist(), [120, 80])
+        self.assertEqual(imageinfo.ReadImageInfo(self._Path('rgb.png')).Size.tolist(), [40, 60])
+
+    def testStats(self):
+        Image.fromarray(self.Gray16).save(self._Path('gray16.png'))
+        Image.fromarray(self.RGB).save(self._Path('rgb.png'))
+
+        for (name, pixels) in [('gray16.png', self.Gray16), ('rgb.png', self.RGB)]:
+            (minVal, mean, maxVal, stddev) = imageinfo.GetImageStats(self._Path(name))
+            self.assertEqual(minVal, pixels.min())
+            self.assertEqual(maxVal, pixels.max())
+            self.assertAlmostEqual(mean, pixels.mean())
+            self.assertAlmostEqual(stddev, pixels.std())
+
+        # Statistics combined across strips must match the whole array
+        image = numpy.random.default_rng(1).normal(1e6, 2.0, size=(3000, 1000))
+        (minVal, mean, maxVal, stddev) = imageinfo.ArrayStats(image)
+        self.assertAlmostEqual(mean, image.mean())
+        self.assertAlmostEqual(stddev, image.std())
+
+    def testCalculateStats(self):
+        '''Single pass statistics of a memory mapped 16-bit image, with its histogram'''
+        from nornir_shared.histogram import Histogram
+
+        path = self._Path('large.npy')
+        image = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.uint16, shape=(2500, 1000))
+        image[:] = numpy.random.default_rng(2).integers(0, 1 << 16, size=image.shape, dtype=numpy.uint16)
+        image.flush()
+
+        hist = Histogram.Init(0, (1 << 16) - 1, 256)
+        stats = imageinfo.CalculateStats(path, hist=hist)
+        self.assertEqual(stats.Count, image.size)
+        self.assertEqual(stats.Min, image.min())
+        self.assertEqual(stats.Max, image.max())
+        self.assertIsInstance(stats.Min, int)
+        self.assertAlmostEqual(stats.Mean, image.mean(dtype=numpy.float64))
+        self.assertAlmostEqual(stats.Variance / image.var(dtype=numpy.float64), 1.0)
+        self.assertEqual(hist.Bins, Histogram.FromImageArray(numpy.asarray(image), 0, (1 << 16) - 1, 256).Bins)
+
+        # 16-bit grayscale PNGs are decoded a strip at a time, palette images are measured by their colors
+        pngPath = self._Path('large.png')
+        Image.fromarray(numpy.asarray(image)).save(pngPath)
+        self.assertGreater(len(list(imagereader.IterDecodedStrips(pngPath))), 1)
+        pngStats = imageinfo.CalculateStats(pngPath)
+        self.assertEqual((pngStats.Count, pngStats.Min, pngStats.Max), (stats.Count, stats.Min, stats.Max))
+        self.assertAlmostEqual(pngStats.Mean, stats.Mean)
+        del image
+
+        palette = Image.fromarray(self.RGB).quantize(16)
+        palette.save(self._Path('palette.png'))
+        self.assertAlmostEqual(imageinfo.CalculateStats(self._Path('palette.png')).Mean,
+                               numpy.asarray(palette.convert('RGB')).mean())
+
+        self.assertRaises(ValueError, imageinfo.CalculateStats, numpy.zeros((0, 10)))
+        self.assertRaises(ValueError, imageinfo.CalculateStats, numpy.array([[1.0, numpy.nan]]))
+        self.assertRaises(FileNotFoundError, imageinfo.GetImageStats, self._Path('missing.png'))
+
+    def testBatch(self):
+        Image.fromarray(self.Gray16).save(self._Path('gray16.png'))
+        Image.fromarray(self.RGB).save(self._Path('rgb.png'))
+        numpy.save(self._Path('gray16.npy'), self.Gray16)
+        with open(self._Path('bad.png'), 'wb') as f:
+            f.write(b'not an image')
+
+        paths = [self._Path(name) for name in ['gray16.png', 'rgb.png', 'bad.png', 'gray16.npy', 'missing.png']]
+
+        columns = imageinfo.GetImageInfoBatch(paths, fields=['width', 'height', 'bpp', 'colorspace', 'filesize', 'stats'],
+                                              workers=2)
+        self.assertEqual(columns['path'].tolist(), paths)
+        self.assertEqual(columns['valid'].tolist(), [True, True, False, True, False])
+        self.assertEqual(columns['width'].tolist(), [80, 60, -1, 80, -1])
+        self.assertEqual(columns['height'].tolist(), [120, 40, -1, 120, -1])
+        self.assertEqual(columns['bpp'].tolist(), [16, 8, -1, 16, -1])
+        self.assertEqual(columns['colorspace'].tolist(), ['Gray', 'sRGB', None, 'Gray', None])
+        self.assertEqual(columns['filesize'][2], len(b'not an image'))
+        self.assertEqual(columns['filesize'][4], -1)
+        self.assertEqual(columns['max'][0], self.Gray16.max())
+        self.assertAlmostEqual(columns['mean'][1], self.RGB.mean())
+        self.assertTrue(numpy.isnan(columns['stddev'][2]))
+
+        columns = imageinfo.GetImageInfoBatch(paths)
+        self.assertEqual(set(columns.keys()), {'path', 'valid'} | set(imageinfo.DefaultBatchFields))
+        self.assertEqual(columns['mode'][3], 'uint16')
+
+        self.assertRaises(ValueError, imageinfo.GetImageInfoBatch, paths, fields=['depth'])
+
+    def testUnsupportedFormat(self):
+        path = self._Path('unknown.img')
+        with open(path, 'wb') as f:
+            f.write(b'not an image')
+
+        self.assertRaises(PIL.UnidentifiedImageError, imageinfo.ReadImageInfo, path)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
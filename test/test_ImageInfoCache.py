@@ -0,0 +1,73 @@
+'''
+Tests for the persistent image metadata cache
+'''
+import os
+import pickle
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_shared.imageinfocache import ImageInfoCache, DefaultCacheFilename
+
+from test.imagetestbase import ImageTestBase
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.Gray8 = self.Rng.integers(0, 256, size=(50, 70), dtype=numpy.uint8)
+        self.ImagePath = self._Path('tile.png')
+        Image.fromarray(self.Gray8).save(self.ImagePath)
+
+    def testMemoizesAndInvalidates(self):
+        cache = ImageInfoCache.ForDirectory(self.OutputDir)
+        self.assertTrue(os.path.exists(self._Path(DefaultCacheFilename)))
+
+        self.assertEqual(cache.GetImageSize(self.ImagePath).tolist(), [50, 70])
+        self.assertEqual(cache.GetImageBpp(self.ImagePath), 8)
+        self.assertTrue(cache.IsValidImage(self.ImagePath))
+        (minVal, mean, maxVal, stddev) = cache.GetImageStats(self.ImagePath)
+        self.assertAlmostEqual(mean, self.Gray8.mean())
+        self.assertEqual((cache.Hits, cache.Misses), (3, 1))
+
+        # A second cache, such as one in another process, reads the stored rows
+        other = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(other.GetImageStats(self.ImagePath), (minVal, mean, maxVal, stddev))
+        self.assertTrue(other.IsValidImage(self.ImagePath))
+        self.assertEqual((other.Hits, other.Misses), (2, 0))
+
+        # Replacing the file changes its size and modification time
+        Image.fromarray(numpy.zeros((20, 30), dtype=numpy.uint16)).save(self.ImagePath)
+        self.assertEqual(other.GetImageSize(self.ImagePath).tolist(), [20, 30])
+        self.assertEqual(other.GetImageBpp(self.ImagePath), 16)
+        self.assertEqual(other.GetImageStats(self.ImagePath)[2], 0)
+        self.assertEqual(other.Misses, 1)
+
+    def testInvalidImages(self):
+        cache = ImageInfoCache(self._Path('cache.sqlite'))
+
+        badPath = self._Path('bad.png')
+        with open(badPath, 'wb') as f:
+            f.write(b'not an image')
+
+        self.assertFalse(cache.IsValidImage(badPath))
+        self.assertIsNone(cache.GetImageSize(badPath))
+        self.assertFalse(cache.IsValidImage(self._Path('missing.png')))
+
+        # A truncated file has a readable header but fails verification
+        truncatedPath = self._Path('truncated.png')
+        with open(self.ImagePath, 'rb') as f:
+            data = f.read()
+        with open(truncatedPath, 'wb') as f:
+            f.write(data[:len(data) // 2])
+
+        self.assertEqual(cache.GetImageSize(truncatedPath).tolist(), [50, 70])
+        self.assertFalse(cache.IsValidImage(truncatedPath))
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,88 @@
+'''
+Tests for overlapping image reads, processing and writes
+'''
+import threading
+import time
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_shared import imagepipeline
+
+from test.imagetestbase import ImageTestBase
+
+
+def Invert(image):
+    '''Processing function, module level so it can be sent to worker processes'''
+    if image.shape[0] == 21:
+        raise ValueError("Cannot process images with 21 rows")
+
+    return 255 - image
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.Images = {}
+        for i in range(12):
+            path = self._Path(f'{i}.png')
+            self.Images[path] = self.Rng.integers(0, 256, size=(20 + i, 30), dtype=numpy.uint8)
+            Image.fromarray(self.Images[path]).save(path)
+
+        numpy.save(self._Path('image.npy'), self.Images[self._Path('0.png')])
+
+    def testPipeline(self):
+        written = {}
+        lock = threading.Lock()
+
+        def Write(path, value):
+            time.sleep(0.01)
+            with lock:
+                written[path] = value
+
+        paths = list(self.Images.keys()) + [self._Path('missing.png'), self._Path('image.npy')]
+        results = list(imagepipeline.ProcessImages(paths, Invert, write=Write, prefetch=3, write_behind=2, workers=2))
+
+        self.assertEqual([r.Path for r in results], paths)
+        for result in results[:len(self.Images)]:
+            if result.Path == self._Path('1.png'):
+                continue
+
+            self.assertTrue(result.Succeeded, str(result))
+            self.assertTrue(numpy.array_equal(result.Value, 255 - self.Images[result.Path]))
+            self.assertTrue(numpy.array_equal(written[result.Path], result.Value))
+
+        # Failures to read or process an image are reported without stopping the pipeline
+        self.assertIsInstance(results[1].Error, ValueError)
+        self.assertIsInstance(results[-2].Error, FileNotFoundError)
+        self.assertEqual(len([r for r in results if not r.Succeeded]), 2)
+        self.assertNotIn(self._Path('1.png'), written)
+
+        # .npy images are read into memory before being sent to a worker process
+        self.assertTrue(results[-1].Succeeded)
+        self.assertTrue(numpy.array_equal(written[self._Path('image.npy')], 255 - self.Images[self._Path('0.png')]))
+
+    def testWriteErrorsAndEarlyExit(self):
+        def Write(path, value):
+            raise OSError("Disk full")
+
+        results = list(imagepipeline.ProcessImages([self._Path('0.png'), self._Path('2.png')], Invert, write=Write,
+                                                   use_processes=False, workers=2))
+        self.assertEqual([type(r.Error) for r in results], [OSError, OSError])
+
+        # Stopping early does not wait for every image to be processed
+        count = 0
+        for result in imagepipeline.ProcessImages(list(self.Images.keys()) * 10, Invert, use_processes=False, workers=1):
+            count += 1
+            if count == 3:
+                break
+
+        self.assertEqual(count, 3)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
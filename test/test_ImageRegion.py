@@ -0,0 +1,129 @@
+'''
+Tests for reading regions of images
+'''
+import os
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_shared import imagereader
+
+from test.imagetestbase import ImageTestBase
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.Gray16 = self.Rng.integers(0, 1 << 16, size=(3000, 700), dtype=numpy.uint16)
+        self.RGB = self.Rng.integers(0, 256, size=(500, 300, 3), dtype=numpy.uint8)
+
+    def _Expected(self, image, y, x, height, width, downsample):
+        region = image[y:y + height, x:x + width].astype(numpy.float64)
+        rows = [region[i:i + downsample].mean(axis=0) for i in range(0, region.shape[0], downsample)]
+        region = numpy.stack(rows)
+        cols = [region[:, i:i + downsample].mean(axis=1) for i in range(0, region.shape[1], downsample)]
+        return numpy.floor(numpy.stack(cols, axis=1) + 0.5).astype(image.dtype)
+
+    def testFormats(self):
+        Image.fromarray(self.Gray16).save(self._Path('gray16.png'))
+        Image.fromarray(self.Gray16).save(self._Path('gray16.tif'))
+        Image.fromarray(self.Gray16).save(self._Path('interlaced.png'), interlace=1)
+        numpy.save(self._Path('gray16.npy'), self.Gray16)
+
+        cache = imagereader.DecodedStripCache()
+        regions = [(10, 20, 100, 50, 1),
+                   (2900, 600, 500, 500, 1),  # Clipped at the image edge
+                   (5, 7, 1000, 300, 3),
+                   (0, 0, 3000, 700, 4)]
+
+        for name in ['gray16.png', 'gray16.tif', 'interlaced.png', 'gray16.npy']:
+            for (y, x, height, width, downsample) in regions:
+                region = imagereader.ReadRegion(self._Path(name), y, x, height, width, downsample, cache=cache)
+                self.assertEqual(region.dtype, numpy.uint16)
+                self.assertTrue(numpy.array_equal(region, self._Expected(self.Gray16, y, x, height, width, downsample)),
+                                (name, y, x, height, width, downsample))
+
+        Image.fromarray(self.RGB).save(self._Path('rgb.tif'))
+        region = imagereader.ReadRegion(self._Path('rgb.tif'), 100, 50, 30, 40)
+        self.assertTrue(numpy.array_equal(region, self.RGB[100:130, 50:90]))
+
+        # Empty regions have the same shape and type in every format
+        for name in ['gray16.png', 'gray16.tif', 'interlaced.png', 'gray16.npy']:
+            for (y, x, height, width, expected) in [(0, 0, 0, 10, (0, 10)), (3000, 0, 10, 10, (0, 10)), (5, 700, 10, 10, (10, 0))]:
+                region = imagereader.ReadRegion(self._Path(name), y, x, height, width, cache=cache)
+                self.assertEqual((region.shape, region.dtype), (expected, numpy.uint16), name)
+
+        self.assertRaises(ValueError, imagereader.ReadRegion, self._Path('gray16.npy'), -1, 0, 10, 10)
+        self.assertRaises(ValueError, imagereader.ReadRegion, self._Path('gray16.npy'), 0, 0, 10, 10, downsample=0)
+
+    def testPngModes(self):
+        '''PNGs decoded in strips match PIL decoding the whole file'''
+        images = {'rgb.png': Image.fromarray(self.RGB),
+                  'rgba.png': Image.fromarray(numpy.dstack((self.RGB, self.RGB[:, :, :1]))),
+                  'palette.png': Image.fromarray(self.RGB).quantize(37),
+                  'bilevel.png': Image.fromarray(self.RGB[:, :, 0] > 127)}
+        images['palette4.png'] = images['palette.png'].quantize(9)
+
+        for (name, im) in images.items():
+            path = self._Path(name)
+            if name == 'palette4.png':
+                im.save(path, bits=4)
+            else:
+                im.save(path)
+
+            with Image.open(path) as saved:
+                expected = numpy.asarray(saved)
+
+            strips = list(imagereader.IterDecodedStrips(path, 7))
+            self.assertEqual(strips[0].shape[0], 7)
+            self.assertTrue(numpy.array_equal(numpy.concatenate(strips), expected), name)
+
+            region = imagereader.ReadRegion(path, 120, 30, 50, 60, cache=imagereader.DecodedStripCache())
+            self.assertEqual(region.dtype, expected.dtype)
+            self.assertTrue(numpy.array_equal(region, expected[120:170, 30:90]), name)
+
+    def testPartialDecode(self):
+        '''Regions are read without decoding the parts of the file after them'''
+        for name in ['gray16.png', 'gray16.tif']:
+            path = self._Path(name)
+            Image.fromarray(self.Gray16).save(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            with open(path, 'wb') as f:
+                f.write(data[:len(data) // 2])
+
+            self.assertRaises((OSError, ValueError), imagereader.ReadImageArray, path)
+            region = imagereader.ReadRegion(path, 10, 10, 100, 100, cache=imagereader.DecodedStripCache())
+            self.assertTrue(numpy.array_equal(region, self.Gray16[10:110, 10:110]), name)
+
+    def testStripCache(self):
+        path = self._Path('gray16.png')
+        Image.fromarray(self.Gray16).save(path)
+
+        cache = imagereader.DecodedStripCache(max_bytes=self.Gray16.nbytes // 2)
+        imagereader.ReadRegion(path, 0, 0, 100, 100, cache=cache)
+        misses = cache.Misses
+        region = imagereader.ReadRegion(path, 50, 100, 100, 100, cache=cache)
+        self.assertTrue(numpy.array_equal(region, self.Gray16[50:150, 100:200]))
+        self.assertEqual(cache.Misses, misses)
+
+        # Decoding the whole image keeps the strips nearest the region within the cache size
+        region = imagereader.ReadRegion(path, 2900, 0, 100, 100, cache=cache)
+        self.assertTrue(numpy.array_equal(region, self.Gray16[2900:, :100]))
+        self.assertLessEqual(cache.NumBytes, cache.MaxBytes)
+        self.assertGreater(cache.NumBytes, 0)
+
+        # A changed file is decoded again
+        Image.fromarray(self.Gray16[::-1].copy()).save(path)
+        os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10**9))
+        region = imagereader.ReadRegion(path, 0, 0, 100, 100, cache=cache)
+        self.assertTrue(numpy.array_equal(region, self.Gray16[::-1][:100, :100]))
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,93 @@
+'''
+Tests for validating many images in a pool
+'''
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_shared import imagevalidation
+from nornir_shared.imagevalidation import ValidationMode
+
+from test.imagetestbase import ImageTestBase
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        image = self.Rng.integers(0, 1 << 16, size=(200, 150), dtype=numpy.uint16)
+        self.GoodPaths = []
+        for i in range(6):
+            path = self._Path(f'good{i}.png')
+            Image.fromarray(image).save(path)
+            self.GoodPaths.append(path)
+
+        numpy.save(self._Path('good.npy'), image)
+        self.GoodPaths.append(self._Path('good.npy'))
+
+        with open(self.GoodPaths[0], 'rb') as f:
+            data = f.read()
+
+        # The header survives, but the compressed pixel data is cut short
+        with open(self._Path('truncated.png'), 'wb') as f:
+            f.write(data[:len(data) // 2])
+
+        # Damage a byte in the pixel data, which the chunk CRC detects
+        corrupt = bytearray(data)
+        corrupt[len(data) // 2] ^= 0xFF
+        with open(self._Path('corrupt.png'), 'wb') as f:
+            f.write(bytes(corrupt))
+
+        with open(self._Path('empty.png'), 'wb'):
+            pass
+
+        with open(self._Path('garbage.png'), 'wb') as f:
+            f.write(b'not an image')
+
+    def testModes(self):
+        damaged = [self._Path(name) for name in ['truncated.png', 'corrupt.png', 'empty.png', 'garbage.png', 'missing.png']]
+        paths = self.GoodPaths + damaged
+
+        report = imagevalidation.ValidateImages(paths, ValidationMode.Header, workers=2)
+        self.assertEqual(len(report), len(paths))
+        self.assertEqual(set(report.InvalidPaths),
+                         {self._Path(name) for name in ['empty.png', 'garbage.png', 'missing.png']})
+        self.assertEqual(report.Errors[self._Path('empty.png')], 'File is empty')
+        self.assertIn('FileNotFoundError', report.Errors[self._Path('missing.png')])
+
+        for mode in (ValidationMode.Verify, ValidationMode.Deep):
+            report = imagevalidation.ValidateImages(paths, mode, workers=2)
+            self.assertFalse(report.AllValid)
+            self.assertEqual(set(report.InvalidPaths), set(damaged), mode)
+            self.assertEqual(set(report.ValidPaths), set(self.GoodPaths), mode)
+
+        result = imagevalidation.ValidateImage(self.GoodPaths[0], 'deep')
+        self.assertTrue(result.Valid)
+        self.assertEqual(result.Info.Size.tolist(), [200, 150])
+
+        report = imagevalidation.ValidateImages(self.GoodPaths, ValidationMode.Deep, workers=2, use_processes=True)
+        self.assertTrue(report.AllValid)
+        self.assertEqual(len(report), len(self.GoodPaths))
+
+    def testStreamingAndEarlyExit(self):
+        paths = [self._Path('garbage.png')] + self.GoodPaths * 20
+
+        results = []
+        for result in imagevalidation.IterValidateImages(paths, ValidationMode.Verify, workers=1):
+            results.append(result)
+            if len(results) == 3:
+                break
+
+        self.assertEqual(len(results), 3)
+
+        report = imagevalidation.ValidateImages(paths, ValidationMode.Verify, workers=1, stop_on_first_invalid=True)
+        self.assertTrue(report.StoppedEarly)
+        self.assertEqual(report.InvalidPaths, [self._Path('garbage.png')])
+        self.assertLess(len(report), len(paths))
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -0,0 +1,92 @@
+'''
+Tests for building tile pyramids without ImageMagick
+'''
+import os
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_shared import imageconvert
+from nornir_shared import tilepyramid
+
+from test.imagetestbase import ImageTestBase
+
+
+class Test(ImageTestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        # Odd dimensions exercise the padded edge tiles and odd rows of each reduction
+        self.Image = self.Rng.integers(0, 1 << 16, size=(531, 701), dtype=numpy.uint16)
+        self.ImagePath = self._Path('section.png')
+        Image.fromarray(self.Image).save(self.ImagePath)
+
+    def _ReadLevel(self, downsample, gridDim, tileSize):
+        directory = self._Path('out', '%03d' % downsample)
+        rows = []
+        for iY in range(gridDim[1]):
+            row = []
+            for iX in range(gridDim[0]):
+                with Image.open(os.path.join(directory, f'X{iX}_Y{iY}.png')) as im:
+                    self.assertEqual(im.size, tileSize)
+                    self.assertEqual(im.mode, 'L')
+                    row.append(numpy.asarray(im))
+            rows.append(numpy.concatenate(row, axis=1))
+
+        return numpy.concatenate(rows, axis=0)
+
+    def testBoxReduce(self):
+        image = numpy.array([[0, 2, 4], [2, 4, 7], [10, 10, 1]], dtype=numpy.uint8)
+        self.assertEqual(tilepyramid.BoxReduce(image).tolist(), [[2, 6], [10, 1]])
+
+    def testPyramid(self):
+        tileSize = (128, 96)
+        outputPath = self._Path('out')
+
+        grid = tilepyramid.BuildTilePyramid(self.ImagePath, outputPath, TileSize=tileSize,
+                                            DownsampleList=[8, 1, 2, 4, 16], workers=2)
+        self.assertEqual(grid, (6, 6))
+
+        expected = imageconvert.ConvertImageArray(self.Image, Bpp=8)
+        for downsample in [1, 2, 4, 8, 16]:
+            (height, width) = expected.shape
+            gridDim = (-(-width // tileSize[0]), -(-height // tileSize[1]))
+
+            with open(os.path.join(outputPath, '%03d' % downsample, f'{downsample}.xml')) as f:
+                xml = f.read()
+            self.assertIn(f'GridDimX="{gridDim[0]}" GridDimY="{gridDim[1]}"', xml)
+            self.assertIn(f'Downsample="{downsample}"', xml)
+
+            level = self._ReadLevel(downsample, gridDim, tileSize)
+            self.assertTrue(numpy.array_equal(level[:height, :width], expected), downsample)
+            self.assertFalse(level[height:].any())
+            self.assertFalse(level[:, width:].any())
+
+            expected = tilepyramid.BoxReduce(expected)
+
+        # The pyramid is not rebuilt while the XML files are newer than the image
+        tile = os.path.join(outputPath, '001', 'X0_Y0.png')
+        os.remove(tile)
+        self.assertEqual(tilepyramid.BuildTilePyramid(self.ImagePath, outputPath, TileSize=tileSize,
+                                                      DownsampleList=[1, 2, 4, 8, 16]), (6, 6))
+        self.assertFalse(os.path.exists(tile))
+
+    def testSkippedLevels(self):
+        '''Levels more than a factor of two apart are reduced more than once'''
+        outputPath = self._Path('out')
+        tilepyramid.BuildTilePyramid(self.ImagePath, outputPath, TileSize=(64, 64), DownsampleList=[2, 8])
+
+        expected = imageconvert.ConvertImageArray(self.Image, Bpp=8)
+        expected = tilepyramid.BoxReduce(tilepyramid.BoxReduce(expected))
+        level = self._ReadLevel(8, (3, 3), (64, 64))
+        self.assertTrue(numpy.array_equal(level[:expected.shape[0], :expected.shape[1]], expected))
+
+        self.assertRaises(ValueError, tilepyramid.BuildTilePyramid, self.ImagePath, outputPath,
+                          DownsampleList=[1, 3])
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
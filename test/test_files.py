@@ -9,7 +9,7 @@ import unittest
 import time
 import datetime
 
-from nornir_shared.files import RecurseSubdirectories, RecurseSubdirectoriesGenerator, IsOlderThan
+from nornir_shared.files import RecurseSubdirectories, RecurseSubdirectoriesGenerator, IsOlderThan, AtomicWrite
 
 
 def CreateDirTree(path, dictSubTrees):
@@ -148,6 +148,30 @@ class TestFiles(unittest.TestCase):
         finally:
             os.remove(testPath)
 
+    def test_AtomicWrite(self):
+        testPath = os.path.join(self.TestOutputPath, "AtomicWriteTest.txt")
+        with open(testPath, 'w') as f:
+            f.write("original")
+
+        with self.assertRaises(RuntimeError):
+            with AtomicWrite(testPath) as tempPath:
+                self.assertTrue(tempPath.endswith('.txt'))
+                with open(tempPath, 'w') as f:
+                    f.write("partial")
+                raise RuntimeError("Interrupted write")
+
+        with open(testPath) as f:
+            self.assertEqual(f.read(), "original")
+
+        with AtomicWrite(testPath) as tempPath:
+            with open(tempPath, 'w') as f:
+                f.write("replaced")
+
+        with open(testPath) as f:
+            self.assertEqual(f.read(), "replaced")
+
+        self.assertEqual([name for name in os.listdir(self.TestOutputPath) if name.startswith('.tmp_')], [])
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']